@@ -0,0 +1,174 @@
+"""
+Set-based queries behind the /analytics dashboard.
+
+Every figure is aggregated inside PostgreSQL so only the final numbers
+cross the wire. compute_analytics() reads the summary tables kept by
+analytics_rollups.py; compute_live_analytics() scans the base tables and
+is used until the rollups have been built once.
+"""
+
+AGE_BUCKETS = ['0-18', '19-35', '36-55', '56-75', '75+']
+TOP_DIAGNOSES_LIMIT = 10
+
+_TOTALS_SQL = """
+    SELECT
+        (SELECT COUNT(*) FROM patients),
+        COUNT(*),
+        COUNT(uhid),
+        COUNT(DISTINCT uhid),
+        MAX(visit_date)
+    FROM patient_medical_records
+"""
+
+# Gender is normalised the same way the UI labels it: m/male, f/female,
+# anything else (including blank or NULL) is Other. Age is whole years.
+_DEMOGRAPHICS_SQL = """
+    SELECT
+        COUNT(*) FILTER (WHERE g IN ('male', 'm')),
+        COUNT(*) FILTER (WHERE g IN ('female', 'f')),
+        COUNT(*) FILTER (WHERE g IS NULL OR g NOT IN ('male', 'm', 'female', 'f')),
+        COUNT(*) FILTER (WHERE age <= 18),
+        COUNT(*) FILTER (WHERE age BETWEEN 19 AND 35),
+        COUNT(*) FILTER (WHERE age BETWEEN 36 AND 55),
+        COUNT(*) FILTER (WHERE age BETWEEN 56 AND 75),
+        COUNT(*) FILTER (WHERE age > 75)
+    FROM (
+        SELECT lower(btrim(gender)) AS g,
+               date_part('year', age(CURRENT_DATE, dob)) AS age
+        FROM patients
+    ) p
+"""
+
+_MONTHLY_TRENDS_SQL = """
+    SELECT to_char(date_trunc('month', visit_date), 'YYYY-MM') AS month, COUNT(*)
+    FROM patient_medical_records
+    WHERE visit_date IS NOT NULL
+    GROUP BY 1
+    ORDER BY 1
+"""
+
+_TOP_DIAGNOSES_SQL = """
+    SELECT btrim(diagnosis, E' \\t\\r\\n') AS diagnosis, COUNT(*) AS n
+    FROM patient_medical_records
+    WHERE diagnosis IS NOT NULL AND btrim(diagnosis, E' \\t\\r\\n') <> ''
+    GROUP BY 1
+    ORDER BY n DESC, diagnosis
+    LIMIT %s
+"""
+
+
+_ROLLUP_STATE_SQL = """
+    SELECT (SELECT COALESCE(SUM(patient_count), 0) FROM analytics_patients_with_records), refreshed_at
+    FROM analytics_rollup_state WHERE id = 1
+"""
+
+_ROLLUP_TOTALS_SQL = """
+    SELECT
+        (SELECT COALESCE(SUM(patient_count), 0) FROM analytics_patient_demographics),
+        COALESCE(SUM(record_count), 0),
+        COALESCE(SUM(records_with_uhid), 0),
+        MAX(day) FILTER (WHERE record_count > 0)
+    FROM (
+        SELECT day, SUM(record_count) AS record_count, SUM(records_with_uhid) AS records_with_uhid
+        FROM analytics_daily_records
+        GROUP BY day
+    ) d
+"""
+
+_ROLLUP_DEMOGRAPHICS_SQL = """
+    SELECT
+        COALESCE(SUM(patient_count) FILTER (WHERE gender = 'male'), 0),
+        COALESCE(SUM(patient_count) FILTER (WHERE gender = 'female'), 0),
+        COALESCE(SUM(patient_count) FILTER (WHERE gender = 'other'), 0),
+        COALESCE(SUM(patient_count) FILTER (WHERE age <= 18), 0),
+        COALESCE(SUM(patient_count) FILTER (WHERE age BETWEEN 19 AND 35), 0),
+        COALESCE(SUM(patient_count) FILTER (WHERE age BETWEEN 36 AND 55), 0),
+        COALESCE(SUM(patient_count) FILTER (WHERE age BETWEEN 56 AND 75), 0),
+        COALESCE(SUM(patient_count) FILTER (WHERE age > 75), 0)
+    FROM (
+        SELECT gender, patient_count,
+               CASE WHEN dob = '-infinity' THEN NULL
+                    ELSE date_part('year', age(CURRENT_DATE, dob)) END AS age
+        FROM analytics_patient_demographics
+    ) p
+"""
+
+_ROLLUP_MONTHLY_TRENDS_SQL = """
+    SELECT to_char(date_trunc('month', day), 'YYYY-MM') AS month, SUM(record_count)
+    FROM analytics_daily_records
+    GROUP BY 1
+    HAVING SUM(record_count) > 0
+    ORDER BY 1
+"""
+
+_ROLLUP_TOP_DIAGNOSES_SQL = """
+    SELECT diagnosis, SUM(record_count) AS n
+    FROM analytics_diagnosis_counts
+    GROUP BY diagnosis
+    HAVING SUM(record_count) > 0
+    ORDER BY n DESC, diagnosis
+    LIMIT %s
+"""
+
+
+def _payload(total_patients, total_medical_records, records_with_uhid, patients_with_records,
+             most_recent, demographics, monthly_rows, diagnosis_rows):
+    average_visits_per_patient = 0
+    if total_patients > 0 and patients_with_records > 0:
+        average_visits_per_patient = round(int(records_with_uhid) / int(patients_with_records), 2)
+
+    return {
+        'total_patients': int(total_patients),
+        'total_medical_records': int(total_medical_records),
+        'average_visits_per_patient': average_visits_per_patient,
+        'most_recent_record_date': most_recent.strftime('%Y-%m-%d') if most_recent else "N/A",
+        'gender_data': {'Male': int(demographics[0]), 'Female': int(demographics[1]),
+                        'Other': int(demographics[2])},
+        'age_distribution_data': dict(zip(AGE_BUCKETS, (int(n) for n in demographics[3:]))),
+        'monthly_case_trends_data': {month: int(count) for month, count in monthly_rows},
+        'top_diagnoses_data': {diagnosis: int(count) for diagnosis, count in diagnosis_rows},
+    }
+
+
+def compute_analytics(cursor):
+    """
+    Returns the analytics payload rendered by analytics.html, read from the
+    rollup tables. 'refreshed_at' is the time of the last full rebuild; it is
+    None when the rollups have never been built and the base tables were used.
+    """
+    cursor.execute(_ROLLUP_STATE_SQL)
+    state = cursor.fetchone()
+    if state is None or state[1] is None:
+        payload = compute_live_analytics(cursor)
+        payload['refreshed_at'] = None
+        return payload
+    patients_with_records, refreshed_at = state
+
+    cursor.execute(_ROLLUP_TOTALS_SQL)
+    total_patients, total_medical_records, records_with_uhid, most_recent = cursor.fetchone()
+    cursor.execute(_ROLLUP_DEMOGRAPHICS_SQL)
+    demographics = cursor.fetchone()
+    cursor.execute(_ROLLUP_MONTHLY_TRENDS_SQL)
+    monthly_rows = cursor.fetchall()
+    cursor.execute(_ROLLUP_TOP_DIAGNOSES_SQL, (TOP_DIAGNOSES_LIMIT,))
+    diagnosis_rows = cursor.fetchall()
+
+    payload = _payload(total_patients, total_medical_records, records_with_uhid, patients_with_records,
+                       most_recent, demographics, monthly_rows, diagnosis_rows)
+    payload['refreshed_at'] = refreshed_at
+    return payload
+
+
+def compute_live_analytics(cursor):
+    """Returns the analytics payload computed directly from the base tables."""
+    cursor.execute(_TOTALS_SQL)
+    total_patients, total_medical_records, records_with_uhid, patients_with_records, most_recent = cursor.fetchone()
+    cursor.execute(_DEMOGRAPHICS_SQL)
+    demographics = cursor.fetchone()
+    cursor.execute(_MONTHLY_TRENDS_SQL)
+    monthly_rows = cursor.fetchall()
+    cursor.execute(_TOP_DIAGNOSES_SQL, (TOP_DIAGNOSES_LIMIT,))
+    diagnosis_rows = cursor.fetchall()
+
+    return _payload(total_patients, total_medical_records, records_with_uhid, patients_with_records,
+                    most_recent, demographics, monthly_rows, diagnosis_rows)
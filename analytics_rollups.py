@@ -0,0 +1,214 @@
+"""
+Incrementally maintained rollups for the /analytics dashboard.
+
+Writers call the add_/remove_ helpers with their own cursor, inside the
+transaction that inserts or updates the patient / medical record, so the
+summary tables commit atomically with the data. An update is expressed as
+"remove the row's old contribution, then add the new one".
+
+Counters every medical record write touches (the visit day, the
+diagnosis, patients with records) are spread over ANALYTICS_ROLLUP_SHARDS
+rows per key (migration 0015); each write picks one at random, so
+concurrent writes do not queue on a single row. Readers sum the shards.
+
+`python analytics_rollups.py refresh` reconciles the rollups with the base
+tables; schedule it (e.g. nightly cron) to correct anything written
+outside the app. It takes no table locks. In one REPEATABLE READ snapshot
+it computes, per key, the true count minus the rollup's count; a second
+short transaction adds those corrections to the live rollups. Increments
+committed while the rebuild ran are kept, because the correction only
+covers what was wrong as of the snapshot.
+"""
+import os
+import random
+import sys
+
+from database import open_connection
+
+ANALYTICS_ROLLUP_SHARDS = int(os.environ.get('ANALYTICS_ROLLUP_SHARDS', 8))
+
+# Keep these in step with analytics_queries.py
+GENDER_KEY_SQL = """CASE WHEN lower(btrim(gender)) IN ('male', 'm') THEN 'male'
+                         WHEN lower(btrim(gender)) IN ('female', 'f') THEN 'female'
+                         ELSE 'other' END"""
+DIAGNOSIS_KEY_SQL = "btrim(diagnosis, E' \\t\\r\\n')"
+
+
+def _apply_patient(cursor, patient_id, sign):
+    cursor.execute(
+        f"""INSERT INTO analytics_patient_demographics AS d (dob, gender, patient_count)
+            SELECT COALESCE(dob, '-infinity'::date), {GENDER_KEY_SQL}, %(sign)s
+            FROM patients WHERE id = %(id)s
+            ON CONFLICT (dob, gender)
+            DO UPDATE SET patient_count = d.patient_count + EXCLUDED.patient_count""",
+        {'id': patient_id, 'sign': sign}
+    )
+
+
+def _apply_record(cursor, record_id, sign):
+    params = {'id': record_id, 'sign': sign, 'shard': random.randrange(ANALYTICS_ROLLUP_SHARDS)}
+    cursor.execute(
+        """INSERT INTO analytics_daily_records AS r (day, shard, record_count, records_with_uhid)
+           SELECT visit_date::date, %(shard)s, %(sign)s, CASE WHEN uhid IS NULL THEN 0 ELSE %(sign)s END
+           FROM patient_medical_records WHERE id = %(id)s AND visit_date IS NOT NULL
+           ON CONFLICT (day, shard) DO UPDATE
+           SET record_count = r.record_count + EXCLUDED.record_count,
+               records_with_uhid = r.records_with_uhid + EXCLUDED.records_with_uhid""",
+        params
+    )
+    cursor.execute(
+        f"""INSERT INTO analytics_diagnosis_counts AS c (diagnosis, shard, record_count)
+            SELECT {DIAGNOSIS_KEY_SQL}, %(shard)s, %(sign)s
+            FROM patient_medical_records
+            WHERE id = %(id)s AND diagnosis IS NOT NULL AND {DIAGNOSIS_KEY_SQL} <> ''
+            ON CONFLICT (diagnosis, shard) DO UPDATE SET record_count = c.record_count + EXCLUDED.record_count""",
+        params
+    )
+    # A patient starts (or stops) counting as "with records" when this row is
+    # their only one. Concurrent first visits for the same UHID can race here;
+    # the scheduled refresh corrects that.
+    cursor.execute(
+        """INSERT INTO analytics_patients_with_records AS p (shard, patient_count)
+           SELECT %(shard)s, %(sign)s
+           WHERE EXISTS (
+               SELECT 1 FROM patient_medical_records r
+               WHERE r.id = %(id)s AND r.uhid IS NOT NULL
+                 AND (SELECT COUNT(*) FROM patient_medical_records o WHERE o.uhid = r.uhid) = 1
+           )
+           ON CONFLICT (shard) DO UPDATE SET patient_count = p.patient_count + EXCLUDED.patient_count""",
+        params
+    )
+
+
+def add_patient_to_rollups(cursor, patient_id):
+    _apply_patient(cursor, patient_id, 1)
+
+
+def remove_patient_from_rollups(cursor, patient_id):
+    _apply_patient(cursor, patient_id, -1)
+
+
+def add_record_to_rollups(cursor, record_id):
+    _apply_record(cursor, record_id, 1)
+
+
+def remove_record_from_rollups(cursor, record_id):
+    _apply_record(cursor, record_id, -1)
+
+
+# Per key: the true count from the base tables minus what the rollup holds
+_DELTA_SQL = {
+    'daily': """
+        SELECT day, SUM(record_count) AS record_count, SUM(records_with_uhid) AS records_with_uhid
+        FROM (
+            SELECT visit_date::date AS day, COUNT(*) AS record_count, COUNT(uhid) AS records_with_uhid
+            FROM patient_medical_records
+            WHERE visit_date IS NOT NULL
+            GROUP BY 1
+            UNION ALL
+            SELECT day, -SUM(record_count), -SUM(records_with_uhid)
+            FROM analytics_daily_records
+            GROUP BY 1
+        ) d
+        GROUP BY day
+        HAVING SUM(record_count) <> 0 OR SUM(records_with_uhid) <> 0""",
+    'diagnosis': f"""
+        SELECT diagnosis, SUM(record_count) AS record_count
+        FROM (
+            SELECT {DIAGNOSIS_KEY_SQL} AS diagnosis, COUNT(*) AS record_count
+            FROM patient_medical_records
+            WHERE diagnosis IS NOT NULL AND {DIAGNOSIS_KEY_SQL} <> ''
+            GROUP BY 1
+            UNION ALL
+            SELECT diagnosis, -SUM(record_count)
+            FROM analytics_diagnosis_counts
+            GROUP BY 1
+        ) d
+        GROUP BY diagnosis
+        HAVING SUM(record_count) <> 0""",
+    'demographics': f"""
+        SELECT dob, gender, SUM(patient_count) AS patient_count
+        FROM (
+            SELECT COALESCE(dob, '-infinity'::date) AS dob, {GENDER_KEY_SQL} AS gender, COUNT(*) AS patient_count
+            FROM patients
+            GROUP BY 1, 2
+            UNION ALL
+            SELECT dob, gender, -patient_count
+            FROM analytics_patient_demographics
+        ) d
+        GROUP BY dob, gender
+        HAVING SUM(patient_count) <> 0""",
+    'patients_with_records': """
+        SELECT patient_count
+        FROM (
+            SELECT (SELECT COUNT(DISTINCT uhid) FROM patient_medical_records)
+                   - (SELECT COALESCE(SUM(patient_count), 0) FROM analytics_patients_with_records) AS patient_count
+        ) d
+        WHERE patient_count <> 0""",
+}
+
+# Adds the corrections to the live rollups (shard 0), then drops rows that
+# have gone to zero
+_APPLY_SQL = (
+    """INSERT INTO analytics_daily_records AS r (day, shard, record_count, records_with_uhid)
+       SELECT day, 0, record_count, records_with_uhid FROM rollup_delta_daily
+       ON CONFLICT (day, shard) DO UPDATE
+       SET record_count = r.record_count + EXCLUDED.record_count,
+           records_with_uhid = r.records_with_uhid + EXCLUDED.records_with_uhid""",
+    """INSERT INTO analytics_diagnosis_counts AS c (diagnosis, shard, record_count)
+       SELECT diagnosis, 0, record_count FROM rollup_delta_diagnosis
+       ON CONFLICT (diagnosis, shard) DO UPDATE SET record_count = c.record_count + EXCLUDED.record_count""",
+    """INSERT INTO analytics_patient_demographics AS d (dob, gender, patient_count)
+       SELECT dob, gender, patient_count FROM rollup_delta_demographics
+       ON CONFLICT (dob, gender) DO UPDATE SET patient_count = d.patient_count + EXCLUDED.patient_count""",
+    """INSERT INTO analytics_patients_with_records AS p (shard, patient_count)
+       SELECT 0, patient_count FROM rollup_delta_patients_with_records
+       ON CONFLICT (shard) DO UPDATE SET patient_count = p.patient_count + EXCLUDED.patient_count""",
+    "DELETE FROM analytics_daily_records WHERE record_count = 0 AND records_with_uhid = 0",
+    "DELETE FROM analytics_diagnosis_counts WHERE record_count = 0",
+    "DELETE FROM analytics_patient_demographics WHERE patient_count = 0",
+    """INSERT INTO analytics_rollup_state (id, refreshed_at) VALUES (1, NOW())
+       ON CONFLICT (id) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at""",
+)
+
+
+def rebuild_rollups(conn):
+    """Reconciles every rollup table with the base tables without blocking writers. Returns the corrected keys."""
+    with conn.cursor() as cursor:
+        # One snapshot for both the base tables and the rollups, so the
+        # differences are exact as of that moment
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        corrected = 0
+        for name, sql in _DELTA_SQL.items():
+            cursor.execute(f"DROP TABLE IF EXISTS rollup_delta_{name}")
+            cursor.execute(f"CREATE TEMP TABLE rollup_delta_{name} AS {sql}")
+            corrected += cursor.rowcount
+    conn.commit()
+
+    with conn.cursor() as cursor:
+        for sql in _APPLY_SQL:
+            cursor.execute(sql)
+        for name in _DELTA_SQL:
+            cursor.execute(f"DROP TABLE rollup_delta_{name}")
+    conn.commit()
+    return corrected
+
+
+def refresh():
+    conn = open_connection()
+    try:
+        print("Rebuilding analytics rollups...")
+        corrected = rebuild_rollups(conn)
+        print(f"✅ Analytics rollups rebuilt ({corrected} counts corrected).")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['refresh']:
+        print("Usage: python analytics_rollups.py refresh")
+        sys.exit(2)
+    refresh()
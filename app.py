@@ -1,6 +1,6 @@
 # app.py
 
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response, json
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, make_response, json, Response
 import psycopg2
 from psycopg2 import extras
 
@@ -8,21 +8,55 @@ from werkzeug.security import generate_password_hash, check_password_hash
 import uuid
 from datetime import datetime, timedelta
 import json
-from collections import Counter
 from functools import wraps
 from flask import Blueprint, send_from_directory
 import os
 import requests
 import time
-from flask import render_template_string, send_from_directory
+from flask import render_template_string, send_from_directory, send_file
 import secrets
-from database import get_db_connection
-from database import create_tables, ensure_columns
+from database import db_connection, get_db_connection, pool_stats
+from migrate import check_schema_version, apply_migrations
+from pagination import clamp_page_size
+from patient_search import search_patients, decode_search_cursor, SEARCH_PAGE_SIZE
+from patient_directory import list_patients_page, decode_directory_cursor
+from analytics_queries import compute_analytics, AGE_BUCKETS
+from audit_writer import log_edit, log_action, audit_writer_stats
+from audit_log_queries import (
+    build_audit_filters, decode_audit_cursor, list_audit_logs_page, stream_audit_csv,
+    AUDIT_PAGE_SIZE, AUDIT_MAX_PAGE_SIZE,
+)
+from ttl_cache import TTLCache
+from lab_orders import record_order, lookup_order, list_orders, set_order_status, order_index_stats
+import http_client
+from http_client import http_client_stats, CircuitOpenError
+from lab_status import (
+    SHARED_API_KEY, get_order, fetch_order_statuses, order_status_summary, order_status_cache_stats,
+    order_not_modified, open_order_stream, iter_order_stream,
+)
+from status_stream import get_status_hub, status_stream_stats, StreamLimitReached, SSE_MAX_TOPICS
+from jobs import get_job
+from scan_jobs import enqueue_scan_request, enqueue_lab_report
+from webhooks import authenticate as webhook_authenticate, handle_lis_event, handle_pacs_event
+from blob_store import find_blob
+from analytics_rollups import (
+    add_patient_to_rollups, remove_patient_from_rollups,
+    add_record_to_rollups, remove_record_from_rollups,
+)
 
 
 # This is a sample host for an external service. In a real application, this should be in a config file.
-DEFAULT_HOST = "https://dcm4chee.org/dcm4chee-arc/aets/DCM4CHEE/rs"
-SHARED_API_KEY = "hospital_shared_key"
+# Set LAB_HOST to point at another LIS / PACS, e.g. mock_lab_server.py for local testing.
+DEFAULT_HOST = os.environ.get('LAB_HOST', "https://dcm4chee.org/dcm4chee-arc/aets/DCM4CHEE/rs")
+# Set AUTO_MIGRATE=1 for local development to apply pending migrations on startup.
+AUTO_MIGRATE = os.environ.get('AUTO_MIGRATE') == '1'
+# Computed /analytics payloads are reused for this many seconds; writes to
+# patients or medical records through this worker clear the cache at once.
+ANALYTICS_CACHE_TTL = int(os.environ.get('ANALYTICS_CACHE_TTL', 60))
+analytics_cache = TTLCache(maxsize=8, ttl=ANALYTICS_CACHE_TTL)
+# Orders shown on /history; each gets a status lookup (see lab_status.py)
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_ORDERS = 200
 # To avoid an insecure request warning, we'll use a local mock for the example.
 # A full implementation would use a proper secure endpoint.
 # The endpoint is not used in this app as the focus is on UI and database.
@@ -43,7 +77,6 @@ app.config['SESSION_PERMANENT'] = True
 
 # Create a 'downloads' directory to store the test reports
 os.makedirs("downloads", exist_ok=True)
-HISTORY_PATH = os.path.join("downloads", "order_history.json")
 
 # --- Utility Helpers ---
 def safe_strftime(val, format='%Y-%m-%d'):
@@ -55,35 +88,6 @@ def safe_strftime(val, format='%Y-%m-%d'):
     # If it's already a string, return it (or attempt parsing if needed)
     return str(val)
 
-def load_history(department=None):
-    if not os.path.exists(HISTORY_PATH):
-        return []
-    try:
-        import json as _json
-        with open(HISTORY_PATH, 'r', encoding='utf-8') as f:
-            history = _json.load(f) or []
-            
-            # Filter by department if specified
-            if department:
-                history = [order for order in history if order.get('department') == department]
-                
-            return history
-    except Exception:
-        return []
-
-def save_history(history):
-    try:
-        import json as _json
-        with open(HISTORY_PATH, 'w', encoding='utf-8') as f:
-            _json.dump(history, f, ensure_ascii=False, indent=2)
-    except Exception:
-        pass
-
-def record_order(entry):
-    history = load_history()
-    history.insert(0, entry)
-    save_history(history)
-
 TEST_CATEGORIES = {
     'biochemistry': {
         'Kidney Function': ['GLU', 'UREA', 'CREATININE'],
@@ -108,50 +112,6 @@ TEST_CATEGORIES = {
 
 # --- Helpers ---
 
-def save_test_stream_to_file(resp, out_path, chunk_size=8192):
-    """Saves a streaming response content to a file."""
-    with open(out_path, 'wb') as f:
-        for chunk in resp.iter_content(chunk_size):
-            if chunk:
-                f.write(chunk)
-
-def download_report(host, order_id, out_dir, uhid=None):
-    """Downloads a test report by order ID."""
-    url = f"{host.rstrip('/')}/api/orders/{order_id}"
-    try:
-        with requests.get(url, stream=True, timeout=30, headers={'X-API-Key': SHARED_API_KEY}) as r:
-            if r.ok:
-                ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-                fname = f"{uhid or 'patient'}_{order_id}_{ts}.json"
-                
-                out_path = os.path.join(out_dir, fname)
-                save_test_stream_to_file(r, out_path)
-                return fname
-            else:
-                return None
-    except Exception:
-        return None
-
-def poll_test_request_status(host, order_id, timeout_s, poll_interval_s, out_dir, uhid):
-    """Polls the status of a request until it's completed or times out."""
-    status_url = f"{host.rstrip('/')}/api/orders/{order_id}"
-    started = time.time()
-    while time.time() - started < timeout_s:
-        try:
-            r = requests.get(status_url, timeout=15, headers={'X-API-Key': SHARED_API_KEY})
-            if r.ok:
-                j = r.json()
-                # Check if any department has completed results
-                per_dept = j.get('perDepartment', [])
-                for dept in per_dept:
-                    if dept.get('status') == 'completed' and dept.get('results'):
-                        return download_report(host, order_id, out_dir, uhid)
-        except requests.RequestException:
-            # Ignore connection errors and continue polling
-            pass
-        time.sleep(poll_interval_s)
-    return None
-
 def perform_test_request(host, department, uhid, tests, priority='routine', specimen='Blood', clinical_notes=''):
     """Performs the API request to create a lab test order."""
     url = f"{host.rstrip('/')}/api/orders"
@@ -180,7 +140,7 @@ def perform_test_request(host, department, uhid, tests, priority='routine', spec
     }
 
     try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=30)
+        resp = http_client.post(url, json=payload, headers=headers, timeout=30, endpoint='lis.orders.create')
     except requests.RequestException as e:
         return None, f"Request error: {e}"
 
@@ -189,16 +149,20 @@ def perform_test_request(host, department, uhid, tests, priority='routine', spec
         order_id = j.get('orderId')
         if order_id:
             # Record to local history
-            record_order({
-                'orderId': order_id,
-                'externalOrderId': payload.get('externalOrderId'),
-                'uhid': uhid,
-                'department': department,
-                'priority': priority,
-                'tests': tests,
-                'specimen': specimen,
-                'createdAt': datetime.now().isoformat()
-            })
+            try:
+                record_order({
+                    'orderId': order_id,
+                    'externalOrderId': payload.get('externalOrderId'),
+                    'uhid': uhid,
+                    'department': department,
+                    'priority': priority,
+                    'tests': tests,
+                    'specimen': specimen,
+                    'createdAt': datetime.now().isoformat()
+                })
+            except Exception as e:
+                # The LIS already accepted the order; don't fail the request over local history
+                print(f"❌ Could not record lab order {order_id}: {e}")
             # Return the actual order ID from the main system
             return order_id, None
         else:
@@ -206,6 +170,13 @@ def perform_test_request(host, department, uhid, tests, priority='routine', spec
     
     return None, f"Server returned error {resp.status_code}: {resp.text[:400]}"    
 
+def order_access(order_id, department):
+    """Returns (order_exists, order_belongs_to_department) for a lab order."""
+    order = lookup_order(order_id)
+    if order is None:
+        return False, False
+    return True, (order.get("department") or "").lower() == department.lower()
+
 # API Key Management (In-memory for this example, use a database in production)
 API_KEYS = {
     "optho-7589-abcde-01": "Ophthalmology Department",
@@ -228,95 +199,6 @@ def validate_api_key(f):
 # Create a 'downloads' directory to store the DICOM files
 os.makedirs("downloads", exist_ok=True)
 
-# --- Helpers ---
-
-def save_stream_to_file(resp, out_path, chunk_size=8192):
-    """Saves a streaming response content to a file."""
-    with open(out_path, 'wb') as f:
-        for chunk in resp.iter_content(chunk_size):
-            if chunk:
-                f.write(chunk)
-
-def download_scan(host, scan_id, out_dir, uhid=None):
-    """Downloads a scan by its ID and saves it."""
-    url = f"{host.rstrip('/')}/api/scans/download/{scan_id}"
-    try:
-        with requests.get(url, stream=True, timeout=30) as r:
-            if r.ok:
-                disp = r.headers.get('Content-Disposition', '')
-                if 'filename=' in disp:
-                    fname = disp.split('filename=')[-1].strip(' "')
-                else:
-                    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    fname = f"{uhid or 'scan'}_{scan_id}_{ts}.dcm"
-                
-                out_path = os.path.join(out_dir, fname)
-                save_stream_to_file(r, out_path)
-                return fname
-            else:
-                return None
-    except Exception:
-        return None
-
-def poll_request_status(host, request_id, timeout_s, poll_interval_s, out_dir, uhid):
-    """Polls the status of a request until it's attended or times out."""
-    status_url = f"{host.rstrip('/')}/api/request_status/{request_id}"
-    started = time.time()
-    while time.time() - started < timeout_s:
-        try:
-            r = requests.get(status_url, timeout=15)
-            if r.ok:
-                j = r.json()
-                status = j.get('status')
-                scan_id = j.get('scan_id')
-                if status and status.lower() in ('attended', 'completed') and scan_id:
-                    return download_scan(host, scan_id, out_dir, uhid)
-        except requests.RequestException:
-            # Ignore connection errors and continue polling
-            pass
-        time.sleep(poll_interval_s)
-    return None
-
-def perform_request(host, department, uhid, scan_type, body_part, poll_interval_s=3.0, timeout_s=300.0):
-    """Performs the API request to get or request a scan."""
-    url = f"{host.rstrip('/')}/api/v1/get_or_request_scan"
-    payload = {
-        "department_name": department,
-        "uhid": uhid,
-        "type_of_scan": scan_type,
-        "body_part": body_part
-    }
-    headers = {'Accept': 'application/json, application/dicom, */*'}
-
-    try:
-        resp = requests.post(url, json=payload, headers=headers, timeout=30, stream=True)
-    except requests.RequestException as e:
-        return None, f"Request error: {e}"
-
-    if resp.status_code == 200:
-        if 'application/json' in resp.headers.get('Content-Type', '').lower():
-            return None, f"Received unexpected JSON: {resp.json()}"
-        else:
-            ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-            fname = f"{uhid or 'scan'}_{ts}.dcm"
-            out_path = os.path.join("downloads", fname)
-            save_stream_to_file(resp, out_path)
-            return fname, None
-
-    if resp.status_code == 202:
-        j = resp.json()
-        request_id = j.get('request_id') or j.get('id')
-        if not request_id:
-            return None, f"Server returned 202 but no request_id was found: {j}"
-        
-        fname = poll_request_status(host, request_id, timeout_s, poll_interval_s, "downloads", uhid)
-        if fname:
-            return fname, None
-        else:
-            return None, "Polling timed out or the final download failed."
-
-    return None, f"Server returned error {resp.status_code}: {resp.text[:400]}"
-
 # --- Flask UI ---
 
 def generate_test_form_html():
@@ -535,6 +417,14 @@ def generate_test_form_html():
             }
         });
 
+        // Live status for the order just submitted; the Check Status button still works without it
+        const submittedOrderId = document.getElementById('currentOrderId') && document.getElementById('currentOrderId').value;
+        if (submittedOrderId && window.EventSource) {
+            const statusEvents = new EventSource(`/api/status/stream?orders=${encodeURIComponent(submittedOrderId)}`);
+            statusEvents.addEventListener('status', e => updateStatusDisplay(JSON.parse(e.data)));
+            statusEvents.addEventListener('done', () => statusEvents.close());
+        }
+
         // Status checking function
         function checkStatus() {
             const orderId = document.getElementById('currentOrderId').value;
@@ -757,100 +647,99 @@ def get_patient_api(uhid):
     API endpoint to retrieve patient medical records by UHID.
     This now only returns medical data and prescriptions.
     """
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed."}), 500
+    with db_connection() as conn:
+        if not conn:
+            return jsonify({"error": "Database connection failed."}), 500
 
-    cursor = conn.cursor()
-    try:
-        # First, check if the patient exists in the patients table
-        cursor.execute("SELECT uhid FROM patients WHERE uhid = %s", (uhid,))
-        if not cursor.fetchone():
-            return jsonify({"error": "Patient not found"}), 404
+        cursor = conn.cursor()
+        try:
+            # First, check if the patient exists in the patients table
+            cursor.execute("SELECT uhid FROM patients WHERE uhid = %s", (uhid,))
+            if not cursor.fetchone():
+                return jsonify({"error": "Patient not found"}), 404
         
-        # Get the department name from the API key
-        api_key = request.headers.get("X-API-Key")
-        department_name = API_KEYS.get(api_key, "Unknown Department")
-
-        # Now, fetch all medical records for the given UHID, including all test results and prescriptions.
-        cursor.execute(
-            """SELECT uhid, diagnosis, treatment, visit_date, test_results FROM patient_medical_records
-               WHERE uhid = %s ORDER BY visit_date DESC""",
-            (uhid,)
-        )
-        medical_records_data = cursor.fetchall()
+            # Get the department name from the API key
+            api_key = request.headers.get("X-API-Key")
+            department_name = API_KEYS.get(api_key, "Unknown Department")
+
+            # Now, fetch all medical records for the given UHID, including all test results and prescriptions.
+            cursor.execute(
+                """SELECT uhid, diagnosis, treatment, visit_date, test_results FROM patient_medical_records
+                   WHERE uhid = %s ORDER BY visit_date DESC""",
+                (uhid,)
+            )
+            medical_records_data = cursor.fetchall()
         
-        # 2. Fetch Prescriptions
-        cursor.execute(
-            """SELECT uhid, visit_date, spectacle_lens, lens_type, medications, systemic_medication, surgery_recommendation, iol_notes, patient_instructions, follow_up_date 
-               FROM patient_prescriptions
-               WHERE uhid = %s ORDER BY visit_date DESC""",
-            (uhid,)
-        )
-        prescriptions_data = cursor.fetchall()
+            # 2. Fetch Prescriptions
+            cursor.execute(
+                """SELECT uhid, visit_date, spectacle_lens, lens_type, medications, systemic_medication, surgery_recommendation, iol_notes, patient_instructions, follow_up_date 
+                   FROM patient_prescriptions
+                   WHERE uhid = %s ORDER BY visit_date DESC""",
+                (uhid,)
+            )
+            prescriptions_data = cursor.fetchall()
         
-        # MODIFICATION END
+            # MODIFICATION END
 
-        # 3. Process and Combine Data
+            # 3. Process and Combine Data
 
-        # Organize medical records by visit_date for easier merging with prescriptions
-        records_by_date = {}
-        for record in medical_records_data:
-            uhid, diagnosis, treatment, visit_date, test_results = record
+            # Organize medical records by visit_date for easier merging with prescriptions
+            records_by_date = {}
+            for record in medical_records_data:
+                uhid, diagnosis, treatment, visit_date, test_results = record
             
-            # Use visit_date as the key
-            date_key = visit_date.isoformat() if visit_date else None
+                # Use visit_date as the key
+                date_key = visit_date.isoformat() if visit_date else None
             
-            if date_key not in records_by_date:
-                # Initialize the main record structure
-                records_by_date[date_key] = {
-                    "uhid": uhid,
-                    "record_date": date_key,
-                    "diagnosis": diagnosis,
-                    "treatment": treatment,
-                    "test_results": test_results,
-                    "prescriptions": []  # List to hold all prescriptions for this visit
-                }
+                if date_key not in records_by_date:
+                    # Initialize the main record structure
+                    records_by_date[date_key] = {
+                        "uhid": uhid,
+                        "record_date": date_key,
+                        "diagnosis": diagnosis,
+                        "treatment": treatment,
+                        "test_results": test_results,
+                        "prescriptions": []  # List to hold all prescriptions for this visit
+                    }
         
-        # Add prescriptions to the corresponding medical record
-        for record in prescriptions_data:
-            uhid, visit_date, spectacle_lens, lens_type, medications, systemic_medication, surgery_recommendation, iol_notes, patient_instructions, follow_up_date  = record
-            date_key = visit_date.isoformat() if visit_date else None
+            # Add prescriptions to the corresponding medical record
+            for record in prescriptions_data:
+                uhid, visit_date, spectacle_lens, lens_type, medications, systemic_medication, surgery_recommendation, iol_notes, patient_instructions, follow_up_date  = record
+                date_key = visit_date.isoformat() if visit_date else None
             
-            if date_key in records_by_date:
-                records_by_date[date_key]["prescriptions"].append({
-                    "spectacle_lens": spectacle_lens,
-                    "lens_type": lens_type,
-                    "medications": medications,
-                    "systemic_medication": systemic_medication,
-                    "surgery_recommendation": surgery_recommendation,
-                    "iol_notes": iol_notes,
-                    "patient_instructions": patient_instructions,
-                    "follow_up_date": follow_up_date
-                })
-            # NOTE: If a prescription exists without a corresponding medical record, 
-            # it will be ignored in this structure.
-
-        # Convert the dictionary values back to a list, sorted by date
-        combined_records = sorted(
-            list(records_by_date.values()), 
-            key=lambda x: x['record_date'], 
-            reverse=True
-        )
-
-        # Return the medical records and the department name
-        response = {
-            "department": department_name,
-            "patient_records": combined_records # Changed key for clarity
-        }
+                if date_key in records_by_date:
+                    records_by_date[date_key]["prescriptions"].append({
+                        "spectacle_lens": spectacle_lens,
+                        "lens_type": lens_type,
+                        "medications": medications,
+                        "systemic_medication": systemic_medication,
+                        "surgery_recommendation": surgery_recommendation,
+                        "iol_notes": iol_notes,
+                        "patient_instructions": patient_instructions,
+                        "follow_up_date": follow_up_date
+                    })
+                # NOTE: If a prescription exists without a corresponding medical record, 
+                # it will be ignored in this structure.
+
+            # Convert the dictionary values back to a list, sorted by date
+            combined_records = sorted(
+                list(records_by_date.values()), 
+                key=lambda x: x['record_date'], 
+                reverse=True
+            )
 
-        return jsonify(response)
+            # Return the medical records and the department name
+            response = {
+                "department": department_name,
+                "patient_records": combined_records # Changed key for clarity
+            }
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 400
-    finally:
-        cursor.close()
-        conn.close()
+            return jsonify(response)
+
+        except Exception as e:
+            return jsonify({"error": str(e)}), 400
+        finally:
+            cursor.close()
 
 @app.route('/api/patient/add', methods=['POST'])
 @validate_api_key
@@ -860,64 +749,65 @@ def add_patient_api():
     This endpoint has been modified to handle only demographic data, as requested,
     and now explicitly rejects attempts to add medical records.
     """
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed."}), 500
+    with db_connection() as conn:
+        if not conn:
+            return jsonify({"error": "Database connection failed."}), 500
 
-    cursor = conn.cursor()
-    try:
-        data = request.get_json()
-        if not data:
-            return jsonify({"error": "Invalid JSON data"}), 400
-
-        # Required demographic fields
-        demographics = data.get('demographics', {})
-        uhid = demographics.get('uhid')
-        first_name = demographics.get('first_name')
-        last_name = demographics.get('last_name')
-        dob = demographics.get('dob')
-        gender = demographics.get('gender')
-        address = demographics.get('address')
-        phone = demographics.get('phone')
-        email = demographics.get('email')
-
-        if not all([uhid, first_name, last_name, dob]):
-            return jsonify({"error": "Missing required demographic fields: uhid, first_name, last_name, and dob are mandatory."}), 400
+        cursor = conn.cursor()
+        try:
+            data = request.get_json()
+            if not data:
+                return jsonify({"error": "Invalid JSON data"}), 400
+
+            # Required demographic fields
+            demographics = data.get('demographics', {})
+            uhid = demographics.get('uhid')
+            first_name = demographics.get('first_name')
+            last_name = demographics.get('last_name')
+            dob = demographics.get('dob')
+            gender = demographics.get('gender')
+            address = demographics.get('address')
+            phone = demographics.get('phone')
+            email = demographics.get('email')
+
+            if not all([uhid, first_name, last_name, dob]):
+                return jsonify({"error": "Missing required demographic fields: uhid, first_name, last_name, and dob are mandatory."}), 400
+        
+            # Check if the patient already exists
+            cursor.execute("SELECT uhid FROM patients WHERE uhid = %s", (uhid,))
+            if cursor.fetchone():
+                return jsonify({"error": f"Patient with UHID {uhid} already exists."}), 409
+
+            # Insert the new patient's demographic data
+            cursor.execute(
+                """INSERT INTO patients (uhid, first_name, last_name, dob, gender, address, phone, email)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id""",
+                (uhid, first_name, last_name, dob, gender, address, phone, email)
+            )
+            patient_id = cursor.fetchone()[0]
+            add_patient_to_rollups(cursor, patient_id)
+
+            conn.commit()
+            analytics_cache.clear()
+
+            # Check for and reject medical record data
+            if 'medical_records' in data:
+                return jsonify({
+                    "message": "Patient added successfully! Note: No medical records were added as this is restricted to the administration department.",
+                    "uhid": uhid
+                }), 201
         
-        # Check if the patient already exists
-        cursor.execute("SELECT uhid FROM patients WHERE uhid = %s", (uhid,))
-        if cursor.fetchone():
-            return jsonify({"error": f"Patient with UHID {uhid} already exists."}), 409
-
-        # Insert the new patient's demographic data
-        cursor.execute(
-            """INSERT INTO patients (uhid, first_name, last_name, dob, gender, address, phone, email)
-               VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id""",
-            (uhid, first_name, last_name, dob, gender, address, phone, email)
-        )
-        patient_id = cursor.fetchone()[0]
-
-        conn.commit()
-
-        # Check for and reject medical record data
-        if 'medical_records' in data:
             return jsonify({
-                "message": "Patient added successfully! Note: No medical records were added as this is restricted to the administration department.",
+                "message": "Patient added successfully!",
                 "uhid": uhid
             }), 201
-        
-        return jsonify({
-            "message": "Patient added successfully!",
-            "uhid": uhid
-        }), 201
 
-    except Exception as e:
-        if conn:
-            conn.rollback()
-        return jsonify({"error": str(e)}), 400
-    finally:
-        cursor.close()
-        conn.close()
+        except Exception as e:
+            if conn:
+                conn.rollback()
+            return jsonify({"error": str(e)}), 400
+        finally:
+            cursor.close()
 
 # --- Decorators for Authentication and Authorization ---
 def login_required(f):
@@ -955,25 +845,24 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        conn = get_db_connection()
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, username, password_hash, role FROM users WHERE username = %s", (username,))
-            user = cursor.fetchone()
-            cursor.close()
-            conn.close()
+        with db_connection() as conn:
+            if conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT id, username, password_hash, role FROM users WHERE username = %s", (username,))
+                user = cursor.fetchone()
+                cursor.close()
 
-            if user and check_password_hash(user[2], password):
-                session['user_id'] = user[0]
-                session['username'] = user[1]
-                session['user_role'] = user[3]
-                flash(f"Welcome, {user[1]}! You are logged in as {user[3]}.", "success")
-                return redirect(url_for('dashboard'))
+                if user and check_password_hash(user[2], password):
+                    session['user_id'] = user[0]
+                    session['username'] = user[1]
+                    session['user_role'] = user[3]
+                    flash(f"Welcome, {user[1]}! You are logged in as {user[3]}.", "success")
+                    return redirect(url_for('dashboard'))
+                else:
+                    flash("Invalid username or password.", "danger")
             else:
-                flash("Invalid username or password.", "danger")
-        else:
-            flash("Could not connect to database for login.", "error")
-    return render_template('login.html')
+                flash("Could not connect to database for login.", "error")
+        return render_template('login.html')
 
 @app.route('/logout')
 @login_required
@@ -998,80 +887,109 @@ def dashboard():
         return redirect(url_for('create_user'))
     else:
         patients = []
-        conn = get_db_connection()
-        if conn:
-            cursor = conn.cursor()
-            try:
-                cursor.execute(
-                    """SELECT uhid, first_name, last_name, dob, gender FROM patients
-                       ORDER BY last_name, first_name"""
-                )
-                patients = cursor.fetchall()
-            except Exception as e:
-                flash(f"Error fetching patient list: {e}", "danger")
-            finally:
-                cursor.close()
-                conn.close()
-        return render_template('dashboard.html', username=session['username'], role=session['user_role'], patients=patients)
+        next_url = prev_url = None
+        limit = clamp_page_size(request.args.get('limit'))
+        after = decode_directory_cursor(request.args.get('after'))
+        before = decode_directory_cursor(request.args.get('before'))
+        with db_connection() as conn:
+            if conn:
+                cursor = conn.cursor()
+                try:
+                    patients, next_cursor, prev_cursor = list_patients_page(cursor, limit, after, before)
+                    if next_cursor:
+                        next_url = url_for('dashboard', after=next_cursor, limit=limit)
+                    if prev_cursor:
+                        prev_url = url_for('dashboard', before=prev_cursor, limit=limit)
+                except Exception as e:
+                    flash(f"Error fetching patient list: {e}", "danger")
+                finally:
+                    cursor.close()
+        return render_template('dashboard.html', username=session['username'], role=session['user_role'], patients=patients,
+                               next_url=next_url, prev_url=prev_url)
+
+@app.route('/api/patients')
+@login_required
+def patient_list_api():
+    """One keyset page of the patient directory, ordered by last name, first name."""
+    if session['user_role'] == 'admin':
+        return jsonify({"error": "Admin users do not have access to patient records."}), 403
+
+    limit = clamp_page_size(request.args.get('limit'))
+    after = decode_directory_cursor(request.args.get('after'))
+    before = decode_directory_cursor(request.args.get('before'))
+
+    with db_connection() as conn:
+        if not conn:
+            return jsonify({"error": "Database connection failed."}), 500
+        cursor = conn.cursor()
+        try:
+            rows, next_cursor, prev_cursor = list_patients_page(cursor, limit, after, before)
+        except psycopg2.Error as e:
+            return jsonify({"error": str(e)}), 500
+        finally:
+            cursor.close()
+
+    return jsonify({
+        "results": [
+            {"uhid": uhid, "first_name": first_name, "last_name": last_name,
+             "dob": safe_strftime(dob), "gender": gender}
+            for uhid, first_name, last_name, dob, gender in rows
+        ],
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+    })
 
 @app.route('/add_patient', methods=['POST'])
 @login_required
 def add_patient():
-    conn = get_db_connection()
-    if not conn:
-        flash('Database connection failed.', 'danger')
-        return redirect(url_for('dashboard'))
+    with db_connection() as conn:
+        if not conn:
+            flash('Database connection failed.', 'danger')
+            return redirect(url_for('dashboard'))
 
-    cursor = conn.cursor()
+        cursor = conn.cursor()
     
-    uhid = request.form.get('uhid')
-    first_name = request.form.get('first_name')
-    last_name = request.form.get('last_name')
-    dob = request.form.get('dob')
-    gender = request.form.get('gender')
-    address = request.form.get('address')
-    phone = request.form.get('phone')
-    email = request.form.get('email')
-
-    # Basic validation
-    if not uhid or not first_name or not last_name:
-        flash('UHID, First Name, and Last Name are required.', 'danger')
-        return redirect(url_for('dashboard'))
-
-    try:
-        # Check if MRN already exists
-        cursor.execute("SELECT COUNT(*) FROM patients WHERE uhid = %s", (uhid,))
-        if cursor.fetchone()[0] > 0:
-            flash(f'A patient with UHID {uhid} already exists.', 'warning')
+        uhid = request.form.get('uhid')
+        first_name = request.form.get('first_name')
+        last_name = request.form.get('last_name')
+        dob = request.form.get('dob')
+        gender = request.form.get('gender')
+        address = request.form.get('address')
+        phone = request.form.get('phone')
+        email = request.form.get('email')
+
+        # Basic validation
+        if not uhid or not first_name or not last_name:
+            flash('UHID, First Name, and Last Name are required.', 'danger')
             return redirect(url_for('dashboard'))
 
-        cursor.execute(
-            """INSERT INTO patients (uhid, first_name, last_name, dob, gender, address, phone, email)
-               VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id""",
-            (uhid, first_name, last_name, dob, gender, address, phone, email)
-        )
-        patient_id = cursor.fetchone()[0]
-        conn.commit()
-
-        # Get the ID of the newly created patient
-        cursor.execute("SELECT uhid FROM patients WHERE uhid = %s", (uhid,))
-        uhid = cursor.fetchone()[0]
-
-        # Log the action in edit history
-        cursor.execute(
-            """INSERT INTO patient_edit_history (patient_id, uhid, editor_id, field_name, new_value, edited_at)
-               VALUES (%s, %s, %s, %s, %s, NOW())""",
-            (patient_id, uhid, session['user_id'], 'new_patient_added', f"New patient added: {first_name} {last_name}",)
-        )
-        conn.commit()
-
-        flash('Patient added successfully!', 'success')
-    except psycopg2.Error as e:
-        conn.rollback()
-        flash(f'Error adding patient: {str(e)}', 'danger')
-    finally:
-        cursor.close()
-        conn.close()
+        try:
+            # Check if MRN already exists
+            cursor.execute("SELECT COUNT(*) FROM patients WHERE uhid = %s", (uhid,))
+            if cursor.fetchone()[0] > 0:
+                flash(f'A patient with UHID {uhid} already exists.', 'warning')
+                return redirect(url_for('dashboard'))
+
+            cursor.execute(
+                """INSERT INTO patients (uhid, first_name, last_name, dob, gender, address, phone, email)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id""",
+                (uhid, first_name, last_name, dob, gender, address, phone, email)
+            )
+            patient_id = cursor.fetchone()[0]
+            add_patient_to_rollups(cursor, patient_id)
+            conn.commit()
+            analytics_cache.clear()
+
+            # Log the action in edit history
+            log_edit(patient_id, uhid, session['user_id'], 'new_patient_added',
+                     new_value=f"New patient added: {first_name} {last_name}")
+
+            flash('Patient added successfully!', 'success')
+        except psycopg2.Error as e:
+            conn.rollback()
+            flash(f'Error adding patient: {str(e)}', 'danger')
+        finally:
+            cursor.close()
 
     return redirect(url_for('dashboard'))
 
@@ -1088,46 +1006,39 @@ def create_user():
         role = request.form['role']
         hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
 
-        conn = get_db_connection()
+        with db_connection() as conn:
+            if conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        "INSERT INTO users (username, password_hash, role) VALUES (%s, %s, %s)",
+                        (username, hashed_password, role)
+                    )
+                    # Audit log for user creation, committed together with the user
+                    log_action(session['user_id'], 'user_creation', f"Created user: {username} ({role})", cursor=cursor)
+                    conn.commit()
+                    flash(f"User '{username}' ({role}) created successfully!", "success")
+                except psycopg2.IntegrityError:
+                    flash("Username already exists. Please choose a different one.", "danger")
+                    conn.rollback()
+                except Exception as e:
+                    flash(f"Error creating user: {e}", "danger")
+                    conn.rollback()
+                finally:
+                    cursor.close()
+    
+    # Fetch all users to display in the admin panel
+    all_users = []
+    with db_connection() as conn:
         if conn:
             cursor = conn.cursor()
             try:
-                cursor.execute(
-                    "INSERT INTO users (username, password_hash, role) VALUES (%s, %s, %s)",
-                    (username, hashed_password, role)
-                )
-                conn.commit()
-                flash(f"User '{username}' ({role}) created successfully!", "success")
-                # Audit log for user creation - Using audit_logs table
-                cursor.execute(
-                    """INSERT INTO audit_logs (user_id, action, details)
-                       VALUES (%s, %s, %s)""",
-                    (session['user_id'], 'user_creation', f"Created user: {username} ({role})")
-                )
-                conn.commit()
-            except psycopg2.IntegrityError:
-                flash("Username already exists. Please choose a different one.", "danger")
-                conn.rollback()
+                cursor.execute("SELECT id, username, role, created_at FROM users ORDER BY created_at DESC")
+                all_users = cursor.fetchall()
             except Exception as e:
-                flash(f"Error creating user: {e}", "danger")
-                conn.rollback()
+                flash(f"Error fetching users: {e}", "danger")
             finally:
                 cursor.close()
-                conn.close()
-    
-    # Fetch all users to display in the admin panel
-    all_users = []
-    conn = get_db_connection()
-    if conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT id, username, role, created_at FROM users ORDER BY created_at DESC")
-            all_users = cursor.fetchall()
-        except Exception as e:
-            flash(f"Error fetching users: {e}", "danger")
-        finally:
-            cursor.close()
-            conn.close()
     
     return render_template('admin_panel.html', username=session['username'], users=all_users)
 
@@ -1136,198 +1047,134 @@ def create_user():
 @role_required('admin')
 def delete_user(user_id):
     """Delete a user from the system."""
-    conn = get_db_connection()
-    if conn:
-        cursor = conn.cursor()
-        try:
-            # First check if user exists and is not admin
-            cursor.execute("SELECT username, role FROM users WHERE id = %s", (user_id,))
-            user = cursor.fetchone()
+    with db_connection() as conn:
+        if conn:
+            cursor = conn.cursor()
+            try:
+                # First check if user exists and is not admin
+                cursor.execute("SELECT username, role FROM users WHERE id = %s", (user_id,))
+                user = cursor.fetchone()
             
-            if not user:
-                flash("User not found.", "danger")
-            elif user[1] == 'admin':
-                flash("Cannot delete admin user.", "danger")
-            else:
-                username = user[0]
-                cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
-                conn.commit()
-                flash(f"User '{username}' deleted successfully!", "success")
-                
-                # Audit log for user deletion
-                cursor.execute(
-                    """INSERT INTO audit_logs (user_id, action, details)
-                       VALUES (%s, %s, %s)""",
-                    (session['user_id'], 'user_deletion', f"Deleted user: {username}")
-                )
-                conn.commit()
-        except Exception as e:
-            flash(f"Error deleting user: {e}", "danger")
-            conn.rollback()
-        finally:
-            cursor.close()
-            conn.close()
+                if not user:
+                    flash("User not found.", "danger")
+                elif user[1] == 'admin':
+                    flash("Cannot delete admin user.", "danger")
+                else:
+                    username = user[0]
+                    cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+                    # Audit log for user deletion, committed together with the deletion
+                    log_action(session['user_id'], 'user_deletion', f"Deleted user: {username}", cursor=cursor)
+                    conn.commit()
+                    flash(f"User '{username}' deleted successfully!", "success")
+            except Exception as e:
+                flash(f"Error deleting user: {e}", "danger")
+                conn.rollback()
+            finally:
+                cursor.close()
     
     return redirect(url_for('create_user'))
 
+def _audit_log_filters():
+    """
+    Reads the audit log filters from the query string.
+    Returns (filters, where_clauses, query_params); filters echoes the raw
+    values back to the template, minus any date that failed to parse.
+    """
+    filters = {
+        'start_date': request.args.get('start_date') or '',
+        'end_date': request.args.get('end_date') or '',
+        'username': (request.args.get('username') or '').strip(),
+        'uhid': (request.args.get('uhid') or '').strip(),
+        'field_name': (request.args.get('field_name') or '').strip(),
+    }
+    start_date = end_date = None
+
+    if filters['start_date']:
+        try:
+            start_date = datetime.strptime(filters['start_date'], '%Y-%m-%dT%H:%M')
+        except ValueError:
+            flash("Invalid 'From' date format. Please use the calendar picker.", "danger")
+            filters['start_date'] = ''
+
+    if filters['end_date']:
+        try:
+            end_date = datetime.strptime(filters['end_date'], '%Y-%m-%dT%H:%M')
+        except ValueError:
+            flash("Invalid 'To' date format. Please use the calendar picker.", "danger")
+            filters['end_date'] = ''
+
+    where_clauses, query_params = build_audit_filters(
+        start_date, end_date, filters['username'], filters['uhid'], filters['field_name']
+    )
+    return filters, where_clauses, query_params
+
 @app.route('/admin/audit_logs')
 @login_required
 @role_required('admin')
 def audit_logs():
-    """Admin functionality to view audit logs with date and time filters."""
-    conn = get_db_connection()
+    """Admin functionality to view audit logs, one page at a time, with date, user, UHID and field filters."""
+    filters, where_clauses, query_params = _audit_log_filters()
+    limit = clamp_page_size(request.args.get('limit'), default=AUDIT_PAGE_SIZE, maximum=AUDIT_MAX_PAGE_SIZE)
+    after = decode_audit_cursor(request.args.get('after'))
+    before = decode_audit_cursor(request.args.get('before'))
     logs = []
-    start_date_str = request.args.get('start_date')
-    end_date_str = request.args.get('end_date')
-
-    if conn:
-        cursor = conn.cursor()
-        query_base = """
-            SELECT
-                peh.edited_at, u.username as editor_username,
-                COALESCE(p.uhid, 'System Event') as uhid,
-                COALESCE(p.first_name, '') as first_name,
-                COALESCE(p.last_name, '') as last_name,
-                peh.field_name, peh.old_value, peh.new_value
-            FROM patient_edit_history peh
-            LEFT JOIN users u ON peh.editor_id = u.id
-            LEFT JOIN patients p ON peh.uhid = p.uhid
-        """
-        where_clauses = []
-        query_params = []
+    next_url = prev_url = None
 
-        if start_date_str:
-            try:
-                start_date = datetime.strptime(start_date_str, '%Y-%m-%dT%H:%M')
-                where_clauses.append("peh.edited_at >= %s")
-                query_params.append(start_date)
-            except ValueError:
-                flash("Invalid 'From' date format. Please use the calendar picker.", "danger")
-                start_date_str = ''
-
-        if end_date_str:
+    with db_connection() as conn:
+        if conn:
+            cursor = conn.cursor()
             try:
-                end_date = datetime.strptime(end_date_str, '%Y-%m-%dT%H:%M')
-                where_clauses.append("peh.edited_at <= %s")
-                query_params.append(end_date)
-            except ValueError:
-                flash("Invalid 'To' date format. Please use the calendar picker.", "danger")
-                end_date_str = ''
-
-        final_query = query_base
-        if where_clauses:
-            final_query += " WHERE " + " AND ".join(where_clauses)
-        final_query += " ORDER BY peh.edited_at DESC"
-        print("Executing Query:")
-        print(final_query)
-        print("With Parameters:")
-        print(query_params)
-        try:
-            cursor.execute(final_query, query_params)
-            logs = cursor.fetchall()
-            print("Fetched Logs:")
-            print(logs)
-        except Exception as e:
-            flash(f"Error fetching audit logs: {e}", "danger")
-            print(f"Error fetching audit logs: {e}")
-            conn.rollback()
-        finally:
-            cursor.close()
-            conn.close()
-    else:
-        flash("Could not connect to database to fetch audit logs.", "error")
+                logs, next_cursor, prev_cursor = list_audit_logs_page(
+                    cursor, where_clauses, query_params, limit, after, before
+                )
+                # Keep the filters (but not the other cursor) on the paging links
+                page_args = {k: v for k, v in filters.items() if v}
+                if next_cursor:
+                    next_url = url_for('audit_logs', show_logs='true', after=next_cursor, limit=limit, **page_args)
+                if prev_cursor:
+                    prev_url = url_for('audit_logs', show_logs='true', before=prev_cursor, limit=limit, **page_args)
+            except Exception as e:
+                flash(f"Error fetching audit logs: {e}", "danger")
+                print(f"Error fetching audit logs: {e}")
+                conn.rollback()
+            finally:
+                cursor.close()
+        else:
+            flash("Could not connect to database to fetch audit logs.", "error")
 
     return render_template('admin_panel.html', username=session['username'], audit_logs=logs,
-                           start_date=start_date_str, end_date=end_date_str, show_audit_logs_section=True)
+                           start_date=filters['start_date'], end_date=filters['end_date'],
+                           filter_username=filters['username'], filter_uhid=filters['uhid'],
+                           filter_field_name=filters['field_name'],
+                           next_url=next_url, prev_url=prev_url, show_audit_logs_section=True)
 
 @app.route('/admin/audit_logs/download')
 @login_required
 @role_required('admin')
 def download_audit_logs():
-    """Admin functionality to download audit logs as CSV with date and time filters."""
-    conn = get_db_connection()
-    logs = []
-    start_date_str = request.args.get('start_date')
-    end_date_str = request.args.get('end_date')
-
-    if conn:
-        cursor = conn.cursor()
-        query_base = """
-            SELECT
-                peh.edited_at, u.username as editor_username,
-                COALESCE(p.uhid, 'System Event') as uhid,
-                COALESCE(p.first_name, '') as first_name,
-                COALESCE(p.last_name, '') as last_name,
-                peh.field_name, peh.old_value, peh.new_value
-            FROM patient_edit_history peh
-            LEFT JOIN users u ON peh.editor_id = u.id
-            LEFT JOIN patients p ON peh.uhid = p.uhid
-        """
-        where_clauses = []
-        query_params = []
-
-        if start_date_str:
-            try:
-                start_date = datetime.strptime(start_date_str, '%Y-%m-%dT%H:%M')
-                where_clauses.append("peh.edited_at >= %s")
-                query_params.append(start_date)
-            except ValueError:
-                flash("Invalid 'From' date format. Please use the calendar picker.", "danger")
-                start_date_str = ''
-
-        if end_date_str:
-            try:
-                end_date = datetime.strptime(end_date_str, '%Y-%m-%dT%H:%M')
-                where_clauses.append("peh.edited_at <= %s")
-                query_params.append(end_date)
-            except ValueError:
-                flash("Invalid 'To' date format. Please use the calendar picker.", "danger")
-                end_date_str = ''
-
-        final_query = query_base
-        if where_clauses:
-            final_query += " WHERE " + " AND ".join(where_clauses)
-        final_query += " ORDER BY peh.edited_at DESC"
+    """
+    Admin functionality to download audit logs as CSV with the same filters as the viewer.
+    Rows are streamed in chunks; pass compress=gzip for a .csv.gz download.
+    """
+    _, where_clauses, query_params = _audit_log_filters()
+    compress = request.args.get('compress') == 'gzip'
 
-        try:
-            cursor.execute(final_query, query_params)
-            logs = cursor.fetchall()
-        except Exception as e:
-            flash(f"Error fetching audit logs: {e}", "danger")
-            conn.rollback()
-        finally:
-            cursor.close()
-            conn.close()
-    else:
+    # The connection stays checked out while the body streams and goes back
+    # to the pool when the response is closed, including on client disconnect.
+    conn = get_db_connection()
+    if not conn:
         flash("Could not connect to database to fetch audit logs.", "error")
         return redirect(url_for('audit_logs', show_logs='true'))
 
-    # Create CSV content
-    import csv
-    from io import StringIO
-    
-    output = StringIO()
-    writer = csv.writer(output)
-    
-    # Write header
-    writer.writerow(['Timestamp', 'Editor', 'Patient UHID', 'First Name', 'Last Name', 'Field', 'Old Value', 'New Value'])
-    
-    # Write data
-    for log in logs:
-        writer.writerow(log)
-    
-    # Prepare response
-    output.seek(0)
-    
-    # Create filename with timestamp
-    from datetime import datetime
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    filename = f"audit_logs_{timestamp}.csv"
-    
-    response = make_response(output.getvalue())
+    filename = f"audit_logs_{timestamp}.csv" + ('.gz' if compress else '')
+
+    response = Response(
+        stream_audit_csv(conn, where_clauses, query_params, compress=compress),
+        mimetype='application/gzip' if compress else 'text/csv'
+    )
+    response.call_on_close(conn.close)
     response.headers['Content-Disposition'] = f'attachment; filename={filename}'
-    response.headers['Content-type'] = 'text/csv'
-    
     return response
 
 @app.route('/patient/search', methods=['GET', 'POST'])
@@ -1339,45 +1186,83 @@ def search_patient():
         return redirect(url_for('dashboard'))
 
     patients = []
+    next_url = prev_url = None
     # Handle both GET and POST methods
     if request.method == 'POST':
         search_query = request.form.get('search_query', '')
     else:
         search_query = request.args.get('search_query', '')
     
-    conn = get_db_connection()
-    if not conn:
-        flash("Database connection failed.", "error")
-        return render_template('dashboard.html', patients=patients, search_query=search_query, role=session['user_role'])
+    with db_connection() as conn:
+        if not conn:
+            flash("Database connection failed.", "error")
+            return render_template('dashboard.html', patients=patients, search_query=search_query, role=session['user_role'])
     
-    cursor = conn.cursor()
-    try:
-        if search_query:
-            search_pattern = f"%{search_query}%"
-            cursor.execute(
-                """SELECT uhid, first_name, last_name, dob, gender FROM patients
-                   WHERE uhid ILIKE %s OR first_name ILIKE %s OR last_name ILIKE %s
-                   ORDER BY last_name, first_name""",
-                (search_pattern, search_pattern, search_pattern)
-            )
-            patients = cursor.fetchall()
-            if not patients:
-                flash(f"No patients found for '{search_query}'.", "info")
-        else:
-            cursor.execute(
-                """SELECT uhid, first_name, last_name, dob, gender FROM patients
-                   ORDER BY last_name, first_name"""
-            )
-            patients = cursor.fetchall()
-    except Exception as e:
-        flash(f"Error searching patients: {e}", "danger")
-    finally:
-        cursor.close()
-        conn.close()
-
-    return render_template('dashboard.html', patients=patients, search_query=search_query, role=session['user_role'])
-
-@app.route('/patient/<string:uhid>', methods=['GET', 'POST'])
+        cursor = conn.cursor()
+        try:
+            if search_query:
+                after = decode_search_cursor(request.args.get('cursor'))
+                patients, next_cursor = search_patients(cursor, search_query, SEARCH_PAGE_SIZE, after)
+                if next_cursor:
+                    next_url = url_for('search_patient', search_query=search_query, cursor=next_cursor)
+                if not patients:
+                    flash(f"No patients found for '{search_query}'.", "info")
+            else:
+                limit = clamp_page_size(request.args.get('limit'))
+                patients, next_cursor, prev_cursor = list_patients_page(
+                    cursor, limit,
+                    decode_directory_cursor(request.args.get('after')),
+                    decode_directory_cursor(request.args.get('before')))
+                if next_cursor:
+                    next_url = url_for('dashboard', after=next_cursor, limit=limit)
+                if prev_cursor:
+                    prev_url = url_for('dashboard', before=prev_cursor, limit=limit)
+        except Exception as e:
+            flash(f"Error searching patients: {e}", "danger")
+        finally:
+            cursor.close()
+
+    return render_template('dashboard.html', patients=patients, search_query=search_query, role=session['user_role'],
+                           next_url=next_url, prev_url=prev_url)
+
+@app.route('/api/patients/search')
+@login_required
+def patient_search_api():
+    """Type-ahead patient search. Returns one ranked page plus a cursor for the next."""
+    if session['user_role'] == 'admin':
+        return jsonify({"error": "Admin users do not have access to patient records."}), 403
+
+    query = request.args.get('q', '')
+    limit = clamp_page_size(request.args.get('limit'), default=SEARCH_PAGE_SIZE)
+    after = decode_search_cursor(request.args.get('cursor'))
+
+    with db_connection() as conn:
+        if not conn:
+            return jsonify({"error": "Database connection failed."}), 500
+        cursor = conn.cursor()
+        try:
+            rows, next_cursor = search_patients(cursor, query, limit, after)
+        except psycopg2.Error as e:
+            return jsonify({"error": str(e)}), 500
+        finally:
+            cursor.close()
+
+    return jsonify({
+        "results": [
+            {
+                "uhid": uhid,
+                "first_name": first_name,
+                "last_name": last_name,
+                "dob": safe_strftime(dob),
+                "gender": gender,
+                "score": float(rank) if rank is not None else None,
+            }
+            for uhid, first_name, last_name, dob, gender, rank in rows
+        ],
+        "next_cursor": next_cursor,
+    })
+
+@app.route('/patient/<string:uhid>', methods=['GET', 'POST'])
 @login_required
 def view_patient(uhid):
     """View and edit patient details, medical records, and history."""
@@ -1385,179 +1270,178 @@ def view_patient(uhid):
         flash("Access denied. Admin users do not have access to patient records.", "danger")
         return redirect(url_for('dashboard'))
 
-    conn = get_db_connection()
-    if not conn:
-        flash("Database connection failed.", "error")
-        return redirect(url_for('dashboard'))
+    with db_connection() as conn:
+        if not conn:
+            flash("Database connection failed.", "error")
+            return redirect(url_for('dashboard'))
     
-    patient = None
-    medical_records = []
-    today_date = datetime.now().date().strftime('%Y-%m-%d')
+        patient = None
+        medical_records = []
+        today_date = datetime.now().date().strftime('%Y-%m-%d')
     
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-    try:
-        # First, get the patient's demographic information
-        cursor.execute("SELECT * FROM patients WHERE uhid = %s", (uhid,))
-        patient = cursor.fetchone()
+        try:
+            # First, get the patient's demographic information
+            cursor.execute("SELECT * FROM patients WHERE uhid = %s", (uhid,))
+            patient = cursor.fetchone()
 
-        if not patient:
-            flash("Patient not found.", "danger")
-            return redirect(url_for('dashboard'))
+            if not patient:
+                flash("Patient not found.", "danger")
+                return redirect(url_for('dashboard'))
 
        
-        # Then, use the correct 'uhid' column to query for medical records
-        cursor.execute(
-            """SELECT uhid, visit_date, diagnosis, treatment, test_results, created_by, created_at, updated_at
-               FROM patient_medical_records WHERE uhid = %s ORDER BY visit_date DESC""",
-            (uhid,)
-        )
-        raw_medical_records = cursor.fetchall()
-
-        # Process medical records to handle JSON data
-        for record_row in raw_medical_records:
-            record_list = list(record_row)
-            test_results_from_db = record_list[4]
-            # Safely process test results, assuming they might be a string or dict
-            processed_test_results = test_results_from_db if isinstance(test_results_from_db, dict) else {}
-            record_list[4] = processed_test_results
-            medical_records.append(tuple(record_list))
+            # Then, use the correct 'uhid' column to query for medical records
+            cursor.execute(
+                """SELECT uhid, visit_date, diagnosis, treatment, test_results, created_by, created_at, updated_at
+                   FROM patient_medical_records WHERE uhid = %s ORDER BY visit_date DESC""",
+                (uhid,)
+            )
+            raw_medical_records = cursor.fetchall()
+
+            # Process medical records to handle JSON data
+            for record_row in raw_medical_records:
+                record_list = list(record_row)
+                test_results_from_db = record_list[4]
+                # Safely process test results, assuming they might be a string or dict
+                processed_test_results = test_results_from_db if isinstance(test_results_from_db, dict) else {}
+                record_list[4] = processed_test_results
+                medical_records.append(tuple(record_list))
             
-        # Handle POST requests for updating patient details or adding medical records
-        if request.method == 'POST':
-            if session['user_role'] not in ['doctor', 'nurse']:
-                flash("Access denied. Only doctors can add medical records.", "danger")
-                return redirect(url_for('view_patient', uhid=uhid))
+            # Handle POST requests for updating patient details or adding medical records
+            if request.method == 'POST':
+                if session['user_role'] not in ['doctor', 'nurse']:
+                    flash("Access denied. Only doctors can add medical records.", "danger")
+                    return redirect(url_for('view_patient', uhid=uhid))
             
-            # Logic for adding a new medical record
-            is_medical_record_form = 'diagnosis' in request.form and 'treatment' in request.form
-
-            if is_medical_record_form:
-                visit_date = request.form['visit_date']
-                diagnosis = request.form['diagnosis']
-                treatment = request.form['treatment']
-
-                # Debug what we're receiving
-                print("=== MEDICAL RECORD FORM DATA ===")
-                print("All form fields:", list(request.form.keys()))
-                print("test_results received:", 'test_results' in request.form)
-                print("test_results value:", request.form.get('test_results'))
+                # Logic for adding a new medical record
+                is_medical_record_form = 'diagnosis' in request.form and 'treatment' in request.form
+
+                if is_medical_record_form:
+                    visit_date = request.form['visit_date']
+                    diagnosis = request.form['diagnosis']
+                    treatment = request.form['treatment']
+
+                    # Debug what we're receiving
+                    print("=== MEDICAL RECORD FORM DATA ===")
+                    print("All form fields:", list(request.form.keys()))
+                    print("test_results received:", 'test_results' in request.form)
+                    print("test_results value:", request.form.get('test_results'))
     
                 
-                # Handling eye drop, medication, and surgery data
-                # Use hidden JSON (from JS) as source of truth
-                test_results_json = request.form.get('test_results', '{}')
-                print("Raw test_results_json:", test_results_json)
-                try:
-                    if test_results_json and test_results_json != '{}':
-                        test_results_data = json.loads(test_results_json)
-                    else:
+                    # Handling eye drop, medication, and surgery data
+                    # Use hidden JSON (from JS) as source of truth
+                    test_results_json = request.form.get('test_results', '{}')
+                    print("Raw test_results_json:", test_results_json)
+                    try:
+                        if test_results_json and test_results_json != '{}':
+                            test_results_data = json.loads(test_results_json)
+                        else:
+                            test_results_data = {}
+                            print("WARNING: test_results is empty or missing!")
+                    except Exception as e:
+                        print("Error parsing test_results:", e)
+                        print("Problematic JSON:", test_results_json)
                         test_results_data = {}
-                        print("WARNING: test_results is empty or missing!")
-                except Exception as e:
-                    print("Error parsing test_results:", e)
-                    print("Problematic JSON:", test_results_json)
-                    test_results_data = {}
 
-                print("Final test_results_data:", test_results_data)
+                    print("Final test_results_data:", test_results_data)
     
-# Merge DR risk separately if submitted
-                risk_category = request.form.get('risk_category')
-                risk_score = request.form.get('risk_score')
-                if risk_category or risk_score:
-                    test_results_data['dr_risk_assessment'] = {
-                        'risk_category': risk_category,
-                        'risk_score': risk_score
-                    }
+    # Merge DR risk separately if submitted
+                    risk_category = request.form.get('risk_category')
+                    risk_score = request.form.get('risk_score')
+                    if risk_category or risk_score:
+                        test_results_data['dr_risk_assessment'] = {
+                            'risk_category': risk_category,
+                            'risk_score': risk_score
+                        }
 
 
                 
-                cursor.execute(
-                    """INSERT INTO patient_medical_records (patient_id, uhid, visit_date, diagnosis, treatment, test_results, created_by, created_at, updated_at)
-                       VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), NOW())""",
-                    (patient['id'], uhid, visit_date, diagnosis, treatment,  json.dumps(test_results_data), session['user_id'])
-                )
-                
-                # Audit Log for medical record creation
-                cursor.execute(
-                    """INSERT INTO patient_edit_history (patient_id, uhid, editor_id, field_name, new_value, edited_at)
-                       VALUES (%s, %s, %s, %s, %s, NOW())""",
-                    (patient['id'], uhid, session['user_id'], 'medical_record_created', f"New record for visit date: {visit_date}",)
-                )
-                print("Raw test_results:", request.form.get('test_results'))
-                print("Type:", type(request.form.get('test_results')))
-
-                conn.commit()
-                flash("Medical record added successfully!", "success")
-                return redirect(url_for('view_patient', uhid=uhid))
+                    cursor.execute(
+                        """INSERT INTO patient_medical_records (patient_id, uhid, visit_date, diagnosis, treatment, test_results, created_by, created_at, updated_at)
+                           VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), NOW()) RETURNING id""",
+                        (patient['id'], uhid, visit_date, diagnosis, treatment,  json.dumps(test_results_data), session['user_id'])
+                    )
+                    add_record_to_rollups(cursor, cursor.fetchone()[0])
+                    print("Raw test_results:", request.form.get('test_results'))
+                    print("Type:", type(request.form.get('test_results')))
+
+                    conn.commit()
+                    analytics_cache.clear()
+
+                    # Audit Log for medical record creation
+                    log_edit(patient['id'], uhid, session['user_id'], 'medical_record_created',
+                             new_value=f"New record for visit date: {visit_date}")
+                    flash("Medical record added successfully!", "success")
+                    return redirect(url_for('view_patient', uhid=uhid))
             
-            # Logic for updating patient details (demographics)
-            else:
-                updated_fields_for_db = {}
-                original_patient = {
-                    "uhid": patient['uhid'], 
-                    "first_name": patient['first_name'], 
-                    "last_name": patient['last_name'],
-                    "dob": patient['dob'], 
-                    "gender": patient['gender'], 
-                    "address": patient['address'],
-                    "phone": patient['phone'], 
-                    "email": patient['email']
-                }
+                # Logic for updating patient details (demographics)
+                else:
+                    updated_fields_for_db = {}
+                    original_patient = {
+                        "uhid": patient['uhid'], 
+                        "first_name": patient['first_name'], 
+                        "last_name": patient['last_name'],
+                        "dob": patient['dob'], 
+                        "gender": patient['gender'], 
+                        "address": patient['address'],
+                        "phone": patient['phone'], 
+                        "email": patient['email']
+                    }
                 
-                # Collect updated fields for audit trail
-                for field in original_patient:
-                    new_value = request.form.get(field)
-                    old_value = original_patient[field]
-                    if field == 'dob':
-                        # Safely handle isoformat if it's a date object
-                        old_value = old_value.isoformat() if hasattr(old_value, 'isoformat') else str(old_value) if old_value else ''
-                        new_value = new_value.strip() if new_value is not None else ''
+                    # Collect updated fields for audit trail
+                    for field in original_patient:
+                        new_value = request.form.get(field)
+                        old_value = original_patient[field]
+                        if field == 'dob':
+                            # Safely handle isoformat if it's a date object
+                            old_value = old_value.isoformat() if hasattr(old_value, 'isoformat') else str(old_value) if old_value else ''
+                            new_value = new_value.strip() if new_value is not None else ''
                     
-                    if str(new_value) != str(old_value):
-                        updated_fields_for_db[field] = (old_value, new_value)
+                        if str(new_value) != str(old_value):
+                            updated_fields_for_db[field] = (old_value, new_value)
                 
-                if updated_fields_for_db:
-                    # Construct dynamic UPDATE query
-                    update_query_parts = []
-                    update_values = []
-                    for field, (old_val, new_val) in updated_fields_for_db.items():
-                        update_query_parts.append(f"{field} = %s")
-                        update_values.append(new_val)
-                    
-                    update_values.append(uhid)
-                    final_update_query = f"UPDATE patients SET {', '.join(update_query_parts)}, updated_at = NOW() WHERE uhid = %s"
-
-                    try:
-                        cursor.execute(final_update_query, update_values)
-                        conn.commit()
-                        flash("Patient details updated successfully!", "success")
-
-                        # Audit Log for patient details update
+                    if updated_fields_for_db:
+                        # Construct dynamic UPDATE query
+                        update_query_parts = []
+                        update_values = []
                         for field, (old_val, new_val) in updated_fields_for_db.items():
-                            cursor.execute(
-                                """INSERT INTO patient_edit_history (patient_id, uhid, editor_id, field_name, old_value, new_value, edited_at)
-                                   VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
-                                (patient['id'], uhid, session['user_id'], field, old_val, new_val)
-                            )
-                        conn.commit()
-                    except Exception as e:
-                        flash(f"Error updating patient details: {e}", "danger")
-                        conn.rollback()
-                else:
-                    flash("No changes detected to update patient details.", "info")
+                            update_query_parts.append(f"{field} = %s")
+                            update_values.append(new_val)
+                    
+                        update_values.append(uhid)
+                        final_update_query = f"UPDATE patients SET {', '.join(update_query_parts)}, updated_at = NOW() WHERE uhid = %s"
+
+                        demographics_changed = 'dob' in updated_fields_for_db or 'gender' in updated_fields_for_db
+                        try:
+                            if demographics_changed:
+                                remove_patient_from_rollups(cursor, patient['id'])
+                            cursor.execute(final_update_query, update_values)
+                            if demographics_changed:
+                                add_patient_to_rollups(cursor, patient['id'])
+                            conn.commit()
+                            analytics_cache.clear()
+                            flash("Patient details updated successfully!", "success")
+
+                            # Audit Log for patient details update
+                            for field, (old_val, new_val) in updated_fields_for_db.items():
+                                log_edit(patient['id'], uhid, session['user_id'], field, old_val, new_val)
+                        except Exception as e:
+                            flash(f"Error updating patient details: {e}", "danger")
+                            conn.rollback()
+                    else:
+                        flash("No changes detected to update patient details.", "info")
             
-            return redirect(url_for('view_patient', uhid=uhid))
+                return redirect(url_for('view_patient', uhid=uhid))
 
-    except Exception as e:
-        flash(f"Error viewing patient: {e}", "danger")
-        if conn:
-            conn.rollback()
-        return redirect(url_for('dashboard'))
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
+        except Exception as e:
+            flash(f"Error viewing patient: {e}", "danger")
+            if conn:
+                conn.rollback()
+            return redirect(url_for('dashboard'))
+        finally:
+            if conn:
+                cursor.close()
 
     # Create the patient dictionary for the template using column names
     patient_dict = {
@@ -1582,278 +1466,278 @@ def view_patient(uhid):
 @login_required
 @role_required('doctor')
 def add_medical_record(uhid):
-    conn = get_db_connection()
-    if not conn:
-        flash("Database connection error.", "danger")
-        return redirect(url_for('dashboard'))
-
-    cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    try:
-        # Get patient_id
-        cursor.execute("SELECT id, uhid FROM patients WHERE uhid = %s", (uhid,))
-        patient = cursor.fetchone()
-        if not patient:
-            flash("Patient not found.", "danger")
+    with db_connection() as conn:
+        if not conn:
+            flash("Database connection error.", "danger")
             return redirect(url_for('dashboard'))
-        patient_id = patient['id']
 
-        uhid = request.form.get('uhid')
-        visit_date = request.form['visit_date']
-        diagnosis = request.form['diagnosis']
-        treatment = request.form['treatment']
-
-        # --- 1. Map Clinical Measurements (Ensure Keys Match CSV) ---
-        CLINICAL_FIELD_MAP = {
-            'va_od': 'VA_OD', 'va_os': 'VA_OS', 
-            'va_od_corrected': 'VA_OD_with_correction', 'va_os_corrected': 'VA_OS_with_correction',
-            'iop_od': 'IOP_OD', 'iop_os': 'IOP_OS', 
-            'ref_od_sph': 'Refraction_OD_Sph', 'ref_od_cyl': 'Refraction_OD_Cyl', 'ref_od_ax': 'Refraction_OD_Ax', 
-            'ref_os_sph': 'Refraction_OS_Sph', 'ref_os_cyl': 'Refraction_OS_Cyl', 'ref_os_ax': 'Refraction_OS_Ax', 
-            'sle_od_cornea': 'SLE_OD_Cornea', 'sle_os_cornea': 'SLE_OS_Cornea', 
-            'sle_od_lens': 'SLE_OD_Lens', 'sle_os_lens': 'SLE_OS_Lens',
-            'fundus_od': 'Fundus_OD', 'fundus_os': 'Fundus_OS'
-        }
+        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        try:
+            # Get patient_id
+            cursor.execute("SELECT id, uhid FROM patients WHERE uhid = %s", (uhid,))
+            patient = cursor.fetchone()
+            if not patient:
+                flash("Patient not found.", "danger")
+                return redirect(url_for('dashboard'))
+            patient_id = patient['id']
+
+            uhid = request.form.get('uhid')
+            visit_date = request.form['visit_date']
+            diagnosis = request.form['diagnosis']
+            treatment = request.form['treatment']
+
+            # --- 1. Map Clinical Measurements (Ensure Keys Match CSV) ---
+            CLINICAL_FIELD_MAP = {
+                'va_od': 'VA_OD', 'va_os': 'VA_OS', 
+                'va_od_corrected': 'VA_OD_with_correction', 'va_os_corrected': 'VA_OS_with_correction',
+                'iop_od': 'IOP_OD', 'iop_os': 'IOP_OS', 
+                'ref_od_sph': 'Refraction_OD_Sph', 'ref_od_cyl': 'Refraction_OD_Cyl', 'ref_od_ax': 'Refraction_OD_Ax', 
+                'ref_os_sph': 'Refraction_OS_Sph', 'ref_os_cyl': 'Refraction_OS_Cyl', 'ref_os_ax': 'Refraction_OS_Ax', 
+                'sle_od_cornea': 'SLE_OD_Cornea', 'sle_os_cornea': 'SLE_OS_Cornea', 
+                'sle_od_lens': 'SLE_OD_Lens', 'sle_os_lens': 'SLE_OS_Lens',
+                'fundus_od': 'Fundus_OD', 'fundus_os': 'Fundus_OS'
+            }
         
-        final_test_results = {}
-        for form_key, json_key in CLINICAL_FIELD_MAP.items():
-            value = request.form.get(form_key)
-            if value and value.strip():
-                # Safety: Check for numeric fields and attempt conversion
-                try:
-                    is_numeric_field = any(x in form_key for x in ['iop_', 'ref_'])
+            final_test_results = {}
+            for form_key, json_key in CLINICAL_FIELD_MAP.items():
+                value = request.form.get(form_key)
+                if value and value.strip():
+                    # Safety: Check for numeric fields and attempt conversion
+                    try:
+                        is_numeric_field = any(x in form_key for x in ['iop_', 'ref_'])
                     
-                    if is_numeric_field:
-                        # Convert to int or float if possible, otherwise keep as string
-                        if '.' in value:
-                             final_test_results[json_key] = float(value.strip())
+                        if is_numeric_field:
+                            # Convert to int or float if possible, otherwise keep as string
+                            if '.' in value:
+                                 final_test_results[json_key] = float(value.strip())
+                            else:
+                                final_test_results[json_key] = int(value.strip())
                         else:
-                            final_test_results[json_key] = int(value.strip())
-                    else:
+                            final_test_results[json_key] = value.strip()
+                    except ValueError:
+                        # If conversion fails (e.g., 'VA_OD' is '20/20'), save as string.
                         final_test_results[json_key] = value.strip()
-                except ValueError:
-                    # If conversion fails (e.g., 'VA_OD' is '20/20'), save as string.
-                    final_test_results[json_key] = value.strip()
 
 
-        # --- 4. Final Serialization ---
-        test_results_json = json.dumps(final_test_results)
+            # --- 4. Final Serialization ---
+            test_results_json = json.dumps(final_test_results)
     
-        print(json.dumps(final_test_results, indent=2))
+            print(json.dumps(final_test_results, indent=2))
 
-        # --- 5. Database Insertion/Update ---
+            # --- 5. Database Insertion/Update ---
 
-        if uhid:
-            # Updating an existing record
-            cursor.execute(
-                """UPDATE patient_medical_records SET
-                   uhid=%s,
-                   visit_date = %s,
-                   diagnosis = %s,
-                   treatment = %s,
-                   test_results = %s,
-                   updated_at = NOW()
-                   WHERE uhid = %s""",
-                (uhid, visit_date, diagnosis, treatment, test_results_json, uhid)
-            )
-            flash("Medical record updated successfully!", "success")
-        else:
-            # Adding a new record
-            cursor.execute(
-                """INSERT INTO patient_medical_records (
-                   patient_id, uhid, visit_date, diagnosis, treatment, test_results, created_by, created_at, updated_at
-                   ) VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), NOW())""", 
-                (patient_id, uhid, visit_date, diagnosis, treatment, test_results_json, session['user_id'])
-            )
-            flash("Medical record added successfully!", "success")
+            if uhid:
+                # Updating an existing record
+                cursor.execute("SELECT id FROM patient_medical_records WHERE uhid = %s", (uhid,))
+                record_ids = [row['id'] for row in cursor.fetchall()]
+                for record_id in record_ids:
+                    remove_record_from_rollups(cursor, record_id)
+                cursor.execute(
+                    """UPDATE patient_medical_records SET
+                       uhid=%s,
+                       visit_date = %s,
+                       diagnosis = %s,
+                       treatment = %s,
+                       test_results = %s,
+                       updated_at = NOW()
+                       WHERE uhid = %s""",
+                    (uhid, visit_date, diagnosis, treatment, test_results_json, uhid)
+                )
+                for record_id in record_ids:
+                    add_record_to_rollups(cursor, record_id)
+                flash("Medical record updated successfully!", "success")
+            else:
+                # Adding a new record
+                cursor.execute(
+                    """INSERT INTO patient_medical_records (
+                       patient_id, uhid, visit_date, diagnosis, treatment, test_results, created_by, created_at, updated_at
+                       ) VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), NOW()) RETURNING id""",
+                    (patient_id, uhid, visit_date, diagnosis, treatment, test_results_json, session['user_id'])
+                )
+                add_record_to_rollups(cursor, cursor.fetchone()[0])
+                flash("Medical record added successfully!", "success")
 
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        # Print the error for debugging your Flask console
-        print(f"DATABASE ERROR: {e}")
-        flash(f"An error occurred while saving the record. Please check the server logs.", "danger")
-        return redirect(url_for('view_patient', uhid=uhid))
-    finally:
-        cursor.close()
-        conn.close()
+            conn.commit()
+            analytics_cache.clear()
+        except Exception as e:
+            conn.rollback()
+            # Print the error for debugging your Flask console
+            print(f"DATABASE ERROR: {e}")
+            flash(f"An error occurred while saving the record. Please check the server logs.", "danger")
+            return redirect(url_for('view_patient', uhid=uhid))
+        finally:
+            cursor.close()
 
     # 🚨 Start of FIX: Retrieve the internal patient_id (PK 'id') using the UHID ('mrn')
-    conn = get_db_connection()
-    if conn:
-        try:
-            cursor = conn.cursor()
+    with db_connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor()
         
-        # Query the patients table to get the internal ID (patient_id)
-            cursor.execute("SELECT uhid FROM patients WHERE uhid = %s", (uhid,))
-            patient_row = cursor.fetchone()
+            # Query the patients table to get the internal ID (patient_id)
+                cursor.execute("SELECT uhid FROM patients WHERE uhid = %s", (uhid,))
+                patient_row = cursor.fetchone()
         
-            if patient_row:
-                uhid = patient_row[0] # The internal ID is the first element
-                flash('Medical record added successfully!', 'success')
+                if patient_row:
+                    uhid = patient_row[0] # The internal ID is the first element
+                    flash('Medical record added successfully!', 'success')
             
-            # 🚨 MODIFIED REDIRECT: Pass both required parameters
-                return redirect(url_for('view_patient', uhid=uhid,))
-            else:
-                flash('Error: Patient not found for this UHID.', 'error')
-            # Redirect to a safe page if lookup fails (e.g., all patients list)
-                return redirect(url_for('view_all_patients')) 
+                # 🚨 MODIFIED REDIRECT: Pass both required parameters
+                    return redirect(url_for('view_patient', uhid=uhid,))
+                else:
+                    flash('Error: Patient not found for this UHID.', 'error')
+                # Redirect to a safe page if lookup fails (e.g., all patients list)
+                    return redirect(url_for('view_all_patients')) 
             
-        except Exception as e:
-            flash(f'An internal error occurred: {e}', 'error')
-            return redirect(url_for('view_all_patients')) 
-        finally:
-            if conn:
-                conn.close()    
+            except Exception as e:
+                flash(f'An internal error occurred: {e}', 'error')
+                return redirect(url_for('view_all_patients')) 
 
     return redirect(url_for('view_patient', uhid=uhid))
 
 @app.route('/view_medical_history/<uhid>', methods=['GET'])
 @login_required 
 def view_medical_history(uhid):
-    conn = None
-    cursor = None
-    try:
-        # Get DB connection
-        conn = get_db_connection()
-        if not conn:
-            flash("Database connection error.", "danger")
-            return redirect(url_for('dashboard')) 
+    with db_connection() as conn:
+        cursor = None
+        try:
+            if not conn:
+                flash("Database connection error.", "danger")
+                return redirect(url_for('dashboard')) 
 
-        # Use DictCursor for fetching data as dictionaries
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            # Use DictCursor for fetching data as dictionaries
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
-        # --- 1. Fetch Patient Data by UHID ---
-        cursor.execute(
-            "SELECT uhid, first_name, last_name, dob, gender, phone, email, address FROM patients WHERE uhid = %s", 
-            (uhid,)
-        )
-        patient_data = cursor.fetchone()
-
-        if not patient_data:
-            flash(f"Patient with UHID '{uhid}' not found.", "danger")
-            return redirect(url_for('dashboard'))
+            # --- 1. Fetch Patient Data by UHID ---
+            cursor.execute(
+                "SELECT uhid, first_name, last_name, dob, gender, phone, email, address FROM patients WHERE uhid = %s", 
+                (uhid,)
+            )
+            patient_data = cursor.fetchone()
+
+            if not patient_data:
+                flash(f"Patient with UHID '{uhid}' not found.", "danger")
+                return redirect(url_for('dashboard'))
         
-        # --- 2. Fetch Medical Records ---
-        cursor.execute(
-            """SELECT uhid, diagnosis, treatment, visit_date, test_results 
-                FROM patient_medical_records 
-                WHERE uhid = %s 
-                ORDER BY visit_date DESC""", 
-            (uhid,)
-        )
-        medical_records = cursor.fetchall()
+            # --- 2. Fetch Medical Records ---
+            cursor.execute(
+                """SELECT uhid, diagnosis, treatment, visit_date, test_results 
+                    FROM patient_medical_records 
+                    WHERE uhid = %s 
+                    ORDER BY visit_date DESC""", 
+                (uhid,)
+            )
+            medical_records = cursor.fetchall()
         
-        # --- 3. Fetch Prescriptions ---
-        cursor.execute(
-            """SELECT 
-                uhid, 
-                created_at, 
-                spectacle_lens,      
-                lens_type,               
-                medications, 
-                systemic_medication, 
-                surgery_recommendation, 
-                iol_notes, 
-                patient_instructions, 
-                follow_up_date 
-            FROM patient_prescriptions 
-            WHERE uhid = %s 
-            ORDER BY created_at DESC""", 
-            (uhid,)
-        )
-        prescriptions = cursor.fetchall()
+            # --- 3. Fetch Prescriptions ---
+            cursor.execute(
+                """SELECT 
+                    uhid, 
+                    created_at, 
+                    spectacle_lens,      
+                    lens_type,               
+                    medications, 
+                    systemic_medication, 
+                    surgery_recommendation, 
+                    iol_notes, 
+                    patient_instructions, 
+                    follow_up_date 
+                FROM patient_prescriptions 
+                WHERE uhid = %s 
+                ORDER BY created_at DESC""", 
+                (uhid,)
+            )
+            prescriptions = cursor.fetchall()
         
-        # --- 4. Process Records and Prescriptions with Detailed Debugging ---
-        medical_records_list = []
-        for row in medical_records:
-            record_dict = dict(row)
-            print(f"[DEBUG MEDICAL RECORD] {record_dict}")
-            medical_records_list.append(record_dict)
+            # --- 4. Process Records and Prescriptions with Detailed Debugging ---
+            medical_records_list = []
+            for row in medical_records:
+                record_dict = dict(row)
+                print(f"[DEBUG MEDICAL RECORD] {record_dict}")
+                medical_records_list.append(record_dict)
         
-        prescriptions_list = []
+            prescriptions_list = []
 
-        for row in prescriptions:
-            record = dict(row)
-            print(f"[DEBUG PRESCRIPTION RAW] {record}")
+            for row in prescriptions:
+                record = dict(row)
+                print(f"[DEBUG PRESCRIPTION RAW] {record}")
 
-            # --- SPECTACLE DATA ---
-            try:
-                raw_lens = record.pop('spectacle_lens', '{}')
-                print(f"[DEBUG SPECTACLE RAW] {raw_lens} (type: {type(raw_lens)})")
-                if isinstance(raw_lens, str):
-                    record['spectacle_data'] = json.loads(raw_lens)
-                else:
-                    record['spectacle_data'] = raw_lens
-                print(f"[DEBUG SPECTACLE PARSED] {record['spectacle_data']}")
-            except Exception as e:
-                print(f"[DEBUG] Error parsing spectacle_lens JSON: {e}")
-                record['spectacle_data'] = {}
+                # --- SPECTACLE DATA ---
+                try:
+                    raw_lens = record.pop('spectacle_lens', '{}')
+                    print(f"[DEBUG SPECTACLE RAW] {raw_lens} (type: {type(raw_lens)})")
+                    if isinstance(raw_lens, str):
+                        record['spectacle_data'] = json.loads(raw_lens)
+                    else:
+                        record['spectacle_data'] = raw_lens
+                    print(f"[DEBUG SPECTACLE PARSED] {record['spectacle_data']}")
+                except Exception as e:
+                    print(f"[DEBUG] Error parsing spectacle_lens JSON: {e}")
+                    record['spectacle_data'] = {}
 
-            # --- MEDICATIONS ---
-            try:
-                raw_meds = record.pop('medications', '[]')
-                print(f"[DEBUG MEDS RAW] {raw_meds} (type: {type(raw_meds)})")
-                if isinstance(raw_meds, str):
-                    med_list = json.loads(raw_meds)
-                else:
-                    med_list = raw_meds
-                print(f"[DEBUG MEDS PARSED] {med_list}")
-            except Exception as e:
-                print(f"[DEBUG] Error parsing medications JSON: {e}")
-                med_list = []
-
-            med_strings = []
-            for med in med_list:
-                name = med.get('name', 'N/A')
-                dose = med.get('dose', '')
-                freq = med.get('frequency', '')
-                eye = med.get('eye', '')
-                duration = med.get('duration_value', '')
-                unit = med.get('duration_unit', '')
-                med_string = f"{name} {dose} {freq} ({eye}) for {duration} {unit}".strip()
-                med_strings.append(med_string)
-                print(f"[DEBUG MEDICATION] {med_string}")
-
-            record['medications_text'] = ' | '.join(med_strings)
-            print(f"[DEBUG FINAL PRESCRIPTION] {record}")
-            prescriptions_list.append(record)
+                # --- MEDICATIONS ---
+                try:
+                    raw_meds = record.pop('medications', '[]')
+                    print(f"[DEBUG MEDS RAW] {raw_meds} (type: {type(raw_meds)})")
+                    if isinstance(raw_meds, str):
+                        med_list = json.loads(raw_meds)
+                    else:
+                        med_list = raw_meds
+                    print(f"[DEBUG MEDS PARSED] {med_list}")
+                except Exception as e:
+                    print(f"[DEBUG] Error parsing medications JSON: {e}")
+                    med_list = []
+
+                med_strings = []
+                for med in med_list:
+                    name = med.get('name', 'N/A')
+                    dose = med.get('dose', '')
+                    freq = med.get('frequency', '')
+                    eye = med.get('eye', '')
+                    duration = med.get('duration_value', '')
+                    unit = med.get('duration_unit', '')
+                    med_string = f"{name} {dose} {freq} ({eye}) for {duration} {unit}".strip()
+                    med_strings.append(med_string)
+                    print(f"[DEBUG MEDICATION] {med_string}")
+
+                record['medications_text'] = ' | '.join(med_strings)
+                print(f"[DEBUG FINAL PRESCRIPTION] {record}")
+                prescriptions_list.append(record)
         
-        # Get the user's role from the session
-        user_role = session.get('user_role')    
+            # Get the user's role from the session
+            user_role = session.get('user_role')    
         
-        # Prepare patient data for template
-        patient_dict = dict(patient_data)
-        patient_dict['name'] = f"{patient_dict.get('first_name', '')} {patient_dict.get('last_name', '')}".strip()
+            # Prepare patient data for template
+            patient_dict = dict(patient_data)
+            patient_dict['name'] = f"{patient_dict.get('first_name', '')} {patient_dict.get('last_name', '')}".strip()
         
-        print(f"[DEBUG SUMMARY] User role: {user_role}")
-        print(f"[DEBUG SUMMARY] Medical records found: {len(medical_records_list)}")
-        print(f"[DEBUG SUMMARY] Prescriptions found: {len(prescriptions_list)}")
-        print(f"[DEBUG SUMMARY] Patient data: {patient_dict}")
-
-        # Render the template with the fetched data
-        return render_template('view_medical_history.html', 
-                               patient=patient_dict, 
-                               medical_records=medical_records_list,
-                               prescriptions=prescriptions_list,
-                               role=user_role) 
+            print(f"[DEBUG SUMMARY] User role: {user_role}")
+            print(f"[DEBUG SUMMARY] Medical records found: {len(medical_records_list)}")
+            print(f"[DEBUG SUMMARY] Prescriptions found: {len(prescriptions_list)}")
+            print(f"[DEBUG SUMMARY] Patient data: {patient_dict}")
+
+            # Render the template with the fetched data
+            return render_template('view_medical_history.html', 
+                                   patient=patient_dict, 
+                                   medical_records=medical_records_list,
+                                   prescriptions=prescriptions_list,
+                                   role=user_role) 
 
-    except Exception as e:
-        flash(f"An error occurred while fetching history: {e}", "danger")
-        print(f"Error in view_medical_history: {e}")
-        import traceback
-        traceback.print_exc()
-        return redirect(url_for('dashboard')) 
-    finally:
-        # Cleanup connection resources
-        if cursor and not cursor.closed: 
-            cursor.close()
-        if conn: 
-            conn.close()
+        except Exception as e:
+            flash(f"An error occurred while fetching history: {e}", "danger")
+            print(f"Error in view_medical_history: {e}")
+            import traceback
+            traceback.print_exc()
+            return redirect(url_for('dashboard')) 
+        finally:
+            # Cleanup connection resources
+            if cursor and not cursor.closed: 
+                cursor.close()
 
 @app.route("/scan/<uhid>", methods=["GET", "POST"])
 def scan(uhid):
-    """Handles the form submission and renders the page."""
-    dicom_file, error = None, None
+    """Queues a scan request on POST; shows the request's progress with ?job=<job_id>."""
+    dicom_file, error, job = None, None, None
     if request.method == "POST":
         host = DEFAULT_HOST
         department = request.form.get("department", "Ophthamology")
@@ -1864,9 +1748,74 @@ def scan(uhid):
         if not all([uhid, scan_type, body_part]):
             error = "UHID, Scan Type, and Body Part are required fields."
         else:
-            dicom_file, error = perform_request(host, department, uhid, scan_type, body_part)
-
-    return render_template('scan.html', dicom_file=dicom_file, error=error)
+            # Submission and polling run in the job worker (python jobs.py worker)
+            try:
+                job_id = enqueue_scan_request(host, department, uhid, scan_type, body_part)
+                return redirect(url_for('scan', uhid=uhid, job=job_id))
+            except Exception as e:
+                print(f"❌ Could not queue scan request: {e}")
+                error = "Could not queue the scan request. Please try again."
+    elif request.args.get("job"):
+        job = get_job(request.args["job"])
+        if job is None:
+            error = "Scan request not found."
+        elif job['status'] == 'succeeded':
+            dicom_file = (job['result'] or {}).get('dicom_file')
+        elif job['status'] == 'failed':
+            error = job['error']
+
+    return render_template('scan.html', dicom_file=dicom_file, error=error, job=job)
+
+@app.route("/api/jobs/<job_id>")
+def job_status(job_id):
+    """Status of a background job (scan request, lab report)."""
+    try:
+        job = get_job(job_id)
+    except Exception as e:
+        return jsonify({'error': f'Error reading job: {str(e)}'}), 500
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    # The payload holds the request details (UHID etc.); the page only needs the outcome
+    job.pop('payload', None)
+    return jsonify(job)
+
+@app.route("/api/webhooks/lis", methods=["POST"])
+def lis_webhook():
+    """Order status callback from the LIS (see webhooks.py for the format and signing)."""
+    auth_error = webhook_authenticate(request.get_data(), request.headers)
+    if auth_error:
+        return jsonify({'error': auth_error[0]}), auth_error[1]
+    event = request.get_json(silent=True)
+    if not isinstance(event, dict):
+        return jsonify({'error': 'Invalid JSON data'}), 400
+    try:
+        summary = handle_lis_event(DEFAULT_HOST, event)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ LIS webhook failed: {e}")
+        return jsonify({'error': 'Could not process event'}), 500
+    if summary is None:
+        return jsonify({'error': 'Unknown order'}), 404
+    return jsonify(summary)
+
+@app.route("/api/webhooks/pacs", methods=["POST"])
+def pacs_webhook():
+    """Scan request callback from the PACS (see webhooks.py for the format and signing)."""
+    auth_error = webhook_authenticate(request.get_data(), request.headers)
+    if auth_error:
+        return jsonify({'error': auth_error[0]}), auth_error[1]
+    event = request.get_json(silent=True)
+    if not isinstance(event, dict):
+        return jsonify({'error': 'Invalid JSON data'}), 400
+    try:
+        summary = handle_pacs_event(event)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"❌ PACS webhook failed: {e}")
+        return jsonify({'error': 'Could not process event'}), 500
+    return jsonify(summary)
 
 @app.route("/test_login", methods=["GET", "POST"])
 def test_login():
@@ -1946,40 +1895,63 @@ def test_index():
 def check_order_status(order_id):
     """Check the status of an order."""
     try:
-        url = f"{DEFAULT_HOST.rstrip('/')}/api/orders/{order_id}"
-        resp = requests.get(url, headers={'X-API-Key': SHARED_API_KEY}, timeout=15)
+        status_code, order_data = get_order(DEFAULT_HOST, SHARED_API_KEY, order_id, timeout=15)
         
-        if resp.status_code == 200:
-            order_data = resp.json()
-            per_dept = order_data.get('perDepartment', [])
-            
-            # Check if any department has completed results
-            completed_depts = []
-            for dept in per_dept:
-                if dept.get('status') == 'completed':
-                    completed_depts.append({
-                        'department': dept.get('department'),
-                        'status': dept.get('status'),
-                        'results': dept.get('results', [])
-                    })
-            
-            return jsonify({
-                'orderId': order_id,
-                'status': 'completed' if completed_depts else 'in_progress',
-                'completedDepartments': completed_depts,
-                'allDepartments': per_dept
-            })
+        if status_code == 200:
+            return jsonify(order_status_summary(order_id, order_data))
         else:
-            return jsonify({'error': f'Failed to fetch order status: {resp.status_code}'}), 400
+            return jsonify({'error': f'Failed to fetch order status: {status_code}'}), 400
             
+    except CircuitOpenError as e:
+        # The LIS is down: answer at once instead of waiting for a timeout
+        return jsonify({'error': f'Lab system unavailable: {str(e)}', 'retryAfter': round(e.retry_after)}), 503
     except Exception as e:
         return jsonify({'error': f'Error checking status: {str(e)}'}), 500
 
+@app.route("/api/status/stream")
+def status_stream():
+    """Server-Sent Events for ?orders=ORD1,ORD2&jobs=<job_id> (see status_stream.py)."""
+    topics = [f"order:{o}" for o in request.args.get('orders', '').split(',') if o.strip()]
+    topics += [f"job:{j}" for j in request.args.get('jobs', '').split(',') if j.strip()]
+    if not topics:
+        return jsonify({'error': 'Pass orders= and/or jobs='}), 400
+    if len(topics) > SSE_MAX_TOPICS:
+        return jsonify({'error': f'At most {SSE_MAX_TOPICS} orders and jobs per stream'}), 400
+    try:
+        events, release = get_status_hub(DEFAULT_HOST).stream(list(dict.fromkeys(topics)),
+                                                               request.headers.get('Last-Event-ID'))
+    except StreamLimitReached:
+        return jsonify({'error': 'Too many open status streams; poll /api/status instead'}), 503, {'Retry-After': '30'}
+    response = Response(events, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Frees the stream slot even when the body is never iterated (HEAD, early disconnect)
+    response.call_on_close(release)
+    return response
+
 @app.route("/api/order/<order_id>")
 def api_get_order(order_id):
+    """Passes the LIS order document through unparsed; supports If-None-Match (see lab_status.py)."""
+    etag = order_not_modified(DEFAULT_HOST, order_id, request.if_none_match)
+    if etag:
+        return '', 304, {'ETag': etag}
     try:
-        r = requests.get(f"{DEFAULT_HOST.rstrip('/')}/api/orders/{order_id}", headers={'X-API-Key': SHARED_API_KEY}, timeout=20)
-        return (r.text, r.status_code, {"Content-Type": r.headers.get('Content-Type', 'application/json')})
+        upstream = open_order_stream(DEFAULT_HOST, SHARED_API_KEY, order_id,
+                                     if_none_match=request.headers.get('If-None-Match'),
+                                     accept_encoding=request.headers.get('Accept-Encoding'), timeout=20)
+        if upstream.status_code == 304:
+            upstream.close()
+            return '', 304, {k: v for k, v in upstream.headers.items() if k.lower() == 'etag'}
+        if upstream.status_code != 200:
+            upstream.close()
+            return jsonify({"error": f"Failed to fetch order: {upstream.status_code}"}), upstream.status_code
+        headers = {'Vary': 'Accept-Encoding'}
+        for name in ('Content-Length', 'Content-Encoding', 'ETag', 'Last-Modified'):
+            if name in upstream.headers:
+                headers[name] = upstream.headers[name]
+        return Response(iter_order_stream(upstream), headers=headers,
+                        content_type=upstream.headers.get('Content-Type', 'application/json'))
+    except CircuitOpenError as e:
+        return jsonify({"error": f"Lab system unavailable: {str(e)}", "retryAfter": round(e.retry_after)}), 503
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1993,16 +1965,7 @@ def view_results(order_id):
     current_department = session['department']
     
     # Check if the order exists in our history and belongs to the current department
-    hist = load_history()
-    order_exists = False
-    order_belongs_to_department = False
-    
-    for order in hist:
-        if order.get("orderId") == order_id:
-            order_exists = True
-            if order.get("department", "").lower() == current_department.lower():
-                order_belongs_to_department = True
-            break
+    order_exists, order_belongs_to_department = order_access(order_id, current_department)
     
     if not order_exists:
         error_page = f"""
@@ -2044,16 +2007,15 @@ def view_results(order_id):
         return error_page, 403
         
     try:
-        r = requests.get(f"{DEFAULT_HOST.rstrip('/')}/api/orders/{order_id}", headers={'X-API-Key': SHARED_API_KEY}, timeout=20)
-        if not r.ok:
+        status_code, data = get_order(DEFAULT_HOST, SHARED_API_KEY, order_id, timeout=20)
+        if status_code != 200:
             error_page = render_template_string("""
             <!DOCTYPE html><html><head><title>Results</title><script src=\"https://cdn.tailwindcss.com\"></script></head>
             <body class=\"bg-gray-100 p-8\"><div class=\"max-w-5xl mx-auto bg-white p-6 rounded shadow\">
             <h1 class=\"text-2xl font-semibold mb-4\">Results</h1>
             <div class=\"text-red-600\">Failed to load results (status: {{status}})</div>
-            <a class=\"mt-4 inline-block text-blue-600\" href=\"/\">Back</a></div></body></html>""", status=r.status_code)
-            return error_page, r.status_code
-        data = r.json()
+            <a class=\"mt-4 inline-block text-blue-600\" href=\"/\">Back</a></div></body></html>""", status=status_code)
+            return error_page, status_code
         return render_template_string("""
 <!DOCTYPE html>
 <html>
@@ -2138,6 +2100,9 @@ def view_results(order_id):
         </body>
         </html>
         """, data=data)
+    except CircuitOpenError as e:
+        return render_template_string("""<!DOCTYPE html><html><body><pre>The lab system is not responding. Please try again in {{ seconds }} seconds.</pre></body></html>""",
+                                      seconds=round(e.retry_after)), 503
     except Exception as e:
         return render_template_string("""<!DOCTYPE html><html><body><pre>{{e}}</pre></body></html>""", e=str(e))
 
@@ -2151,16 +2116,7 @@ def serve_report(filename):
     current_department = session['department']
     
     # Check if the order exists in our history and belongs to the current department
-    hist = load_history()
-    order_exists = False
-    order_belongs_to_department = False
-    
-    for order in hist:
-        if order.get("orderId") == filename:
-            order_exists = True
-            if order.get("department", "").lower() == current_department.lower():
-                order_belongs_to_department = True
-            break
+    order_exists, order_belongs_to_department = order_access(filename, current_department)
     
     if not order_exists:
         error_page = f"""
@@ -2216,12 +2172,9 @@ You can check the status using the "Check Status" button.
 For any questions, please contact the laboratory department.
 """
     
-    # Create a temporary file
-    temp_file = os.path.join("downloads", f"order_{filename}.txt")
-    with open(temp_file, 'w') as f:
-        f.write(order_details)
-    
-    return send_from_directory("downloads", f"order_{filename}.txt", as_attachment=True)
+    # Generated per click; sent from memory rather than left behind in downloads/
+    return Response(order_details, mimetype='text/plain',
+                    headers={'Content-Disposition': f'attachment; filename=order_{filename}.txt'})
 
 @app.route("/history")
 def history_page():
@@ -2232,22 +2185,23 @@ def history_page():
     # Get the current department from session
     department = session.get("department")
     
-    # Load history filtered by department
-    hist = load_history(department)
-    # fetch status for each order (best-effort, non-blocking style)
-    statuses = {}
-    for h in hist[:20]:  # limit to last 20 for speed
-        try:
-            r = requests.get(f"{DEFAULT_HOST.rstrip('/')}/api/orders/{h['orderId']}", headers={'X-API-Key': SHARED_API_KEY}, timeout=5)
-            if r.ok:
-                j = r.json()
-                per = j.get('perDepartment', [])
-                any_completed = any(d.get('status') == 'completed' for d in per)
-                statuses[h['orderId']] = 'completed' if any_completed else 'in_progress'
-            else:
-                statuses[h['orderId']] = 'unknown'
-        except Exception:
-            statuses[h['orderId']] = 'unknown'
+    # Load the most recent orders for this department (?limit=, up to HISTORY_MAX_ORDERS)
+    limit = clamp_page_size(request.args.get('limit'), default=HISTORY_PAGE_SIZE, maximum=HISTORY_MAX_ORDERS)
+    hist = list_orders(department, limit)
+    # Completed orders (reported by the LIS webhook or seen here before) are not polled again.
+    # The rest are fetched concurrently; anything slower than the deadline shows as unknown.
+    statuses = {h['orderId']: 'completed' for h in hist if h.get('status') == 'completed'}
+    polled = fetch_order_statuses(DEFAULT_HOST, SHARED_API_KEY, [h['orderId'] for h in hist if h['orderId'] not in statuses])
+    for order_id, status in polled.items():
+        if status == 'completed':
+            try:
+                previous = set_order_status(order_id, status)
+                if previous is not None and previous[0] != 'completed':
+                    # Seen here before the LIS webhook: queue the report download now
+                    enqueue_lab_report(DEFAULT_HOST, order_id, previous[1])
+            except Exception as e:
+                print(f"⚠️ Could not store status of lab order {order_id}: {e}")
+    statuses.update(polled)
     return render_template_string("""
     <!DOCTYPE html>
     <html>
@@ -2291,7 +2245,7 @@ def history_page():
                             <td class="px-4 py-2">{{ h.createdAt }}</td>
                             {% set st = statuses.get(h.orderId, 'unknown') %}
                             <td class="px-4 py-2">
-                                <span class="px-2 py-1 rounded text-xs {{ 'bg-green-100 text-green-700' if st=='completed' else ('bg-yellow-100 text-yellow-700' if st=='in_progress' else 'bg-gray-100 text-gray-700') }}">{{ st.replace('_',' ') }}</span>
+                                <span data-order-status="{{ h.orderId }}" class="px-2 py-1 rounded text-xs {{ 'bg-green-100 text-green-700' if st=='completed' else ('bg-yellow-100 text-yellow-700' if st=='in_progress' else 'bg-gray-100 text-gray-700') }}">{{ st.replace('_',' ') }}</span>
                             </td>
                             <td class="px-4 py-2 space-x-2">
                                 <a class="inline-block bg-blue-600 text-white px-3 py-1 rounded" href="/results/{{ h.orderId }}">View Results</a>
@@ -2308,9 +2262,28 @@ def history_page():
             {% endif %}
         </div>
         <script>feather.replace()</script>
+        {% set open_orders = hist|rejectattr('orderId', 'in', completed_ids)|map(attribute='orderId')|list %}
+        {% if open_orders %}
+        <script>
+            // Badges update in place while orders are still open
+            if (window.EventSource) {
+                const statusEvents = new EventSource("{{ url_for('status_stream', orders=open_orders|join(',')) }}");
+                statusEvents.addEventListener('status', e => {
+                    const data = JSON.parse(e.data);
+                    const badge = document.querySelector(`[data-order-status="${data.id}"]`);
+                    if (!badge || !data.status) return;
+                    badge.textContent = data.status.replace('_', ' ');
+                    badge.className = 'px-2 py-1 rounded text-xs ' + (data.status === 'completed' ? 'bg-green-100 text-green-700'
+                        : data.status === 'in_progress' ? 'bg-yellow-100 text-yellow-700' : 'bg-gray-100 text-gray-700');
+                });
+                statusEvents.addEventListener('done', () => statusEvents.close());
+            }
+        </script>
+        {% endif %}
     </body>
     </html>
-    """, hist=hist, statuses=statuses, department=department)
+    """, hist=hist, statuses=statuses, department=department,
+        completed_ids=[order_id for order_id, status in statuses.items() if status == 'completed'])
 
 @app.route("/api/health")
 def health():
@@ -2319,13 +2292,32 @@ def health():
         'status': 'OK',
         'service': 'Laboratory Test Request System',
         'timestamp': datetime.now().isoformat(),
-        'target_host': DEFAULT_HOST
+        'target_host': DEFAULT_HOST,
+        'db_pool': pool_stats(),
+        'analytics_cache': analytics_cache.snapshot(),
+        'audit_writer': audit_writer_stats(),
+        'lab_order_index': order_index_stats(),
+        'lab_status_cache': order_status_cache_stats(),
+        'http_client': http_client_stats(),
+        'status_streams': status_stream_stats()
     })
 @app.route("/dicom/<path:filename>")
 def serve_dicom(filename):
-    """Serves the downloaded DICOM file from the 'downloads' directory."""
-    # Serve as a raw binary stream so the WADO loader can parse it
-    return send_from_directory("downloads", filename, mimetype="application/octet-stream")
+    """Serves a downloaded DICOM file by name from the blob store (see blob_store.py)."""
+    try:
+        blob = find_blob(filename)
+    except (RuntimeError, psycopg2.Error) as e:
+        print(f"⚠️ Could not look up {filename} in the blob store, trying downloads/: {e}")
+        blob = None
+    if blob is None:
+        # Saved flat in downloads/ before the blob store (python blob_store.py import moves them)
+        return send_from_directory("downloads", filename, mimetype="application/octet-stream")
+    if not os.path.exists(blob['path']):
+        return jsonify({'error': 'File not found'}), 404
+    # Serve as a raw binary stream so the WADO loader can parse it; the
+    # content hash is a strong validator
+    return send_file(os.path.abspath(blob['path']), mimetype="application/octet-stream",
+                     etag=blob['sha256'], conditional=True)
 
 @app.route('/analytics')
 @login_required
@@ -2335,130 +2327,51 @@ def analytics():
         flash("Admin users do not have access to analytics.", "danger")
         return redirect(url_for('dashboard'))
 
-    conn = get_db_connection()
-    gender_data = {'Male': 0, 'Female': 0, 'Other': 0}
-    age_distribution_data = {'0-18': 0, '19-35': 0, '36-55': 0, '56-75': 0, '75+': 0}
-    monthly_case_trends_data = {}
-    top_diagnoses_data = {}
-
-    total_patients = 0
-    total_medical_records = 0
-    average_visits_per_patient = 0
-    most_recent_record_date = "N/A"
-
-    if conn:
-        cursor = conn.cursor()
-        try:
-            # REMOVE or COMMENT OUT the problematic audit log insert
-            # This was causing an error because 'uhid' is not defined in this context
-            # cursor.execute(
-            #     """INSERT INTO patient_edit_history (uhid, editor_id, field_name, old_value, new_value, edited_at)
-            #        VALUES (%s, %s, %s, %s, %s, NOW())""",
-            #     (uhid, session['user_id'], 'analytics_page_viewed', None, f"User {session['username']} viewed analytics dashboard.")
-            # )
-            # conn.commit()
-
-            cursor.execute("SELECT COUNT(*) FROM patients")
-            total_patients = cursor.fetchone()[0]
-
-            cursor.execute("SELECT COUNT(*) FROM patient_medical_records")
-            total_medical_records = cursor.fetchone()[0]
-
-            if total_patients > 0:
-                cursor.execute("SELECT COUNT(DISTINCT uhid) FROM patient_medical_records")
-                patients_with_records = cursor.fetchone()[0]
-                if patients_with_records > 0:
-                    cursor.execute("SELECT CAST(COUNT(uhid) AS DECIMAL) / COUNT(DISTINCT uhid) FROM patient_medical_records")
-                    avg_visits_result = cursor.fetchone()[0]
-                    if avg_visits_result is not None:
-                        average_visits_per_patient = round(float(avg_visits_result), 2)
-                else:
-                    average_visits_per_patient = 0
-
-            cursor.execute("SELECT MAX(visit_date) FROM patient_medical_records")
-            recent_date_result = cursor.fetchone()[0]
-            if recent_date_result:
-                most_recent_record_date = recent_date_result.strftime('%Y-%m-%d')
+    cached = analytics_cache.get('payload')
+    if cached is not None:
+        return render_template('analytics.html', **cached)
+
+    analytics_data = {
+        'total_patients': 0,
+        'total_medical_records': 0,
+        'average_visits_per_patient': 0,
+        'most_recent_record_date': "N/A",
+        'gender_data': {'Male': 0, 'Female': 0, 'Other': 0},
+        'age_distribution_data': {bucket: 0 for bucket in AGE_BUCKETS},
+        'monthly_case_trends_data': {},
+        'top_diagnoses_data': {},
+        'refreshed_at': None,
+    }
 
-            cursor.execute("SELECT gender, COUNT(*) FROM patients GROUP BY gender")
-            for row in cursor.fetchall():
-                gender = row[0] if row[0] else 'Unknown'
-                count = row[1]
-    
-    # Normalize gender values to match your expected keys
-                if gender and gender.strip():
-                    gender_lower = gender.strip().lower()
-                    if gender_lower == 'male' or gender_lower == 'm':
-                        gender_data['Male'] += count
-                    elif gender_lower == 'female' or gender_lower == 'f':
-                        gender_data['Female'] += count
-                    else:
-                        gender_data['Other'] += count
-                else:
-                    gender_data['Other'] += count
-
-            cursor.execute("SELECT dob FROM patients WHERE dob IS NOT NULL")
-            dob_results = cursor.fetchall()
-            today = datetime.now().date()
-            for dob_row in dob_results:
-                dob = dob_row[0]
-                if dob:
-                    age = today.year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
-                    if age <= 18:
-                        age_distribution_data['0-18'] += 1
-                    elif 19 <= age <= 35:
-                        age_distribution_data['19-35'] += 1
-                    elif 36 <= age <= 55:
-                        age_distribution_data['36-55'] += 1
-                    elif 56 <= age <= 75:
-                        age_distribution_data['56-75'] += 1
-                    else:
-                        age_distribution_data['75+'] += 1
-
-            cursor.execute("SELECT visit_date FROM patient_medical_records WHERE visit_date IS NOT NULL ORDER BY visit_date")
-            trends_results = cursor.fetchall()
-            month_year_counts = Counter()
-            for row in trends_results:
-                visit_date = row[0]
-                if visit_date:
-                    month_year = visit_date.strftime('%Y-%m')
-                    month_year_counts[month_year] += 1
-            monthly_case_trends_data = dict(sorted(month_year_counts.items()))
-
-            cursor.execute("SELECT diagnosis FROM patient_medical_records WHERE diagnosis IS NOT NULL AND diagnosis != ''")
-            diagnosis_results = cursor.fetchall()
-            diagnoses_counter = Counter()
-            for row in diagnosis_results:
-                diagnosis = row[0].strip()
-                if diagnosis:
-                    diagnoses_counter[diagnosis] += 1
-            top_diagnoses_data = dict(diagnoses_counter.most_common(10))
-
-            print("=== ANALYTICS DATA DEBUG ===")
-            print(f"Total patients: {total_patients}")
-            print(f"Gender data: {gender_data}")
-            print(f"Age distribution: {age_distribution_data}")
-            print(f"Monthly trends: {monthly_case_trends_data}")
-            print(f"Top diagnoses: {top_diagnoses_data}")
+    generation = analytics_cache.generation
+    computed = False
+    with db_connection() as conn:
+        if conn:
+            cursor = conn.cursor()
+            try:
+                analytics_data = compute_analytics(cursor)
+                computed = True
+            except Exception as e:
+                flash(f"Error fetching analytics data: {e}", "danger")
+                print(f"Error fetching analytics data: {e}")
+                import traceback
+                traceback.print_exc()  # This will show the full error traceback
+            finally:
+                cursor.close()
 
-        except Exception as e:
-            flash(f"Error fetching analytics data: {e}", "danger")
-            print(f"Error fetching analytics data: {e}")
-            import traceback
-            traceback.print_exc()  # This will show the full error traceback
-        finally:
-            cursor.close()
-            conn.close()
-
-    return render_template('analytics.html',
-                           total_patients=total_patients,
-                           total_medical_records=total_medical_records,
-                           average_visits_per_patient=f"{average_visits_per_patient:.2f}",
-                           most_recent_record_date=most_recent_record_date,
-                           gender_data=gender_data,
-                           age_distribution_data=age_distribution_data,
-                           monthly_case_trends_data=monthly_case_trends_data,
-                           top_diagnoses_data=top_diagnoses_data)
+    context = dict(total_patients=analytics_data['total_patients'],
+                   total_medical_records=analytics_data['total_medical_records'],
+                   average_visits_per_patient=f"{analytics_data['average_visits_per_patient']:.2f}",
+                   most_recent_record_date=analytics_data['most_recent_record_date'],
+                   gender_data=analytics_data['gender_data'],
+                   age_distribution_data=analytics_data['age_distribution_data'],
+                   monthly_case_trends_data=analytics_data['monthly_case_trends_data'],
+                   top_diagnoses_data=analytics_data['top_diagnoses_data'],
+                   rollups_refreshed_at=analytics_data['refreshed_at'])
+    # Failed loads are not cached, so the next view retries the database
+    if computed:
+        analytics_cache.set('payload', context, generation=generation)
+    return render_template('analytics.html', **context)
 
 @app.route('/dr_risk_assessment', methods=['POST'])
 @login_required
@@ -2467,75 +2380,68 @@ def dr_risk_assessment():
     if session['user_role'] == 'admin' or session['user_role'] == 'nurse':
         return jsonify({"error": "Access denied for this role."}), 403
 
-    conn = get_db_connection()
-    if conn:
-        cursor = conn.cursor()
-        try:
-            data = request.get_json()
-            duration_diabetes_years = float(data.get('duration_diabetes_years', 0))
-            hba1c = float(data.get('hba1c', 0))
-            systolic_bp = float(data.get('systolic_bp', 0))
-            diastolic_bp = float(data.get('diastolic_bp', 0))
-            has_kidney_disease = data.get('has_kidney_disease', False)
-            has_high_cholesterol = data.get('has_high_cholesterol', False)
-
-            risk_score = 0
-            risk_category = "No Diabetic Retinopathy (No DR detected)"
-            risk_implication = "Annual screening recommended."
-
-            if duration_diabetes_years > 10: risk_score += 3
-            elif duration_diabetes_years > 5: risk_score += 1
-
-            if hba1c >= 8.0: risk_score += 4
-            elif hba1c >= 7.0: risk_score += 2
-
-            if systolic_bp >= 140 or diastolic_bp >= 90: risk_score += 2
-            if has_kidney_disease: risk_score += 3
-            if has_high_cholesterol: risk_score += 1
-
-            if risk_score >= 10:
-                risk_category = "Proliferative Diabetic Retinopathy (PDR)"
-                risk_implication = "Immediate ophthalmology referral for laser or surgical intervention required."
-            elif risk_score >= 7:
-                risk_category = "Severe Non-Proliferative Diabetic Retinopathy (Severe NPDR)"
-                risk_implication = "Urgent ophthalmology referral for potential treatment to prevent vision loss."
-            elif risk_score >= 4:
-                risk_category = "Moderate Non-Proliferative Diabetic Retinopathy (Moderate NPDR)"
-                risk_implication = "Regular follow-ups (e.g., 4-6 months) and intensive diabetes/BP management crucial."
-            elif risk_score >= 2:
-                risk_category = "Mild Non-Proliferative Diabetic Retinopathy (Mild NPDR)"
-                risk_implication = "Close monitoring (e.e., 6-12 months) and strict diabetes control advised."
-
-            # Also fetch patient id for dr_risk_assessment log
-            cursor.execute("SELECT id FROM patients WHERE uhid = %s", (data.get('uhid'),))
-            p_row = cursor.fetchone()
-            p_id = p_row[0] if p_row else None
-
-            cursor.execute(
-                """INSERT INTO patient_edit_history (patient_id, uhid, editor_id, field_name, old_value, new_value, edited_at)
-                   VALUES (%s, %s, %s, %s, %s, %s, NOW())""",
-                (p_id, data.get('uhid'), session['user_id'], 'dr_risk_assessment_performed', None, f"Risk Category: {risk_category}, Score: {risk_score}, Implication: {risk_implication}")
-            )
-            conn.commit()
-            cursor.close()
-            conn.close()
-
-            return jsonify({
-                "risk_score": risk_score,
-                "risk_category": risk_category,
-                "implication": risk_implication,
-                "message": "This is a simplified rule-based assessment and not a medical diagnosis."
-            })
-        except Exception as e:
-            if conn: conn.rollback()
-            return jsonify({"error": str(e)}), 400
-        finally:
-            if conn and not cursor.closed:
+    with db_connection() as conn:
+        if conn:
+            cursor = conn.cursor()
+            try:
+                data = request.get_json()
+                duration_diabetes_years = float(data.get('duration_diabetes_years', 0))
+                hba1c = float(data.get('hba1c', 0))
+                systolic_bp = float(data.get('systolic_bp', 0))
+                diastolic_bp = float(data.get('diastolic_bp', 0))
+                has_kidney_disease = data.get('has_kidney_disease', False)
+                has_high_cholesterol = data.get('has_high_cholesterol', False)
+
+                risk_score = 0
+                risk_category = "No Diabetic Retinopathy (No DR detected)"
+                risk_implication = "Annual screening recommended."
+
+                if duration_diabetes_years > 10: risk_score += 3
+                elif duration_diabetes_years > 5: risk_score += 1
+
+                if hba1c >= 8.0: risk_score += 4
+                elif hba1c >= 7.0: risk_score += 2
+
+                if systolic_bp >= 140 or diastolic_bp >= 90: risk_score += 2
+                if has_kidney_disease: risk_score += 3
+                if has_high_cholesterol: risk_score += 1
+
+                if risk_score >= 10:
+                    risk_category = "Proliferative Diabetic Retinopathy (PDR)"
+                    risk_implication = "Immediate ophthalmology referral for laser or surgical intervention required."
+                elif risk_score >= 7:
+                    risk_category = "Severe Non-Proliferative Diabetic Retinopathy (Severe NPDR)"
+                    risk_implication = "Urgent ophthalmology referral for potential treatment to prevent vision loss."
+                elif risk_score >= 4:
+                    risk_category = "Moderate Non-Proliferative Diabetic Retinopathy (Moderate NPDR)"
+                    risk_implication = "Regular follow-ups (e.g., 4-6 months) and intensive diabetes/BP management crucial."
+                elif risk_score >= 2:
+                    risk_category = "Mild Non-Proliferative Diabetic Retinopathy (Mild NPDR)"
+                    risk_implication = "Close monitoring (e.e., 6-12 months) and strict diabetes control advised."
+
+                # Also fetch patient id for dr_risk_assessment log
+                cursor.execute("SELECT id FROM patients WHERE uhid = %s", (data.get('uhid'),))
+                p_row = cursor.fetchone()
+                p_id = p_row[0] if p_row else None
+
+                log_edit(p_id, data.get('uhid'), session['user_id'], 'dr_risk_assessment_performed',
+                         new_value=f"Risk Category: {risk_category}, Score: {risk_score}, Implication: {risk_implication}")
                 cursor.close()
-            if conn and not conn.closed:
-                conn.close()
-    else:
-        return jsonify({"error": "Database connection failed."}), 500
+
+                return jsonify({
+                    "risk_score": risk_score,
+                    "risk_category": risk_category,
+                    "implication": risk_implication,
+                    "message": "This is a simplified rule-based assessment and not a medical diagnosis."
+                })
+            except Exception as e:
+                if conn: conn.rollback()
+                return jsonify({"error": str(e)}), 400
+            finally:
+                if conn and not cursor.closed:
+                    cursor.close()
+        else:
+            return jsonify({"error": "Database connection failed."}), 500
     
 @app.route('/prescription/<uhid>', methods=['GET', 'POST'])
 @login_required
@@ -2546,161 +2452,161 @@ def prescription_page(uhid):
     Note: Now fetches patient data by MRN since UHID is no longer in the route path.
     """
     
-    conn = None
-    cursor = None
-    patient = None # Initialize patient outside of try block
-    patient_uhid = None # Initialize UHID fallback
+    with db_connection() as conn:
+        cursor = None
+        patient = None # Initialize patient outside of try block
+        patient_uhid = None # Initialize UHID fallback
 
-    try:
-        conn = get_db_connection()
-        if not conn:
-            flash("Database connection error.", 'danger')
-            return redirect(url_for('dashboard'))
+        try:
+            if not conn:
+                flash("Database connection error.", 'danger')
+                return redirect(url_for('dashboard'))
 
-        # --- STEP 1: Fetch Patient Data (using MRN only) ---
-        # We need to manually fetch the patient since the original helper relied on UHID.
-        # This assumes DictCursor is used for easy dictionary access.
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            # --- STEP 1: Fetch Patient Data (using MRN only) ---
+            # We need to manually fetch the patient since the original helper relied on UHID.
+            # This assumes DictCursor is used for easy dictionary access.
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
         
-        # Assuming MRN is sufficient to look up the primary patient record
-        cursor.execute("SELECT * FROM patients WHERE uhid = %s", (uhid,))
-        patient_row = cursor.fetchone()
+            # Assuming MRN is sufficient to look up the primary patient record
+            cursor.execute("SELECT * FROM patients WHERE uhid = %s", (uhid,))
+            patient_row = cursor.fetchone()
         
-        if patient_row:
-            patient = dict(patient_row)
-            # Synthesize name for template compatibility
-            patient['name'] = f"{patient.get('first_name', '')} {patient.get('last_name', '')}".strip()
-            # Safely get the UHID, which is needed for the redirect later
-            patient_uhid = patient.get('uhid')
-            if not patient_uhid:
-                 patient_uhid = "N/A" # Fallback if UHID field is empty
-        else:
-            flash(f'Patient with uhid {uhid} not found.', 'danger')
-            return redirect(url_for('dashboard'))
+            if patient_row:
+                patient = dict(patient_row)
+                # Synthesize name for template compatibility
+                patient['name'] = f"{patient.get('first_name', '')} {patient.get('last_name', '')}".strip()
+                # Safely get the UHID, which is needed for the redirect later
+                patient_uhid = patient.get('uhid')
+                if not patient_uhid:
+                     patient_uhid = "N/A" # Fallback if UHID field is empty
+            else:
+                flash(f'Patient with uhid {uhid} not found.', 'danger')
+                return redirect(url_for('dashboard'))
         
-        # Close cursor for read operation before starting potential write operation
-        cursor.close() 
+            # Close cursor for read operation before starting potential write operation
+            cursor.close() 
 
-        # --- STEP 2: Process POST Request (Saving Prescription) ---
-        if request.method == 'POST':
-            # Re-open cursor for write operation
-            cursor = conn.cursor() 
-            visit_date = request.form['visit_date']
+            # --- STEP 2: Process POST Request (Saving Prescription) ---
+            if request.method == 'POST':
+                # Re-open cursor for write operation
+                cursor = conn.cursor() 
+                visit_date = request.form['visit_date']
             
-            form_data = request.form
+                form_data = request.form
             
-            # --- Extract Spectacle/Refraction Data ---
-            spectacle_data = {
-                'od_sph': form_data.get('spectacle_od_sph'),
-                'od_cyl': form_data.get('spectacle_od_cyl'),
-                'od_axis': form_data.get('spectacle_od_axis'),
-                'od_add': form_data.get('spectacle_od_add'),
-                'od_prism': form_data.get('spectacle_od_prism'),
-                'od_va': form_data.get('spectacle_od_va'),
-                'os_sph': form_data.get('spectacle_os_sph'),
-                'os_cyl': form_data.get('spectacle_os_cyl'),
-                'os_axis': form_data.get('spectacle_os_axis'),
-                'os_add': form_data.get('spectacle_os_add'),
-                'os_prism': form_data.get('spectacle_os_prism'),
-                'os_va': form_data.get('spectacle_os_va'),
-            }
-            lens_type = form_data.get('lens_type')
+                # --- Extract Spectacle/Refraction Data ---
+                spectacle_data = {
+                    'od_sph': form_data.get('spectacle_od_sph'),
+                    'od_cyl': form_data.get('spectacle_od_cyl'),
+                    'od_axis': form_data.get('spectacle_od_axis'),
+                    'od_add': form_data.get('spectacle_od_add'),
+                    'od_prism': form_data.get('spectacle_od_prism'),
+                    'od_va': form_data.get('spectacle_od_va'),
+                    'os_sph': form_data.get('spectacle_os_sph'),
+                    'os_cyl': form_data.get('spectacle_os_cyl'),
+                    'os_axis': form_data.get('spectacle_os_axis'),
+                    'os_add': form_data.get('spectacle_os_add'),
+                    'os_prism': form_data.get('spectacle_os_prism'),
+                    'os_va': form_data.get('spectacle_os_va'),
+                }
+                lens_type = form_data.get('lens_type')
 
-            # --- Extract Dynamic Medication Data ---
-            medications = []
-            med_index = 1
-            while True:
-                name_key = f'medication_name_{med_index}'
+                # --- Extract Dynamic Medication Data ---
+                medications = []
+                med_index = 1
+                while True:
+                    name_key = f'medication_name_{med_index}'
                 
-                # Check if the next medication block exists
-                if name_key not in form_data:
-                    break
+                    # Check if the next medication block exists
+                    if name_key not in form_data:
+                        break
                 
-                # Only save if the drug name is provided and not empty
-                if form_data.get(name_key, '').strip():
-                    medication = {
-                        'name': form_data.get(name_key).strip(),
-                        'dose': form_data.get(f'medication_dose_{med_index}'),
-                        'frequency': form_data.get(f'medication_frequency_{med_index}'),
-                        'eye': form_data.get(f'medication_eye_{med_index}'),
-                        'duration_value': form_data.get(f'medication_duration_value_{med_index}'),
-                        'duration_unit': form_data.get(f'medication_duration_unit_{med_index}'),
-                    }
-                    medications.append(medication)
+                    # Only save if the drug name is provided and not empty
+                    if form_data.get(name_key, '').strip():
+                        medication = {
+                            'name': form_data.get(name_key).strip(),
+                            'dose': form_data.get(f'medication_dose_{med_index}'),
+                            'frequency': form_data.get(f'medication_frequency_{med_index}'),
+                            'eye': form_data.get(f'medication_eye_{med_index}'),
+                            'duration_value': form_data.get(f'medication_duration_value_{med_index}'),
+                            'duration_unit': form_data.get(f'medication_duration_unit_{med_index}'),
+                        }
+                        medications.append(medication)
                 
-                med_index += 1
+                    med_index += 1
             
-            # --- Extract Notes and Follow-up ---
-            systemic_medication = form_data.get('systemic_medication')
-            surgery_recommendation = form_data.get('surgery_recommendation')
-            iol_notes = form_data.get('iol_notes')
-            patient_instructions = form_data.get('patient_instructions')
+                # --- Extract Notes and Follow-up ---
+                systemic_medication = form_data.get('systemic_medication')
+                surgery_recommendation = form_data.get('surgery_recommendation')
+                iol_notes = form_data.get('iol_notes')
+                patient_instructions = form_data.get('patient_instructions')
             
-            follow_up_date_str = form_data.get('follow_up_date')
-            follow_up_date = follow_up_date_str if follow_up_date_str else None
+                follow_up_date_str = form_data.get('follow_up_date')
+                follow_up_date = follow_up_date_str if follow_up_date_str else None
 
             
-            # --- Save to Database ---
+                # --- Save to Database ---
             
-            # IMPORTANT: session['user_id'] must hold the integer ID of the logged-in user
-            user_id = session.get('user_id', 1) 
-
-            insert_query = """
-                INSERT INTO patient_prescriptions (
-                    patient_id, uhid, created_by, spectacle_lens, lens_type, medications, 
-                    systemic_medication, surgery_recommendation, iol_notes, 
-                    patient_instructions, follow_up_date, visit_date
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            cursor.execute(insert_query, ( 
-                patient['id'],
-                uhid, 
-                user_id,
-                json.dumps(spectacle_data), 
-                lens_type, 
-                json.dumps(medications),    
-                systemic_medication, 
-                surgery_recommendation, 
-                iol_notes, 
-                patient_instructions, 
-                follow_up_date,
-                visit_date
-            ))
+                # IMPORTANT: session['user_id'] must hold the integer ID of the logged-in user
+                user_id = session.get('user_id', 1) 
+
+                insert_query = """
+                    INSERT INTO patient_prescriptions (
+                        patient_id, uhid, created_by, spectacle_lens, lens_type, medications, 
+                        systemic_medication, surgery_recommendation, iol_notes, 
+                        patient_instructions, follow_up_date, visit_date
+                    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """
+                cursor.execute(insert_query, ( 
+                    patient['id'],
+                    uhid, 
+                    user_id,
+                    json.dumps(spectacle_data), 
+                    lens_type, 
+                    json.dumps(medications),    
+                    systemic_medication, 
+                    surgery_recommendation, 
+                    iol_notes, 
+                    patient_instructions, 
+                    follow_up_date,
+                    visit_date
+                ))
             
-            conn.commit()
-            flash('Prescription saved successfully!', 'success')
+                conn.commit()
+                flash('Prescription saved successfully!', 'success')
             
-            # SUCCESS REDIRECT: Go back to the patient's main view using MRN and the retrieved UHID
+                # SUCCESS REDIRECT: Go back to the patient's main view using MRN and the retrieved UHID
         
-        # --- STEP 3: Handle GET Request (Displaying the Form) ---
-        today_date = datetime.now().date().strftime('%Y-%m-%d')
-        return render_template('prescription_form.html', patient=patient, today_date=today_date)
+            # --- STEP 3: Handle GET Request (Displaying the Form) ---
+            today_date = datetime.now().date().strftime('%Y-%m-%d')
+            return render_template('prescription_form.html', patient=patient, today_date=today_date)
     
-    except Exception as e:
-        error_message = f"ERROR: Prescription processing failed. Details: {e}"
-        print(f"FATAL SERVER ERROR in prescription_page: {error_message}") 
-        flash(error_message, 'danger')
+        except Exception as e:
+            error_message = f"ERROR: Prescription processing failed. Details: {e}"
+            print(f"FATAL SERVER ERROR in prescription_page: {error_message}") 
+            flash(error_message, 'danger')
         
-        if conn: conn.rollback()
+            if conn: conn.rollback()
         
-        # ERROR FALLBACK REDIRECT
-        # Use the retrieved patient_uhid if available, otherwise just redirect to dashboard
-        if patient_uhid and uhid:
-            return redirect(url_for('view_medical_history', uhid=uhid))
-        else:
-            return redirect(url_for('dashboard')) 
+            # ERROR FALLBACK REDIRECT
+            # Use the retrieved patient_uhid if available, otherwise just redirect to dashboard
+            if patient_uhid and uhid:
+                return redirect(url_for('view_medical_history', uhid=uhid))
+            else:
+                return redirect(url_for('dashboard')) 
 
-    finally:
-        # Cleanup connection resources
-        if cursor and not cursor.closed: cursor.close()
-        if conn: conn.close()    
+        finally:
+            # Cleanup connection resources
+            if cursor and not cursor.closed: cursor.close()
 
 
 with app.app_context():
+    # Schema changes are applied out-of-band with `python migrate.py apply`;
+    # workers only compare versions so startup never takes table locks.
     try:
-        create_tables() 
-        ensure_columns()
-        print("✅ Database initialized and tables verified.")
+        current_version, expected_version = check_schema_version()
+        if AUTO_MIGRATE and current_version != expected_version:
+            apply_migrations()
     except Exception as e:
         print(f"⚠️ Startup Database Setup Warning: {e}")
 
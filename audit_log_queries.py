@@ -0,0 +1,172 @@
+"""
+Queries behind the admin audit log screens.
+
+The viewer pages with a keyset cursor on (edited_at, id), newest first.
+Filters are plain equality predicates that the composite indexes from
+migrations 0004 and 0008 serve together with that order; date filters
+also prune the monthly partitions from migration 0009.
+
+The CSV export streams: rows come from a named (server-side) cursor a batch
+at a time and are written out in chunks as they arrive, so memory use does
+not depend on how much history is exported.
+"""
+import csv
+import zlib
+from datetime import datetime
+from io import StringIO
+
+from pagination import encode_cursor, decode_cursor
+
+_AUDIT_COLUMNS = """
+        peh.edited_at, u.username as editor_username,
+        COALESCE(p.uhid, 'System Event') as uhid,
+        COALESCE(p.first_name, '') as first_name,
+        COALESCE(p.last_name, '') as last_name,
+        peh.field_name, peh.old_value, peh.new_value"""
+_AUDIT_FROM = """
+    FROM patient_edit_history peh
+    LEFT JOIN users u ON peh.editor_id = u.id
+    LEFT JOIN patients p ON peh.uhid = p.uhid
+"""
+AUDIT_LOG_SELECT_SQL = "SELECT" + _AUDIT_COLUMNS + _AUDIT_FROM
+
+AUDIT_CSV_HEADER = ['Timestamp', 'Editor', 'Patient UHID', 'First Name', 'Last Name', 'Field', 'Old Value', 'New Value']
+
+AUDIT_PAGE_SIZE = 50
+AUDIT_MAX_PAGE_SIZE = 200
+
+# Rows fetched per round trip from the server-side cursor, and written per chunk
+EXPORT_BATCH_ROWS = 2000
+
+
+def build_audit_filters(start_date=None, end_date=None, username=None, uhid=None, field_name=None):
+    """Returns (where_clauses, query_params) for the given, already-parsed filters."""
+    where_clauses = []
+    query_params = []
+    if start_date:
+        where_clauses.append("peh.edited_at >= %s")
+        query_params.append(start_date)
+    if end_date:
+        where_clauses.append("peh.edited_at <= %s")
+        query_params.append(end_date)
+    if username:
+        # Resolved to an id once so idx_edit_history_editor_edited_at applies
+        where_clauses.append("peh.editor_id = (SELECT id FROM users WHERE username = %s)")
+        query_params.append(username)
+    if uhid:
+        where_clauses.append("peh.uhid = %s")
+        query_params.append(uhid)
+    if field_name:
+        where_clauses.append("peh.field_name = %s")
+        query_params.append(field_name)
+    return where_clauses, query_params
+
+
+def decode_audit_cursor(token):
+    """Returns (edited_at, id) from an audit log cursor, or None if it is malformed."""
+    values = decode_cursor(token, length=2)
+    if values is None:
+        return None
+    try:
+        return datetime.fromisoformat(values[0]), int(values[1])
+    except (TypeError, ValueError):
+        return None
+
+
+def _page_key(row):
+    # row is the CSV columns followed by peh.id
+    return encode_cursor([row[0].isoformat(), row[8]])
+
+
+def list_audit_logs_page(cursor, where_clauses, query_params, limit, after=None, before=None):
+    """
+    Returns (rows, next_cursor, prev_cursor) for one page, newest first.
+    rows have the CSV columns. `after` moves to older entries, `before` to
+    newer ones; pass at most one.
+    """
+    clauses = list(where_clauses)
+    params = list(query_params)
+    # The plain edited_at bound duplicates the row comparison so the planner
+    # can prune monthly partitions (migration 0009), which it cannot do from
+    # a row comparison alone.
+    if before is not None:
+        clauses.append("peh.edited_at >= %s AND (peh.edited_at, peh.id) > (%s, %s)")
+        params.extend([before[0], *before])
+        order = "ASC"
+    else:
+        if after is not None:
+            clauses.append("peh.edited_at <= %s AND (peh.edited_at, peh.id) < (%s, %s)")
+            params.extend([after[0], *after])
+        order = "DESC"
+
+    query = "SELECT" + _AUDIT_COLUMNS + ", peh.id" + _AUDIT_FROM
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += f" ORDER BY peh.edited_at {order}, peh.id {order} LIMIT %s"
+    cursor.execute(query, params + [limit + 1])
+    rows = cursor.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        return [], None, None
+
+    if before is not None:
+        rows.reverse()
+        next_cursor = _page_key(rows[-1])
+        prev_cursor = _page_key(rows[0]) if has_more else None
+    else:
+        next_cursor = _page_key(rows[-1]) if has_more else None
+        prev_cursor = _page_key(rows[0]) if after is not None else None
+    return [tuple(row[:8]) for row in rows], next_cursor, prev_cursor
+
+
+def build_audit_query(where_clauses):
+    query = AUDIT_LOG_SELECT_SQL
+    if where_clauses:
+        query += " WHERE " + " AND ".join(where_clauses)
+    return query + " ORDER BY peh.edited_at DESC, peh.id DESC"
+
+
+def stream_audit_csv(conn, where_clauses, query_params, compress=False, batch_rows=EXPORT_BATCH_ROWS):
+    """
+    Yields the audit log CSV as bytes, one chunk per batch of rows,
+    gzip-compressed when compress is true. The caller owns conn and must
+    release it once the response is closed.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    def take_chunk():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    writer.writerow(AUDIT_CSV_HEADER)
+    yield take_chunk()
+
+    # Named cursors only live inside a transaction; the rollback below ends it
+    cursor = conn.cursor(name='audit_log_export')
+    cursor.itersize = batch_rows
+    try:
+        cursor.execute(build_audit_query(where_clauses), query_params)
+        while True:
+            rows = cursor.fetchmany(batch_rows)
+            if not rows:
+                break
+            writer.writerows(rows)
+            chunk = take_chunk()
+            if chunk:
+                yield chunk
+    except Exception as e:
+        # Headers are already sent, so the download just ends early
+        print(f"❌ Audit log export aborted: {e}")
+        raise
+    finally:
+        cursor.close()
+        conn.rollback()
+
+    if compressor:
+        yield compressor.flush()
@@ -0,0 +1,288 @@
+"""
+Maintenance for the monthly partitions of patient_edit_history (migration 0009).
+
+    python audit_partitions.py list
+    python audit_partitions.py maintain            # ensure + archive; run daily from cron
+    python audit_partitions.py ensure [--months-ahead N]
+    python audit_partitions.py archive [--retention-months N]
+    python audit_partitions.py restore patient_edit_history_y2023m01
+
+`ensure` creates the partitions for the current month and the next
+AUDIT_PARTITION_MONTHS_AHEAD months. Rows that reached the DEFAULT partition
+because a month was missing are moved into the new partition.
+
+`archive` detaches every partition that ended more than
+AUDIT_RETENTION_MONTHS months ago, writes it to AUDIT_ARCHIVE_DIR as
+<partition>.csv.gz plus a <partition>.json manifest, and drops it.
+`restore` loads an archive back and re-attaches it so the audit screens can
+search that month again. `maintain` leaves restored partitions attached;
+run `archive --include-restored` when the investigation is done.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+from datetime import date, datetime
+
+from database import open_connection
+
+PARENT_TABLE = 'patient_edit_history'
+DEFAULT_PARTITION = 'patient_edit_history_default'
+COLUMNS = "id, patient_id, uhid, editor_id, field_name, old_value, new_value, edited_at"
+
+AUDIT_PARTITION_MONTHS_AHEAD = int(os.environ.get('AUDIT_PARTITION_MONTHS_AHEAD', 3))
+AUDIT_RETENTION_MONTHS = int(os.environ.get('AUDIT_RETENTION_MONTHS', 24))
+AUDIT_ARCHIVE_DIR = os.environ.get('AUDIT_ARCHIVE_DIR', os.path.join('archives', 'audit_history'))
+
+_PARTITION_NAME_RE = re.compile(r'^patient_edit_history_y(\d{4})m(\d{2})$')
+RESTORED_COMMENT = 'restored from archive'
+
+_BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def add_months(day, months):
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{PARENT_TABLE}_y{month.year}m{month.month:02d}"
+
+
+def month_of(name):
+    """Returns the first day of the month a partition name covers, or None."""
+    match = _PARTITION_NAME_RE.match(name)
+    if not match:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def list_partitions(cursor):
+    """
+    Returns [(name, lower, upper, estimated_rows, restored)]; bounds are None
+    for the DEFAULT partition.
+    """
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint,
+               obj_description(c.oid, 'pg_class') IS NOT DISTINCT FROM %s
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname
+    """, (RESTORED_COMMENT, PARENT_TABLE))
+    partitions = []
+    for name, bound, rows, restored in cursor.fetchall():
+        match = _BOUND_RE.search(bound)
+        lower = datetime.fromisoformat(match.group(1)) if match else None
+        upper = datetime.fromisoformat(match.group(2)) if match else None
+        partitions.append((name, lower, upper, max(rows, 0), restored))
+    return partitions
+
+
+def detached_partitions(cursor):
+    """Monthly tables left detached (e.g. by an interrupted archive or restore)."""
+    cursor.execute(
+        "SELECT relname FROM pg_class WHERE relkind = 'r' AND NOT relispartition AND relname LIKE %s",
+        (PARENT_TABLE + '\\_y%',)
+    )
+    return sorted(name for (name,) in cursor.fetchall() if month_of(name))
+
+
+def create_month_partition(conn, month):
+    """Creates and attaches the partition for `month`, moving in any matching rows from DEFAULT."""
+    name = partition_name(month)
+    lower, upper = month, add_months(month, 1)
+    with conn.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE {name} (LIKE {PARENT_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        cursor.execute(
+            f"""WITH moved AS (
+                    DELETE FROM {DEFAULT_PARTITION}
+                    WHERE edited_at >= %s AND edited_at < %s
+                    RETURNING {COLUMNS}
+                )
+                INSERT INTO {name} ({COLUMNS}) SELECT {COLUMNS} FROM moved""",
+            (lower, upper)
+        )
+        moved = cursor.rowcount
+        # Attaching builds the partition's copies of the parent's indexes and foreign keys
+        cursor.execute(
+            f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+            (lower, upper)
+        )
+    conn.commit()
+    print(f"✅ Created partition {name}" + (f" ({moved} rows moved from the default partition)" if moved else ""))
+
+
+def ensure_partitions(conn, months_ahead=AUDIT_PARTITION_MONTHS_AHEAD):
+    with conn.cursor() as cursor:
+        existing = {p[0] for p in list_partitions(cursor)}
+    conn.commit()
+    this_month = add_months(date.today(), 0)
+    for offset in range(months_ahead + 1):
+        month = add_months(this_month, offset)
+        if partition_name(month) not in existing:
+            create_month_partition(conn, month)
+
+
+def _manifest_path(archive_dir, name):
+    return os.path.join(archive_dir, f"{name}.json")
+
+
+def _archive_path(archive_dir, name):
+    return os.path.join(archive_dir, f"{name}.csv.gz")
+
+
+def archive_partition(conn, name, archive_dir=AUDIT_ARCHIVE_DIR, detach=True):
+    """Detaches a partition, writes it to a gzip CSV with a manifest, then drops it."""
+    os.makedirs(archive_dir, exist_ok=True)
+    lower = month_of(name)
+    upper = add_months(lower, 1)
+    if detach:
+        with conn.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}")
+        conn.commit()
+
+    # From here the table is detached; if anything fails it stays as a plain
+    # table and `restore` (or re-running `archive`) picks it up again.
+    data_path = _archive_path(archive_dir, name)
+    tmp_path = data_path + '.tmp'
+    with conn.cursor() as cursor:
+        with gzip.open(tmp_path, 'wb') as f:
+            cursor.copy_expert(f"COPY {name} ({COLUMNS}) TO STDOUT WITH (FORMAT csv, HEADER)", f)
+        cursor.execute(f"SELECT COUNT(*) FROM {name}")
+        rows = cursor.fetchone()[0]
+    conn.commit()
+
+    sha256 = hashlib.sha256()
+    with open(tmp_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    os.replace(tmp_path, data_path)
+    with open(_manifest_path(archive_dir, name), 'w') as f:
+        json.dump({
+            'partition': name,
+            'columns': COLUMNS,
+            'lower': lower.isoformat(),
+            'upper': upper.isoformat(),
+            'rows': rows,
+            'sha256': sha256.hexdigest(),
+            'archived_at': datetime.now().isoformat(timespec='seconds'),
+        }, f, indent=2)
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE {name}")
+    conn.commit()
+    print(f"✅ Archived {name} ({rows} rows) to {data_path}")
+
+
+def archive_old_partitions(conn, retention_months=AUDIT_RETENTION_MONTHS, archive_dir=AUDIT_ARCHIVE_DIR,
+                           include_restored=False):
+    cutoff = datetime.combine(add_months(date.today(), -retention_months), datetime.min.time())
+    with conn.cursor() as cursor:
+        partitions = list_partitions(cursor)
+        leftovers = detached_partitions(cursor)
+    conn.commit()
+    archived = 0
+    for name in leftovers:
+        print(f"⚠️ {name} is detached but not archived; archiving it now.")
+        archive_partition(conn, name, archive_dir, detach=False)
+        archived += 1
+    for name, lower, upper, _, restored in partitions:
+        if restored and not include_restored:
+            print(f"Keeping restored partition {name} attached.")
+            continue
+        if upper is not None and upper <= cutoff and month_of(name):
+            archive_partition(conn, name, archive_dir)
+            archived += 1
+    if not archived:
+        print(f"No partitions older than {retention_months} months.")
+
+
+def restore_partition(conn, name, archive_dir=AUDIT_ARCHIVE_DIR):
+    """Loads an archived partition back and re-attaches it."""
+    month = month_of(name)
+    if month is None:
+        raise ValueError(f"Not a partition name: {name}")
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+        if cursor.fetchone()[0]:
+            # Left detached by an interrupted archive; attach it as it is
+            cursor.execute(f"SELECT COUNT(*) FROM {name}")
+            rows = cursor.fetchone()[0]
+        else:
+            with open(_manifest_path(archive_dir, name)) as f:
+                manifest = json.load(f)
+            cursor.execute(f"CREATE TABLE {name} (LIKE {PARENT_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+            with gzip.open(_archive_path(archive_dir, name), 'rb') as f:
+                cursor.copy_expert(f"COPY {name} ({manifest['columns']}) FROM STDIN WITH (FORMAT csv, HEADER)", f)
+            cursor.execute(f"SELECT COUNT(*) FROM {name}")
+            rows = cursor.fetchone()[0]
+            if rows != manifest['rows']:
+                raise RuntimeError(f"{name}: archive has {rows} rows, manifest says {manifest['rows']}")
+        cursor.execute(
+            f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)",
+            (month, add_months(month, 1))
+        )
+        cursor.execute(f"COMMENT ON TABLE {name} IS %s", (RESTORED_COMMENT,))
+    conn.commit()
+    print(f"✅ Restored {name} ({rows} rows). Run `archive --include-restored` to detach it again when done.")
+
+
+def print_partitions(conn):
+    with conn.cursor() as cursor:
+        partitions = list_partitions(cursor)
+    conn.commit()
+    for name, lower, upper, rows, restored in partitions:
+        span = f"{lower:%Y-%m-%d} .. {upper:%Y-%m-%d}" if lower else "DEFAULT"
+        print(f"{name:<40} {span:<26} ~{rows} rows" + (" (restored)" if restored else ""))
+    if os.path.isdir(AUDIT_ARCHIVE_DIR):
+        archives = sorted(f[:-len('.json')] for f in os.listdir(AUDIT_ARCHIVE_DIR) if f.endswith('.json'))
+        attached = {p[0] for p in partitions}
+        for name in archives:
+            if name not in attached:
+                print(f"{name:<40} archived in {AUDIT_ARCHIVE_DIR}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the monthly partitions of patient_edit_history.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help="Show partitions and archives")
+    sub.add_parser('maintain', help="Create upcoming partitions and archive expired ones")
+    ensure = sub.add_parser('ensure', help="Create partitions for this month and the next N")
+    ensure.add_argument('--months-ahead', type=int, default=AUDIT_PARTITION_MONTHS_AHEAD)
+    archive = sub.add_parser('archive', help="Detach and archive partitions older than the retention period")
+    archive.add_argument('--retention-months', type=int, default=AUDIT_RETENTION_MONTHS)
+    archive.add_argument('--include-restored', action='store_true',
+                         help="Also archive partitions brought back with `restore`")
+    restore = sub.add_parser('restore', help="Re-attach an archived partition")
+    restore.add_argument('partition')
+    args = parser.parse_args(argv)
+
+    conn = open_connection()
+    try:
+        if args.command == 'list':
+            print_partitions(conn)
+        elif args.command == 'maintain':
+            ensure_partitions(conn)
+            archive_old_partitions(conn)
+        elif args.command == 'ensure':
+            ensure_partitions(conn, args.months_ahead)
+        elif args.command == 'archive':
+            archive_old_partitions(conn, args.retention_months, include_restored=args.include_restored)
+        elif args.command == 'restore':
+            restore_partition(conn, args.partition)
+    except Exception as e:
+        conn.rollback()
+        print(f"❌ {e}")
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,252 @@
+"""
+Batched, asynchronous writes to patient_edit_history and audit_logs.
+
+Request handlers call log_edit() / log_action() after committing their own
+change. Events go onto a bounded in-process queue and a background thread
+inserts them in batches (one execute_values INSERT per table and one commit
+per batch), so a clinical write no longer pays an extra round trip and
+commit for its audit row.
+
+Durability:
+  * Pass the caller's cursor to write the event in the caller's own
+    transaction instead - use this for events that must commit atomically
+    with the change they describe (user creation / deletion).
+  * AUDIT_WRITE_MODE=sync makes every queued call write immediately through
+    its own connection, i.e. the behaviour before batching.
+  * Queued events live in memory until flushed (at most AUDIT_FLUSH_INTERVAL
+    seconds). They are flushed on a clean shutdown (atexit and gunicorn's
+    worker_exit) but are lost if the process is killed outright.
+
+Timestamps (edited_at / timestamp) are taken when the event is logged, not
+when its batch is inserted. They are taken in UTC and converted to the
+database session's time zone on insert, so they store the same value as
+NOW() would and sort and partition alongside rows written by the database.
+
+Back-pressure: when the queue is full the caller blocks for up to
+AUDIT_ENQUEUE_TIMEOUT seconds, then writes its event synchronously, so a
+slow database slows requests down rather than dropping audit rows.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from database import get_db_connection
+
+AUDIT_WRITE_MODE = os.environ.get('AUDIT_WRITE_MODE', 'async')  # 'async' or 'sync'
+AUDIT_QUEUE_MAX = int(os.environ.get('AUDIT_QUEUE_MAX', 10000))
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 500))
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 1.0))
+AUDIT_ENQUEUE_TIMEOUT = float(os.environ.get('AUDIT_ENQUEUE_TIMEOUT', 2.0))
+# Seconds to wait between attempts when a batch fails to insert
+AUDIT_RETRY_DELAY = 2.0
+
+EDIT_HISTORY = 'patient_edit_history'
+AUDIT_LOGS = 'audit_logs'
+
+_INSERT_SQL = {
+    EDIT_HISTORY: """INSERT INTO patient_edit_history
+                     (patient_id, uhid, editor_id, field_name, old_value, new_value, edited_at)
+                     VALUES %s""",
+    AUDIT_LOGS: "INSERT INTO audit_logs (user_id, action, details, timestamp) VALUES %s",
+}
+# The columns are TIMESTAMP without time zone, filled by NOW() elsewhere
+_LOCAL_TIME_SQL = "(%s::timestamptz AT TIME ZONE current_setting('TimeZone'))"
+_INSERT_TEMPLATES = {
+    EDIT_HISTORY: f"(%s, %s, %s, %s, %s, %s, {_LOCAL_TIME_SQL})",
+    AUDIT_LOGS: f"(%s, %s, %s, {_LOCAL_TIME_SQL})",
+}
+
+
+def _insert(cursor, table, rows):
+    execute_values(cursor, _INSERT_SQL[table], rows, template=_INSERT_TEMPLATES[table], page_size=AUDIT_BATCH_SIZE)
+
+
+class AuditWriter:
+    def __init__(self, maxsize=AUDIT_QUEUE_MAX, batch_size=AUDIT_BATCH_SIZE, flush_interval=AUDIT_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self.stats = {'enqueued': 0, 'flushed': 0, 'batches': 0, 'sync_writes': 0,
+                      'fallback_writes': 0, 'failed_batches': 0, 'lost': 0}
+
+    def _ensure_thread(self):
+        # Started lazily, and again in each forked gunicorn worker
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, table, row):
+        """Queues one row for `table`; falls back to a synchronous write when the queue stays full."""
+        if AUDIT_WRITE_MODE == 'sync' or self._stopping.is_set():
+            self.stats['sync_writes'] += 1
+            self._write_now(table, [row])
+            return
+        self._ensure_thread()
+        try:
+            self._queue.put((table, row), timeout=AUDIT_ENQUEUE_TIMEOUT)
+            self.stats['enqueued'] += 1
+        except queue.Full:
+            print(f"⚠️ Audit queue full ({self._queue.maxsize}); writing event synchronously.")
+            self.stats['fallback_writes'] += 1
+            self._write_now(table, [row])
+
+    def _write_now(self, table, rows):
+        conn = get_db_connection()
+        if not conn:
+            raise psycopg2.OperationalError("Could not connect to database to write audit event.")
+        try:
+            with conn.cursor() as cursor:
+                _insert(cursor, table, rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _take_batch(self, timeout):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _flush(self, batch):
+        """Inserts a batch, retrying until it succeeds or the writer is stopping."""
+        by_table = {}
+        for table, row in batch:
+            by_table.setdefault(table, []).append(row)
+        while True:
+            conn = get_db_connection()
+            try:
+                if not conn:
+                    raise RuntimeError("no database connection")
+                with conn.cursor() as cursor:
+                    for table, rows in by_table.items():
+                        _insert(cursor, table, rows)
+                conn.commit()
+                self.stats['batches'] += 1
+                self.stats['flushed'] += len(batch)
+                return True
+            except (psycopg2.IntegrityError, psycopg2.DataError) as e:
+                # A row the database will never accept; isolate it instead of retrying
+                conn.rollback()
+                print(f"⚠️ Audit batch rejected ({e}); inserting rows one at a time.")
+                self._flush_rows(conn, batch)
+                return False
+            except Exception as e:
+                if conn:
+                    conn.rollback()
+                self.stats['failed_batches'] += 1
+                print(f"❌ Audit batch of {len(batch)} events failed: {e}")
+                if self._stopping.is_set():
+                    # Last resort: keep the events in the application log
+                    for table, row in batch:
+                        print(f"❌ Lost audit event for {table}: {row}")
+                    self.stats['lost'] += len(batch)
+                    return False
+                time.sleep(AUDIT_RETRY_DELAY)
+            finally:
+                if conn:
+                    conn.close()
+
+    def _flush_rows(self, conn, batch):
+        with conn.cursor() as cursor:
+            for table, row in batch:
+                try:
+                    _insert(cursor, table, [row])
+                    conn.commit()
+                    self.stats['flushed'] += 1
+                except psycopg2.Error as e:
+                    conn.rollback()
+                    print(f"❌ Dropped audit event for {table}: {row} ({e})")
+                    self.stats['lost'] += 1
+
+    def _run(self):
+        while True:
+            batch = self._take_batch(self.flush_interval)
+            if batch:
+                try:
+                    self._flush(batch)
+                except Exception as e:
+                    print(f"❌ Audit writer error: {e}")
+                for _ in batch:
+                    self._queue.task_done()
+            elif self._stopping.is_set():
+                return
+
+    def flush(self, timeout=None):
+        """Blocks until everything queued so far has been written."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        if timeout is None:
+            self._queue.join()
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def shutdown(self, timeout=10):
+        """Drains the queue and stops the background thread."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print(f"⚠️ Audit writer did not drain within {timeout}s; "
+                  f"{self._queue.qsize()} events still queued.")
+
+    def snapshot(self):
+        return dict(self.stats, mode=AUDIT_WRITE_MODE, queued=self._queue.qsize(), maxsize=self._queue.maxsize)
+
+
+_writer = AuditWriter()
+atexit.register(_writer.shutdown)
+
+
+def log_edit(patient_id, uhid, editor_id, field_name, old_value=None, new_value=None, cursor=None):
+    """Records a patient_edit_history row; with `cursor`, inside the caller's transaction."""
+    row = (patient_id, uhid, editor_id, field_name, old_value, new_value, datetime.now(timezone.utc))
+    if cursor is not None:
+        _insert(cursor, EDIT_HISTORY, [row])
+    else:
+        _writer.submit(EDIT_HISTORY, row)
+
+
+def log_action(user_id, action, details, cursor=None):
+    """Records an audit_logs row; with `cursor`, inside the caller's transaction."""
+    row = (user_id, action, details, datetime.now(timezone.utc))
+    if cursor is not None:
+        _insert(cursor, AUDIT_LOGS, [row])
+    else:
+        _writer.submit(AUDIT_LOGS, row)
+
+
+def flush_audit_events(timeout=None):
+    _writer.flush(timeout)
+
+
+def shutdown_audit_writer(timeout=10):
+    _writer.shutdown(timeout)
+
+
+def audit_writer_stats():
+    return _writer.snapshot()
@@ -0,0 +1,325 @@
+"""
+Chunked, resumable data backfills.
+
+A backfill walks a table in primary-key order, one chunk of `batch_size` keys
+at a time. Each chunk is processed and committed together with its checkpoint
+row in backfill_checkpoints, so an interrupted run resumes exactly after the
+last committed chunk. The key range can be split into slices that run in
+separate worker processes.
+
+    python backfill.py list
+    python backfill.py status
+    python backfill.py run uhid_placeholders --batch-size 2000 --workers 4
+    python backfill.py run test_results_json --pause 0.2 --max-rows-per-sec 5000
+"""
+import argparse
+import ast
+import json
+import multiprocessing
+import sys
+import time
+
+import psycopg2
+import psycopg2.extras
+
+from database import open_connection
+
+DEFAULT_BATCH_SIZE = 1000
+# Keep backfill sessions from queueing behind (or blocking) live traffic
+BACKFILL_LOCK_TIMEOUT = '5s'
+BACKFILL_STATEMENT_TIMEOUT = '60s'
+
+
+class Backfill:
+    """
+    Describes one backfill job.
+
+    Either `update_sql` (a set-based UPDATE using %(lo)s / %(hi)s key bounds)
+    or `process_batch(cursor, rows)` (Python transform over rows read with a
+    server-side cursor; returns the number of rows changed) must be given.
+    """
+
+    def __init__(self, name, table, description='', key='id', columns=None, where=None,
+                 update_sql=None, process_batch=None):
+        if (update_sql is None) == (process_batch is None):
+            raise ValueError("Backfill needs exactly one of update_sql or process_batch")
+        self.name = name
+        self.table = table
+        self.description = description
+        self.key = key
+        self.columns = columns or []
+        self.where = where
+        self.update_sql = update_sql
+        self.process_batch = process_batch
+
+    def key_bounds(self, cursor):
+        cursor.execute(f"SELECT COALESCE(MIN({self.key}), 0), COALESCE(MAX({self.key}), 0) FROM {self.table}")
+        lo, hi = cursor.fetchone()
+        return lo - 1, hi
+
+    def chunk_end(self, cursor, last_key, upper_key, batch_size):
+        """Key that closes the next chunk of at most `batch_size` rows."""
+        cursor.execute(
+            f"""SELECT {self.key} FROM {self.table}
+                WHERE {self.key} > %s AND {self.key} <= %s
+                ORDER BY {self.key} OFFSET %s LIMIT 1""",
+            (last_key, upper_key, batch_size - 1)
+        )
+        row = cursor.fetchone()
+        return row[0] if row else upper_key
+
+    def run_chunk(self, conn, lo, hi, chunk_no):
+        """Processes keys in (lo, hi]. Returns (rows_scanned, rows_changed)."""
+        if self.update_sql is not None:
+            with conn.cursor() as cursor:
+                cursor.execute(self.update_sql, {'lo': lo, 'hi': hi})
+                changed = cursor.rowcount
+                cursor.execute(f"SELECT COUNT(*) FROM {self.table} WHERE {self.key} > %s AND {self.key} <= %s", (lo, hi))
+                return cursor.fetchone()[0], changed
+
+        cols = ', '.join([self.key] + self.columns)
+        where = f" AND ({self.where})" if self.where else ''
+        # Named (server-side) cursor: rows stream in itersize pieces instead of
+        # being materialised client-side all at once.
+        reader = conn.cursor(name=f"backfill_{self.name}_{chunk_no}")
+        reader.itersize = 500
+        try:
+            reader.execute(
+                f"""SELECT {cols} FROM {self.table}
+                    WHERE {self.key} > %s AND {self.key} <= %s{where}
+                    ORDER BY {self.key}""",
+                (lo, hi)
+            )
+            rows = reader.fetchall()
+        finally:
+            reader.close()
+        if not rows:
+            return 0, 0
+        with conn.cursor() as cursor:
+            changed = self.process_batch(cursor, rows)
+        return len(rows), changed or 0
+
+
+# --- Checkpoints ---
+
+def _load_checkpoints(conn, job_name):
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+        cursor.execute(
+            "SELECT * FROM backfill_checkpoints WHERE job_name = %s ORDER BY slice_no", (job_name,)
+        )
+        rows = [dict(r) for r in cursor.fetchall()]
+    conn.commit()
+    return rows
+
+
+def _plan_slices(conn, job, workers, restart):
+    """Returns the list of checkpoint rows to run, creating them if needed."""
+    existing = _load_checkpoints(conn, job.name)
+    if existing and restart:
+        with conn.cursor() as cursor:
+            cursor.execute("DELETE FROM backfill_checkpoints WHERE job_name = %s", (job.name,))
+        conn.commit()
+        existing = []
+    if existing:
+        if existing[0]['slice_count'] != workers and any(r['completed_at'] is None for r in existing):
+            raise RuntimeError(
+                f"Backfill '{job.name}' was started with {existing[0]['slice_count']} workers; "
+                f"resume with --workers {existing[0]['slice_count']} or pass --restart.")
+        return existing
+
+    with conn.cursor() as cursor:
+        lower, upper = job.key_bounds(cursor)
+        span = max(upper - lower, 0)
+        step = span // workers + 1
+        for slice_no in range(workers):
+            lo = lower + slice_no * step
+            hi = min(lo + step, upper)
+            cursor.execute(
+                """INSERT INTO backfill_checkpoints
+                       (job_name, slice_no, slice_count, lower_key, upper_key, last_key)
+                   VALUES (%s, %s, %s, %s, %s, %s)""",
+                (job.name, slice_no, workers, lo, hi, lo)
+            )
+    conn.commit()
+    return _load_checkpoints(conn, job.name)
+
+
+def _run_slice(job_name, slice_no, batch_size, pause_s, max_rows_per_s):
+    """Worker entry point: processes one slice until done, committing per chunk."""
+    job = BACKFILLS[job_name]
+    conn = open_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(f"SET lock_timeout = '{BACKFILL_LOCK_TIMEOUT}'")
+            cursor.execute(f"SET statement_timeout = '{BACKFILL_STATEMENT_TIMEOUT}'")
+        conn.commit()
+
+        checkpoint = next(r for r in _load_checkpoints(conn, job_name) if r['slice_no'] == slice_no)
+        last_key, upper_key = checkpoint['last_key'], checkpoint['upper_key']
+        scanned_total, changed_total = checkpoint['rows_scanned'], checkpoint['rows_changed']
+        chunk_no = 0
+
+        while last_key < upper_key:
+            started = time.monotonic()
+            with conn.cursor() as cursor:
+                hi = job.chunk_end(cursor, last_key, upper_key, batch_size)
+            scanned, changed = job.run_chunk(conn, last_key, hi, chunk_no)
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """UPDATE backfill_checkpoints
+                       SET last_key = %s, rows_scanned = rows_scanned + %s,
+                           rows_changed = rows_changed + %s, updated_at = NOW()
+                       WHERE job_name = %s AND slice_no = %s""",
+                    (hi, scanned, changed, job_name, slice_no)
+                )
+            # Chunk changes and checkpoint commit atomically
+            conn.commit()
+            last_key = hi
+            scanned_total += scanned
+            changed_total += changed
+            chunk_no += 1
+            print(f"[{job_name}#{slice_no}] up to {job.key}={hi}: "
+                  f"{scanned_total} scanned, {changed_total} changed")
+
+            elapsed = time.monotonic() - started
+            delay = pause_s
+            if max_rows_per_s and scanned:
+                delay = max(delay, scanned / max_rows_per_s - elapsed)
+            if delay > 0:
+                time.sleep(delay)
+
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """UPDATE backfill_checkpoints SET completed_at = NOW(), updated_at = NOW()
+                   WHERE job_name = %s AND slice_no = %s AND completed_at IS NULL""",
+                (job_name, slice_no)
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def run_backfill(job_name, batch_size=DEFAULT_BATCH_SIZE, workers=1, pause_s=0.0,
+                 max_rows_per_s=None, restart=False):
+    """Runs (or resumes) a backfill, fanning slices out across worker processes."""
+    if job_name not in BACKFILLS:
+        raise KeyError(f"Unknown backfill '{job_name}'. Known: {', '.join(sorted(BACKFILLS))}")
+    job = BACKFILLS[job_name]
+
+    conn = open_connection()
+    try:
+        slices = _plan_slices(conn, job, workers, restart)
+    finally:
+        conn.close()
+    pending = [r['slice_no'] for r in slices if r['completed_at'] is None]
+    if not pending:
+        print(f"✅ Backfill '{job_name}' already complete. Use --restart to run it again.")
+        return True
+
+    print(f"Running backfill '{job_name}' on {job.table}: {len(pending)} slice(s) pending.")
+    # Each worker gets its rate share so the total stays under max_rows_per_s
+    per_worker_rate = max_rows_per_s / len(pending) if max_rows_per_s else None
+    args = (batch_size, pause_s, per_worker_rate)
+    if len(pending) == 1:
+        _run_slice(job_name, pending[0], *args)
+        ok = True
+    else:
+        procs = [multiprocessing.Process(target=_run_slice, args=(job_name, s) + args) for s in pending]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        ok = all(p.exitcode == 0 for p in procs)
+    print(("✅ " if ok else "❌ ") + f"Backfill '{job_name}' " + ("finished." if ok else "stopped; rerun to resume."))
+    return ok
+
+
+def print_status():
+    conn = open_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """SELECT job_name, COUNT(*), COUNT(completed_at), SUM(rows_scanned), SUM(rows_changed),
+                          MAX(updated_at)
+                   FROM backfill_checkpoints GROUP BY job_name ORDER BY job_name"""
+            )
+            rows = cursor.fetchall()
+    finally:
+        conn.close()
+    if not rows:
+        print("No backfills have been started.")
+    for name, slices, done, scanned, changed, updated in rows:
+        state = "complete" if done == slices else f"{done}/{slices} slices done"
+        print(f"{name:<24} {state:<20} scanned={scanned} changed={changed} last update={updated}")
+
+
+# --- Backfill definitions ---
+
+def _convert_test_results(cursor, rows):
+    """Rewrites legacy Python-repr test_results strings as real JSON objects."""
+    updates = []
+    for record_id, raw in rows:
+        if isinstance(raw, dict):
+            continue
+        try:
+            updates.append((record_id, json.dumps(ast.literal_eval(raw))))
+        except (ValueError, SyntaxError) as e:
+            print(f"Could not parse record {record_id}. Data is likely not a dictionary. Error: {e}")
+    if updates:
+        psycopg2.extras.execute_values(
+            cursor,
+            """UPDATE patient_medical_records AS pmr SET test_results = v.data::jsonb
+               FROM (VALUES %s) AS v(id, data) WHERE pmr.id = v.id""",
+            updates
+        )
+    return len(updates)
+
+
+BACKFILLS = {job.name: job for job in [
+    Backfill(
+        'uhid_placeholders', 'patients',
+        description="Give legacy patients without a UHID a TEMP-UHID-<mrn> placeholder.",
+        update_sql="""UPDATE patients SET uhid = 'TEMP-UHID-' || mrn
+                      WHERE id > %(lo)s AND id <= %(hi)s AND (uhid IS NULL OR uhid = '')""",
+    ),
+    Backfill(
+        'test_results_json', 'patient_medical_records',
+        description="Convert legacy string test_results into JSON objects.",
+        columns=['test_results'],
+        where="test_results IS NOT NULL",
+        process_batch=_convert_test_results,
+    ),
+]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run resumable, chunked data backfills.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help="list available backfills")
+    sub.add_parser('status', help="show progress of started backfills")
+    run_cmd = sub.add_parser('run', help="run or resume a backfill")
+    run_cmd.add_argument('name', choices=sorted(BACKFILLS))
+    run_cmd.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    run_cmd.add_argument('--workers', type=int, default=1, help="parallel worker processes")
+    run_cmd.add_argument('--pause', type=float, default=0.0, help="seconds to sleep between chunks")
+    run_cmd.add_argument('--max-rows-per-sec', type=float, help="overall scan rate cap")
+    run_cmd.add_argument('--restart', action='store_true', help="discard checkpoints and start over")
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        for job in BACKFILLS.values():
+            print(f"{job.name:<24} {job.table:<26} {job.description}")
+        return 0
+    if args.command == 'status':
+        print_status()
+        return 0
+    ok = run_backfill(args.name, args.batch_size, max(args.workers, 1), args.pause,
+                      args.max_rows_per_sec, args.restart)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""
+Content-addressed storage for downloaded DICOMs and lab reports.
+
+Files are stored by the SHA-256 of their content, sharded two levels deep
+so no directory grows past a few hundred entries:
+
+    downloads/blobs/3f/a2/3fa2...e9
+
+Identical content (the same study downloaded twice, a report fetched
+again) is written once. Pages keep linking to files by a logical name
+(e.g. UH123_SCAN42.dcm); the blob_refs table (migration 0013) maps each name
+to its content along with the uhid, the scan / order id and the kind, and
+blobs records size and MIME type.
+
+A file is first written to downloads/blobs/tmp while its hash is computed,
+then linked into place before the index rows are committed, so a name a
+reader can look up always has its file and readers never see a partial
+one. The temporary copy is kept until the commit: if a concurrent gc
+removed the same content in the meantime, it is put back from there.
+
+    python blob_store.py import [downloads]   # move old flat files into the store
+    python blob_store.py gc                   # delete content no name points to
+    python blob_store.py stats
+"""
+import argparse
+import hashlib
+import mimetypes
+import os
+import sys
+import tempfile
+
+from database import db_connection
+
+BLOB_STORE_DIR = os.environ.get('BLOB_STORE_DIR', os.path.join('downloads', 'blobs'))
+BLOB_CHUNK_SIZE = 64 * 1024
+
+_REF_COLUMNS = "r.name, r.sha256, r.kind, r.uhid, r.source_id, b.size, b.mime, r.created_at"
+# Files in downloads/ that are not downloads
+_NOT_BLOBS = ('order_history.json', 'lab_orders.sqlite3')
+
+
+def blob_path(sha256):
+    """Where the content with this hash is stored."""
+    return os.path.join(BLOB_STORE_DIR, sha256[:2], sha256[2:4], sha256)
+
+
+def _to_ref(row):
+    name, sha256, kind, uhid, source_id, size, mime, created_at = row
+    return {
+        'name': name,
+        'sha256': sha256,
+        'kind': kind,
+        'uhid': uhid,
+        'source_id': source_id,
+        'size': size,
+        'mime': mime,
+        'created_at': created_at.isoformat() if created_at else None,
+        'path': blob_path(sha256),
+    }
+
+
+def store_blob(chunks, name, kind, mime, uhid=None, source_id=None):
+    """
+    Stores the bytes from the iterable `chunks` under the logical `name`
+    (replacing what the name pointed to before) and returns their SHA-256.
+    `name` may also be a function of the SHA-256, for content that has no
+    stable name of its own.
+    """
+    tmp_dir = os.path.join(BLOB_STORE_DIR, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                if chunk:
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        sha256 = digest.hexdigest()
+        if callable(name):
+            name = name(sha256)
+
+        path = blob_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+
+        with db_connection() as conn:
+            if not conn:
+                raise RuntimeError("Could not connect to database to store file.")
+            with conn.cursor() as cursor:
+                # Waits for a concurrent gc deleting this content, then re-creates it
+                cursor.execute(
+                    """INSERT INTO blobs (sha256, size, mime) VALUES (%s, %s, %s)
+                       ON CONFLICT (sha256) DO UPDATE SET last_stored_at = NOW()""",
+                    (sha256, size, mime)
+                )
+                cursor.execute(
+                    """INSERT INTO blob_refs (name, sha256, kind, uhid, source_id) VALUES (%s, %s, %s, %s, %s)
+                       ON CONFLICT (name) DO UPDATE
+                       SET sha256 = EXCLUDED.sha256, kind = EXCLUDED.kind, uhid = EXCLUDED.uhid,
+                           source_id = EXCLUDED.source_id, updated_at = NOW()""",
+                    (name, sha256, kind, uhid, source_id)
+                )
+            conn.commit()
+
+        if os.path.exists(path):
+            os.remove(tmp_path)
+        else:
+            # A gc deleted this content between the link and the commit
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        return sha256
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def store_file(path, name=None, kind=None, mime=None, uhid=None, source_id=None):
+    """Stores an existing file; the logical name defaults to its file name."""
+    name = name or os.path.basename(path)
+    mime = mime or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    kind = kind or ('dicom' if name.lower().endswith('.dcm') else 'lab_report')
+    with open(path, 'rb') as f:
+        return store_blob(iter(lambda: f.read(BLOB_CHUNK_SIZE), b''), name, kind, mime, uhid, source_id)
+
+
+def find_blob(name):
+    """The stored file for a logical name as a dict (with its 'path'), or None."""
+    with db_connection() as conn:
+        if not conn:
+            raise RuntimeError("Could not connect to database to look up file.")
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {_REF_COLUMNS} FROM blob_refs r JOIN blobs b ON b.sha256 = r.sha256 WHERE r.name = %s",
+                (name,)
+            )
+            row = cursor.fetchone()
+    return _to_ref(row) if row else None
+
+
+def list_blobs(uhid, kind=None):
+    """A patient's stored files, newest first."""
+    query = f"SELECT {_REF_COLUMNS} FROM blob_refs r JOIN blobs b ON b.sha256 = r.sha256 WHERE r.uhid = %s"
+    params = [uhid]
+    if kind:
+        query += " AND r.kind = %s"
+        params.append(kind)
+    query += " ORDER BY r.created_at DESC"
+    with db_connection() as conn:
+        if not conn:
+            return []
+        with conn.cursor() as cursor:
+            cursor.execute(query, params)
+            return [_to_ref(row) for row in cursor.fetchall()]
+
+
+def collect_garbage():
+    """Deletes content that no logical name points to. Returns the number of files removed."""
+    with db_connection() as conn:
+        if not conn:
+            raise RuntimeError("Could not connect to database to collect garbage.")
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """DELETE FROM blobs b
+                   WHERE NOT EXISTS (SELECT 1 FROM blob_refs r WHERE r.sha256 = b.sha256)
+                   RETURNING sha256"""
+            )
+            orphans = [row[0] for row in cursor.fetchall()]
+            # Removed before the commit: a store_blob() of the same content
+            # waits for it, then finds its file gone and puts its copy back
+            for sha256 in orphans:
+                try:
+                    os.remove(blob_path(sha256))
+                except FileNotFoundError:
+                    pass
+        conn.commit()
+    print(f"✅ Removed {len(orphans)} unreferenced files.")
+    return len(orphans)
+
+
+def import_downloads(directory='downloads'):
+    """Moves the files that used to be saved flat in `directory` into the store, keeping their names."""
+    imported = 0
+    for fname in sorted(os.listdir(directory)):
+        path = os.path.join(directory, fname)
+        if fname in _NOT_BLOBS or not os.path.isfile(path) or not fname.lower().endswith(('.dcm', '.json')):
+            continue
+        store_file(path)
+        os.remove(path)
+        imported += 1
+    print(f"✅ Imported {imported} files from {directory} into {BLOB_STORE_DIR}.")
+    return imported
+
+
+def blob_store_stats():
+    with db_connection() as conn:
+        if not conn:
+            raise RuntimeError("Could not connect to database to read file store stats.")
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs")
+            blobs, stored_bytes = cursor.fetchone()
+            cursor.execute("SELECT COUNT(*), COALESCE(SUM(b.size), 0) FROM blob_refs r JOIN blobs b ON b.sha256 = r.sha256")
+            names, named_bytes = cursor.fetchone()
+    return {'names': names, 'blobs': blobs, 'stored_bytes': int(stored_bytes), 'named_bytes': int(named_bytes),
+            'saved_bytes': int(named_bytes - stored_bytes)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage stored DICOMs and lab reports.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    imp = sub.add_parser('import', help="Move flat files from downloads/ into the store")
+    imp.add_argument('directory', nargs='?', default='downloads')
+    sub.add_parser('gc', help="Delete content no name points to")
+    sub.add_parser('stats', help="Show stored and deduplicated sizes")
+    args = parser.parse_args(argv)
+
+    if args.command == 'import':
+        import_downloads(args.directory)
+    elif args.command == 'gc':
+        collect_garbage()
+    elif args.command == 'stats':
+        for key, value in blob_store_stats().items():
+            print(f"{key:<13} {value}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""
+Reports missing, invalid and unused indexes.
+
+Expected indexes are every CREATE INDEX declared in ./migrations. Usage
+counters come from pg_stat_user_indexes, which accumulate since the last
+statistics reset, so let the app serve real traffic before trusting the
+"unused" list.
+"""
+import re
+import sys
+
+from database import get_db_connection
+from migrate import discover_migrations
+
+_CREATE_INDEX_RE = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?(\w+)',
+    re.IGNORECASE
+)
+# Tables where more than this many rows were read by sequential scans are
+# flagged as likely missing an index.
+SEQ_SCAN_ROWS_WARNING = 1_000_000
+
+
+def expected_indexes():
+    """Returns {index_name: migration} for indexes declared in SQL migrations."""
+    found = {}
+    for mig in discover_migrations():
+        if mig.kind != 'sql':
+            continue
+        for name in _CREATE_INDEX_RE.findall(mig.source.decode('utf-8')):
+            found[name.lower()] = f"{mig.version:04d}_{mig.name}"
+    return found
+
+
+def check_indexes():
+    conn = get_db_connection()
+    if not conn:
+        print("Failed to connect")
+        return 2
+
+    problems = 0
+    try:
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            SELECT c.relname, i.indisvalid
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = current_schema()
+        """)
+        present = {name: valid for name, valid in cursor.fetchall()}
+
+        print("== Expected indexes ==")
+        for name, migration in sorted(expected_indexes().items()):
+            if name not in present:
+                print(f"❌ missing  {name} (from {migration})")
+                problems += 1
+            elif not present[name]:
+                print(f"❌ INVALID  {name} (from {migration}) - drop it and rerun the migration")
+                problems += 1
+            else:
+                print(f"✅ present  {name}")
+
+        # Per-partition copies of a partitioned index (e.g. patient_edit_history's
+        # monthly partitions) are skipped; pruning leaves most of them idle.
+        print("\n== Unused indexes (idx_scan = 0, excluding primary keys, unique constraints and partitions) ==")
+        cursor.execute("""
+            SELECT s.relname, s.indexrelname, pg_size_pretty(pg_relation_size(s.indexrelid))
+            FROM pg_stat_user_indexes s
+            JOIN pg_index i ON i.indexrelid = s.indexrelid
+            JOIN pg_class ic ON ic.oid = s.indexrelid
+            WHERE s.idx_scan = 0 AND NOT i.indisprimary AND NOT i.indisunique AND NOT ic.relispartition
+            ORDER BY pg_relation_size(s.indexrelid) DESC
+        """)
+        unused = cursor.fetchall()
+        for table, index, size in unused:
+            print(f"⚠️ {table}.{index} ({size}) has never been used")
+        if not unused:
+            print("None.")
+
+        print("\n== Tables read mostly by sequential scans ==")
+        cursor.execute("""
+            SELECT relname, seq_scan, seq_tup_read, COALESCE(idx_scan, 0), n_live_tup
+            FROM pg_stat_user_tables
+            WHERE seq_tup_read > %s AND seq_scan > COALESCE(idx_scan, 0)
+            ORDER BY seq_tup_read DESC
+        """, (SEQ_SCAN_ROWS_WARNING,))
+        heavy = cursor.fetchall()
+        for table, seq_scan, seq_rows, idx_scan, live in heavy:
+            print(f"⚠️ {table}: {seq_scan} seq scans read {seq_rows} rows "
+                  f"(idx scans: {idx_scan}, live rows: {live}) - possible missing index")
+        if not heavy:
+            print("None.")
+        cursor.close()
+    finally:
+        conn.close()
+
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(check_indexes())
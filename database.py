@@ -1,388 +1,254 @@
-import psycopg2
-import psycopg2.extras # Needed for DictCursor in app.py
-from werkzeug.security import generate_password_hash
-import uuid 
-import os 
-# This reads the secret URL you put in the Render Dashboard
-DATABASE_URL = os.environ.get('DATABASE_URL')
-def get_db_connection():
-    try:
-        if DATABASE_URL:
-            # Use this on Render
-            return psycopg2.connect(DATABASE_URL)
-        else:
-            # Use this for local testing on your Mac
-            return psycopg2.connect(
-                host="localhost",
-                database="postgres",
-                user="postgres",
-                password="karthi"
-            )
-    except Exception as e:
-        print(f"Connection failed: {e}")
-        return None
-
-def ensure_uhid_column():
-    """Adds the uhid column to the patients table if it does not exist."""
-    conn = get_db_connection()
-    if not conn:
-        return
-
-    try:
-        cursor = conn.cursor()
-        print("Checking for missing 'uhid' column in patients table...")
-
-        # Use PostgreSQL's DO block to safely check and add the column
-        cursor.execute("""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1 FROM information_schema.columns 
-                    WHERE table_name='patients' AND column_name='uhid'
-                ) THEN
-                    ALTER TABLE patients ADD COLUMN uhid VARCHAR(50) UNIQUE;
-                    -- After adding, update existing records to have a placeholder value
-                    UPDATE patients SET uhid = 'TEMP-UHID-' || mrn WHERE uhid IS NULL OR uhid = '';
-                    CREATE UNIQUE INDEX IF NOT EXISTS idx_patients_uhid ON patients(uhid);
-                    RAISE NOTICE 'Added and populated UHID column to patients table.';
-                ELSE
-                    -- If the column exists, ensure existing NULLs are updated to allow redirection
-                    UPDATE patients SET uhid = 'TEMP-UHID-' || mrn WHERE uhid IS NULL OR uhid = '';
-                    RAISE NOTICE 'UHID column already exists, ensuring no NULL values.';
-                END IF;
-            END$$;
-        """)
-        conn.commit()
-        print("✅ UHID column check and data population complete.")
-    except Exception as e:
-        print(f"❌ Error ensuring UHID column: {e}")
-        if conn: conn.rollback()
-    finally:
-        if conn:
-            if 'cursor' in locals(): cursor.close()
-            conn.close()
-
-def ensure_prescription_columns():
-    """
-    Adds necessary prescription-related columns to the patient_prescriptions table.
-    This is vital for existing installations.
-    """
-    conn = get_db_connection()
-    if not conn:
-        return
-    
-    # Define columns to be added: (column_name, data_type)
-    columns_to_add = [
-        ('lens_type', 'VARCHAR(100)'),
-        ('systemic_medication', 'TEXT'),
-        ('iol_notes', 'TEXT'),
-        ('patient_instructions', 'TEXT'),
-        ('follow_up_date', 'DATE'),
-    ]
-
-    try:
-        cursor = conn.cursor()
-        print("Checking for missing columns in patient_prescriptions table...")
-
-        for col_name, col_type in columns_to_add:
-            print(f"Checking for column: {col_name}...")
-            # Use PostgreSQL's DO block for safe, idempotent column addition
-            cursor.execute(f"""
-                DO $$
-                BEGIN
-                    IF NOT EXISTS (
-                        SELECT 1 FROM information_schema.columns 
-                        WHERE table_name='patient_prescriptions' AND column_name='{col_name}'
-                    ) THEN
-                        ALTER TABLE patient_prescriptions ADD COLUMN {col_name} {col_type};
-                        RAISE NOTICE 'Added column {col_name} to patient_prescriptions.';
-                    END IF;
-                END$$;
-            """)
-        
-        conn.commit()
-        print("✅ Prescription column checks and additions complete.")
-
-    except Exception as e:
-        print(f"❌ Error ensuring prescription columns: {e}")
-        if conn: conn.rollback()
-    finally:
-        if conn:
-            if 'cursor' in locals(): cursor.close()
-            conn.close()
-
-
-
-def ensure_columns():
-    """Consolidated function to ensure all required columns exist."""
-    print("Ensuring all required database columns...")
-    ensure_uhid_column()
-    ensure_prescription_columns()
-    
-    # Also ensure prescription_details in patient_medical_records as expected by app.py startup
-    conn = get_db_connection()
-    if not conn:
-        return
-
-    try:
-        cursor = conn.cursor()
-        print("Checking for missing 'prescription_details' column in patient_medical_records table...")
-        cursor.execute("""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1 FROM information_schema.columns 
-                    WHERE table_name='patient_medical_records' AND column_name='prescription_details'
-                ) THEN
-                    ALTER TABLE patient_medical_records ADD COLUMN prescription_details JSONB;
-                    RAISE NOTICE 'Added prescription_details column to patient_medical_records.';
-                END IF;
-            END$$;
-        """)
-        print("Checking for missing 'uhid' column in patient_edit_history table...")
-        cursor.execute("""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1 FROM information_schema.columns 
-                    WHERE table_name='patient_edit_history' AND column_name='uhid'
-                ) THEN
-                    ALTER TABLE patient_edit_history ADD COLUMN uhid VARCHAR(50);
-                    RAISE NOTICE 'Added uhid column to patient_edit_history.';
-                END IF;
-            END$$;
-        """)
-        print("Checking for missing 'uhid' column in patient_edit_history table...")
-        cursor.execute("""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1 FROM information_schema.columns 
-                    WHERE table_name='patient_edit_history' AND column_name='uhid'
-                ) THEN
-                    ALTER TABLE patient_edit_history ADD COLUMN uhid VARCHAR(50);
-                END IF;
-            END$$;
-        """)
-
-        print("Checking for missing columns in patient_medical_records table...")
-        cursor.execute("""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='patient_medical_records' AND column_name='uhid') THEN
-                    ALTER TABLE patient_medical_records ADD COLUMN uhid VARCHAR(50);
-                END IF;
-                IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='patient_medical_records' AND column_name='created_by') THEN
-                    ALTER TABLE patient_medical_records ADD COLUMN created_by INTEGER;
-                END IF;
-                IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='patient_medical_records' AND column_name='created_at') THEN
-                    ALTER TABLE patient_medical_records ADD COLUMN created_at TIMESTAMP DEFAULT NOW();
-                END IF;
-                IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='patient_medical_records' AND column_name='updated_at') THEN
-                    ALTER TABLE patient_medical_records ADD COLUMN updated_at TIMESTAMP DEFAULT NOW();
-                END IF;
-                IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='patients' AND column_name='created_at') THEN
-                    ALTER TABLE patients ADD COLUMN created_at TIMESTAMP DEFAULT NOW();
-                END IF;
-                IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='patients' AND column_name='updated_at') THEN
-                    ALTER TABLE patients ADD COLUMN updated_at TIMESTAMP DEFAULT NOW();
-                END IF;
-            END$$;
-        """)
-
-        print("Checking for missing columns in patient_prescriptions table...")
-        cursor.execute("""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='patient_prescriptions' AND column_name='uhid') THEN
-                    ALTER TABLE patient_prescriptions ADD COLUMN uhid VARCHAR(50);
-                END IF;
-                IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='patient_prescriptions' AND column_name='visit_date') THEN
-                    ALTER TABLE patient_prescriptions ADD COLUMN visit_date TIMESTAMP;
-                END IF;
-            END$$;
-        """)
-
-        print("Making MRN column nullable in patients table...")
-        cursor.execute("ALTER TABLE patients ALTER COLUMN mrn DROP NOT NULL;")
-
-        print("Checking for missing 'created_at' column in users table...")
-        cursor.execute("""
-            DO $$
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1 FROM information_schema.columns 
-                    WHERE table_name='users' AND column_name='created_at'
-                ) THEN
-                    ALTER TABLE users ADD COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
-                    RAISE NOTICE 'Added created_at column to users table.';
-                END IF;
-            END$$;
-        """)
-
-        conn.commit()
-        print("✅ Consolidated column checks complete.")
-    except Exception as e:
-        print(f"❌ Error in ensure_columns: {e}")
-        if conn: conn.rollback()
-    finally:
-        if conn:
-            if 'cursor' in locals(): cursor.close()
-            conn.close()
-
-
-def create_tables():
-    """Connects to the database and creates necessary tables."""
-    conn = get_db_connection()
-    if not conn:
-        return
-
-    try:
-        cursor = conn.cursor()
-
-        # Users table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(100) UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                role VARCHAR(50) NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        print("Table 'users' ensured.")
-
-        # Patients table
-        # IS THE FALLBACK FOR EXISTING DATABASES***)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS patients (
-                id SERIAL PRIMARY KEY,
-                mrn VARCHAR(20) UNIQUE, -- Changed to nullable to match app.py logic
-                uhid VARCHAR(50) UNIQUE, -- Defined here for NEW installations
-                first_name VARCHAR(100) NOT NULL,
-                last_name VARCHAR(100) NOT NULL,
-                dob DATE,
-                gender VARCHAR(10),
-                address TEXT,
-                phone VARCHAR(20),
-                email VARCHAR(100),
-                created_at TIMESTAMP DEFAULT NOW(),
-                updated_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
-        print("Table 'patients' ensured.")
-        
-        # Patient Medical Records table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS patient_medical_records (
-                id SERIAL PRIMARY KEY,
-                patient_id INTEGER REFERENCES patients(id) ON DELETE CASCADE,
-                uhid VARCHAR(50), -- Added to support lookups as expected by app.py
-                visit_date TIMESTAMP NOT NULL DEFAULT NOW(),
-                diagnosis TEXT NOT NULL,
-                treatment TEXT,
-                test_results JSONB,
-                prescribed_drops JSONB,
-                prescribed_medication JSONB,
-                surgery_recommendation TEXT,
-                risk_assessment_score INTEGER,
-                risk_assessment_category VARCHAR(50),
-                risk_assessment_implication TEXT,
-                prescription_details JSONB,
-                created_by INTEGER,
-                created_at TIMESTAMP DEFAULT NOW(),
-                updated_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
-        print("Table 'patient_medical_records' ensured.")
-
-        # Audit Logs table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS audit_logs (
-                id SERIAL PRIMARY KEY,
-                timestamp TIMESTAMP DEFAULT NOW(),
-                user_id INTEGER, 
-                action TEXT NOT NULL,
-                details TEXT
-            );
-        """)
-        print("Table 'audit_logs' ensured.")
-
-        # Patient Edit History table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS patient_edit_history (
-                id SERIAL PRIMARY KEY,
-                patient_id INTEGER REFERENCES patients(id) ON DELETE CASCADE,
-                uhid VARCHAR(50), -- Added to support system logs as expected by app.py
-                editor_id INTEGER NOT NULL, 
-                field_name VARCHAR(100) NOT NULL,
-                old_value TEXT,
-                new_value TEXT,
-                edited_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
-        print("Table 'patient_edit_history' ensured.")
-
-        # Patient Prescriptions table (Updated to include all form fields)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS patient_prescriptions (
-                id SERIAL PRIMARY KEY,
-                patient_id INTEGER NOT NULL REFERENCES patients(id) ON DELETE CASCADE,
-                medical_record_id INTEGER REFERENCES patient_medical_records(id) ON DELETE CASCADE,
-                uhid VARCHAR(50), -- Added as expected by app.py
-                
-                -- Refraction/Spectacle Data
-                spectacle_lens JSONB,
-                lens_type VARCHAR(100),          -- NEW
-                
-                -- Medication Data
-                drops JSONB,
-                medications JSONB,
-
-                -- Notes and Follow-up
-                systemic_medication TEXT,        -- NEW
-                surgery_recommendation TEXT,
-                iol_notes TEXT,                  -- NEW
-                patient_instructions TEXT,       -- NEW
-                follow_up_date DATE,             -- NEW
-                visit_date TIMESTAMP,            -- NEW
-                
-                created_by INTEGER, 
-                created_at TIMESTAMP DEFAULT NOW(),
-                updated_at TIMESTAMP DEFAULT NOW()
-            );
-        """)
-        print("✅ patient_prescriptions table verified/created with full schema.")
-
-        # Insert a default admin user if not exists
-        admin_username = "admin"
-        admin_password_hash = generate_password_hash("adminpass", method='pbkdf2:sha256')
-        cursor.execute("SELECT COUNT(*) FROM users WHERE username = %s", (admin_username,))
-        if cursor.fetchone()[0] == 0:
-            cursor.execute(
-                "INSERT INTO users (username, password_hash, role) VALUES (%s, %s, %s)",
-                (admin_username, admin_password_hash, 'admin')
-            )
-            print(f"Default admin user '{admin_username}' created.")
-        
-        conn.commit()
-        print("Database tables created/ensured successfully!")
-
-    except psycopg2.Error as e:
-        print(f"Error creating tables or connecting to database: {e}")
-        if conn:
-            conn.rollback() # Rollback in case of error
-    finally:
-        if conn:
-            if 'cursor' in locals(): cursor.close()
-            conn.close()
-
-
-if __name__ == '__main__':
-    create_tables()
-    ensure_uhid_column()
-    ensure_prescription_columns() # CRITICAL: Ensure existing installations get the new columns
-    ensure_columns()
-
-
-
+import psycopg2
+import psycopg2.extras # Needed for DictCursor in app.py
+import psycopg2.pool
+import uuid 
+import os 
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+# This reads the secret URL you put in the Render Dashboard
+DATABASE_URL = os.environ.get('DATABASE_URL')
+
+# Connection pool sizing (per worker process)
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+# Seconds a request waits for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# Idle connections older than this are pinged before being handed out
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', 30))
+
+
+def open_connection():
+    """Opens a dedicated psycopg2 connection that is not managed by the pool."""
+    if DATABASE_URL:
+        # Use this on Render
+        return psycopg2.connect(DATABASE_URL)
+    else:
+        # Use this for local testing on your Mac
+        return psycopg2.connect(
+            host="localhost",
+            database="postgres",
+            user="postgres",
+            password="karthi"
+        )
+
+
+class PooledConnection:
+    """A checked-out pool connection. close() hands it back to the pool."""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def __getattr__(self, name):
+        if self._raw is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return getattr(self._raw, name)
+
+    @property
+    def closed(self):
+        return 1 if self._raw is None else self._raw.closed
+
+    def close(self):
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool.putconn(raw)
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool owned by a single process."""
+
+    def __init__(self, minconn, maxconn, timeout, ping_after):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.pid = os.getpid()
+        self._idle = deque()  # (raw connection, returned_at)
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self.stats = {
+            'checkouts': 0,
+            'created': 0,
+            'reused': 0,
+            'discarded': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+        }
+        for _ in range(minconn):
+            self._idle.append((self._create(), time.monotonic()))
+
+    def _create(self):
+        raw = open_connection()
+        with self._cond:
+            self.stats['created'] += 1
+        return raw
+
+    def _is_healthy(self, raw, returned_at):
+        if raw.closed:
+            return False
+        if time.monotonic() - returned_at < self.ping_after:
+            return True
+        try:
+            cur = raw.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            raw.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, raw):
+        with self._cond:
+            self.stats['discarded'] += 1
+        try:
+            raw.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """Checks out a healthy connection, waiting up to `timeout` seconds."""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+                if self._idle or self._in_use < self.maxconn:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise psycopg2.pool.PoolError(
+                        f"timed out after {self.timeout}s waiting for a database connection")
+                self._cond.wait(remaining)
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            self.stats['checkouts'] += 1
+            self.stats['wait_time_total'] += time.monotonic() - started
+
+        # Health checks and connects happen outside the lock
+        try:
+            if entry is not None:
+                raw, returned_at = entry
+                if self._is_healthy(raw, returned_at):
+                    with self._cond:
+                        self.stats['reused'] += 1
+                    return raw
+                self._discard(raw)
+            return self._create()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, raw):
+        """Returns a connection to the pool, rolling back any open transaction."""
+        keep = not raw.closed and os.getpid() == self.pid
+        if keep and raw.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                raw.rollback()
+            except psycopg2.Error:
+                keep = False
+        with self._cond:
+            self._in_use -= 1
+            if keep and not self._closed:
+                self._idle.append((raw, time.monotonic()))
+                raw = None
+            self._cond.notify()
+        if raw is not None:
+            self._discard(raw)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._cond.notify_all()
+        for raw, _ in idle:
+            self._discard(raw)
+
+    def snapshot(self):
+        with self._cond:
+            data = dict(self.stats)
+            data.update({
+                'pid': self.pid,
+                'min': self.minconn,
+                'max': self.maxconn,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+            })
+        return data
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Returns this process's pool, creating it lazily (e.g. after a gunicorn fork)."""
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            # Never close connections inherited from the parent process: the
+            # socket is shared and closing it would end the parent's session.
+            _pool = ConnectionPool(DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_PING_AFTER)
+        return _pool
+
+
+def reset_pool():
+    """Drops any pool inherited across fork without touching its sockets."""
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+def close_pool():
+    """Closes every idle connection in this process's pool."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+
+
+def pool_stats():
+    """Returns counters for this process's pool (empty if no pool yet)."""
+    pool = _pool
+    if pool is None or pool.pid != os.getpid():
+        return {}
+    return pool.snapshot()
+
+
+def get_db_connection():
+    try:
+        pool = get_pool()
+        return PooledConnection(pool, pool.getconn())
+    except Exception as e:
+        print(f"Connection failed: {e}")
+        return None
+
+
+@contextmanager
+def db_connection():
+    """Checks a pooled connection out for the duration of a `with` block.
+
+    Yields None when no connection could be obtained, so callers keep the
+    usual `if not conn:` handling.
+    """
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        if conn:
+            conn.close()
+
+if __name__ == '__main__':
+    # Schema changes are versioned in ./migrations; see migrate.py
+    from migrate import apply_migrations
+    apply_migrations()
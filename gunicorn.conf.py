@@ -0,0 +1,26 @@
+# gunicorn.conf.py
+# Picked up automatically when gunicorn is started from the project root.
+import os
+
+import audit_writer
+import database
+
+# Threaded workers: a status stream (Server-Sent Events, status_stream.py)
+# holds one thread for up to SSE_MAX_DURATION instead of a whole worker.
+# At most half of the threads serve streams (SSE_MAX_STREAMS), so page
+# requests always have threads left. Requests that need the database still
+# share the worker's DB_POOL_MAX connections.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+
+
+def post_fork(server, worker):
+    # Each worker builds its own connection pool; sockets opened by the
+    # master (e.g. during a --preload import) must not be shared.
+    database.reset_pool()
+
+
+def worker_exit(server, worker):
+    # Write out queued audit events while the pool is still open
+    audit_writer.shutdown_audit_writer()
+    database.close_pool()
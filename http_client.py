@@ -0,0 +1,270 @@
+"""
+Shared HTTP client for calls to the PACS / LIS (DEFAULT_HOST).
+
+Every outbound call goes through one requests.Session per process, so
+connections (and their TLS sessions) are kept alive and reused instead of
+being set up for every status poll. The session is rebuilt in each forked
+gunicorn worker. requests.Session and its urllib3 pools are safe to share
+between threads for this use (no cookies are relied on).
+
+  * HTTP_POOL_HOSTS / HTTP_POOL_SIZE: hosts kept in the pool and the
+    connections kept per host. A thread that finds all of a host's
+    connections busy opens a temporary extra one rather than waiting.
+  * HTTP_CONNECT_TIMEOUT / HTTP_TIMEOUT: default connect and read timeouts.
+    A caller's single `timeout` value is its read timeout; connecting never
+    waits longer than HTTP_CONNECT_TIMEOUT.
+
+Resilience, per endpoint (the `endpoint` name a call site passes, e.g.
+'lis.orders', or the host):
+
+  * Circuit breaker: after BREAKER_FAILURE_THRESHOLD consecutive failures
+    (connection errors, timeouts, 5xx) the breaker opens and calls fail at
+    once with CircuitOpenError instead of waiting on a socket. After
+    BREAKER_RESET_TIMEOUT seconds (with jitter) one probe call is let
+    through (half-open); it closes the breaker on success or re-opens it.
+  * Retries: connection errors and 502/503/504 answers are retried up to
+    HTTP_RETRIES times with exponential backoff and full jitter, for
+    idempotent methods only - a POST is only resent when the connection
+    could not be made at all. Pass retries=0 to a call to turn this off.
+  * Retry budget: each request earns HTTP_RETRY_BUDGET_RATIO of a retry
+    token (up to HTTP_RETRY_BUDGET_MAX); a retry spends one. When the
+    upstream is failing everything, retries stop once the budget is spent
+    instead of multiplying the load.
+
+Breakers and budgets live in each worker process. http_client_stats()
+reports request, retry and connection reuse counters and every breaker's
+state; it is included in /api/health.
+"""
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', 4))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 20))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 30))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 2))
+HTTP_RETRY_BACKOFF = float(os.environ.get('HTTP_RETRY_BACKOFF', 0.5))
+HTTP_RETRY_MAX_DELAY = float(os.environ.get('HTTP_RETRY_MAX_DELAY', 5))
+HTTP_RETRY_BUDGET_RATIO = float(os.environ.get('HTTP_RETRY_BUDGET_RATIO', 0.2))
+HTTP_RETRY_BUDGET_MAX = float(os.environ.get('HTTP_RETRY_BUDGET_MAX', 10))
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of calling an endpoint whose breaker is open."""
+
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"{endpoint} is not responding; not retrying for {retry_after:.0f}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, endpoint, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        # Retry budget for this endpoint
+        self._retry_tokens = HTTP_RETRY_BUDGET_MAX
+        self.stats = {'calls': 0, 'failures': 0, 'rejected': 0, 'opened': 0, 'probes': 0,
+                      'retries': 0, 'retries_denied': 0}
+
+    def before_call(self, retry=False):
+        """Raises CircuitOpenError unless a call may go out now."""
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._open_until - time.monotonic()
+                if remaining > 0:
+                    self.stats['rejected'] += 1
+                    raise CircuitOpenError(self.endpoint, remaining)
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    # One probe at a time; everyone else fails fast until it answers
+                    self.stats['rejected'] += 1
+                    raise CircuitOpenError(self.endpoint, self.reset_timeout)
+                self._probing = True
+                self.stats['probes'] += 1
+            self.stats['calls'] += 1
+            if not retry:
+                self._retry_tokens = min(HTTP_RETRY_BUDGET_MAX, self._retry_tokens + HTTP_RETRY_BUDGET_RATIO)
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                print(f"✅ {self.endpoint} is responding again; circuit closed.")
+            self.state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.stats['failures'] += 1
+            self._failures += 1
+            if self.state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.stats['opened'] += 1
+                    print(f"⚠️ {self.endpoint} failed {self._failures} times in a row; circuit open.")
+                self.state = OPEN
+                # Jitter keeps every worker's probes from arriving together
+                self._open_until = time.monotonic() + self.reset_timeout * random.uniform(0.8, 1.2)
+                self._probing = False
+
+    def take_retry_token(self):
+        with self._lock:
+            if self._retry_tokens >= 1:
+                self._retry_tokens -= 1
+                self.stats['retries'] += 1
+                return True
+            self.stats['retries_denied'] += 1
+            return False
+
+    def snapshot(self):
+        with self._lock:
+            state = self.state
+            if state == OPEN and self._open_until <= time.monotonic():
+                state = HALF_OPEN
+            return dict(self.stats, state=state, consecutive_failures=self._failures,
+                        retry_tokens=round(self._retry_tokens, 1))
+
+
+_session = None
+_session_pid = None
+_breakers = {}
+_lock = threading.Lock()
+_stats = {'requests': 0, 'errors': 0, 'short_circuited': 0}
+
+
+def get_session():
+    """The shared Session for this process."""
+    global _session, _session_pid, _breakers
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            # Sockets opened before a fork must not be shared with the parent
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session_pid = os.getpid()
+            _breakers = {}
+        return _session
+
+
+def get_breaker(endpoint):
+    get_session()
+    with _lock:
+        breaker = _breakers.get(endpoint)
+        if breaker is None:
+            breaker = _breakers[endpoint] = CircuitBreaker(endpoint)
+        return breaker
+
+
+def _timeouts(timeout):
+    if isinstance(timeout, tuple):
+        return timeout
+    return (min(HTTP_CONNECT_TIMEOUT, timeout), timeout)
+
+
+def could_not_connect(error):
+    """True when `error` means the request never reached the server, so even a POST is safe to resend."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def request(method, url, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, endpoint=None, **kwargs):
+    """
+    Sends a request through the shared session; same arguments and return
+    value as requests.request(). Raises CircuitOpenError (a
+    requests.ConnectionError) without calling when `endpoint` is failing.
+    """
+    breaker = get_breaker(endpoint or urlsplit(url).netloc)
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    with _lock:
+        _stats['requests'] += 1
+    attempt = 0
+    while True:
+        try:
+            breaker.before_call(retry=attempt > 0)
+        except CircuitOpenError:
+            with _lock:
+                _stats['short_circuited'] += 1
+            raise
+        error = resp = None
+        try:
+            resp = get_session().request(method, url, timeout=_timeouts(timeout), **kwargs)
+        except requests.RequestException as e:
+            breaker.record_failure()
+            error = e
+            retryable = idempotent or could_not_connect(e)
+        except Exception:
+            # Never leave a half-open breaker waiting on a probe that died
+            breaker.record_failure()
+            raise
+        else:
+            if resp.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            retryable = idempotent and resp.status_code in RETRY_STATUSES
+            if not retryable:
+                return resp
+
+        if attempt >= retries or not retryable or not breaker.take_retry_token():
+            if error is not None:
+                with _lock:
+                    _stats['errors'] += 1
+                raise error
+            return resp
+        if resp is not None:
+            resp.close()
+        attempt += 1
+        # Exponential backoff with full jitter
+        time.sleep(random.uniform(0, min(HTTP_RETRY_MAX_DELAY, HTTP_RETRY_BACKOFF * 2 ** attempt)))
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def http_client_stats():
+    connections = pooled_requests = pools = 0
+    with _lock:
+        session = _session if _session_pid == os.getpid() else None
+        breakers = list(_breakers.values()) if session is not None else []
+    if session is not None:
+        for adapter in set(session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                pools += 1
+                connections += pool.num_connections
+                pooled_requests += pool.num_requests
+    return dict(_stats, pools=pools, connections_opened=connections, pooled_requests=pooled_requests,
+                pool_size=HTTP_POOL_SIZE,
+                reuse_ratio=round(1 - connections / pooled_requests, 3) if pooled_requests else None,
+                breakers={breaker.endpoint: breaker.snapshot() for breaker in breakers})
@@ -0,0 +1,361 @@
+"""
+Postgres-backed background jobs.
+
+Slow work that used to run inside a request (submitting a scan request and
+polling the PACS for up to five minutes, waiting for a lab report) is
+queued in the background_jobs table (migration 0011) and run by a separate
+worker process:
+
+    python jobs.py worker [--threads 4]
+    python jobs.py status JOB_ID
+    python jobs.py purge [--days 7]
+
+The web route calls enqueue_job() and returns the job id at once; the page
+then follows the job through /api/jobs/<job_id>.
+
+A job handler runs one step and either returns the job's result (stored as
+JSON), raises RetryLater to be run again after a delay - how polling jobs
+wait without holding a worker thread - or raises JobFailed to stop. Any
+other exception is retried with exponential backoff up to JOB_MAX_ATTEMPTS
+times.
+
+Workers claim due jobs with SELECT ... FOR UPDATE SKIP LOCKED and commit the
+claim before running the step, so any number of workers can share the
+table. While a step runs its worker refreshes locked_at every
+JOB_HEARTBEAT_INTERVAL seconds; a job whose lock is older than
+JOB_LOCK_TIMEOUT (its worker died) is put back in the queue as a failed
+attempt, and failed once it reaches JOB_MAX_ATTEMPTS.
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from psycopg2.extras import Json
+
+from database import db_connection
+
+JOB_WORKER_THREADS = int(os.environ.get('JOB_WORKER_THREADS', 4))
+JOB_IDLE_SLEEP = float(os.environ.get('JOB_IDLE_SLEEP', 1.0))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+JOB_LOCK_TIMEOUT = int(os.environ.get('JOB_LOCK_TIMEOUT', 300))
+JOB_HEARTBEAT_INTERVAL = JOB_LOCK_TIMEOUT / 3
+JOB_RETENTION_DAYS = int(os.environ.get('JOB_RETENTION_DAYS', 7))
+
+_JOB_COLUMNS = "job_id, kind, payload, status, attempts, polls, result, error, created_at, updated_at, finished_at"
+
+_handlers = {}
+
+
+class RetryLater(Exception):
+    """Raised by a handler to run the job again after `delay` seconds, optionally with an updated payload."""
+
+    def __init__(self, delay, payload=None):
+        super().__init__(f"retry in {delay}s")
+        self.delay = delay
+        self.payload = payload
+
+
+class JobFailed(Exception):
+    """Raised by a handler when the job cannot succeed; it is not retried."""
+
+
+def job_handler(kind):
+    """Registers the decorated function as the handler for jobs of `kind`."""
+    def register(func):
+        _handlers[kind] = func
+        return func
+    return register
+
+
+def enqueue_job(kind, payload, delay=0, unique_key=None):
+    """
+    Queues a job and returns its id. With `unique_key`, a job of the same
+    kind with the same payload[unique_key] that is queued, running or
+    succeeded is returned instead of queueing another.
+    """
+    job_id = uuid.uuid4().hex
+    with db_connection() as conn:
+        if not conn:
+            raise RuntimeError("Could not connect to database to queue job.")
+        with conn.cursor() as cursor:
+            if unique_key is not None:
+                value = str(payload[unique_key])
+                # Serialises concurrent enqueues of the same job until commit
+                cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"{kind}:{unique_key}:{value}",))
+                cursor.execute(
+                    """SELECT job_id FROM background_jobs
+                       WHERE kind = %s AND payload ->> %s = %s AND status <> 'failed'
+                       LIMIT 1""",
+                    (kind, unique_key, value)
+                )
+                existing = cursor.fetchone()
+                if existing:
+                    conn.commit()
+                    return existing[0]
+            cursor.execute(
+                """INSERT INTO background_jobs (job_id, kind, payload, run_after)
+                   VALUES (%s, %s, %s, NOW() + make_interval(secs => %s))""",
+                (job_id, kind, Json(payload), delay)
+            )
+        conn.commit()
+    return job_id
+
+
+def get_job(job_id):
+    """Returns the job as a dict, or None when it does not exist."""
+    with db_connection() as conn:
+        if not conn:
+            raise RuntimeError("Could not connect to database to read job.")
+        with conn.cursor() as cursor:
+            cursor.execute(f"SELECT {_JOB_COLUMNS} FROM background_jobs WHERE job_id = %s", (job_id,))
+            row = cursor.fetchone()
+    if not row:
+        return None
+    job = dict(zip([c.strip() for c in _JOB_COLUMNS.split(',')], row))
+    for key in ('created_at', 'updated_at', 'finished_at'):
+        if job[key] is not None:
+            job[key] = job[key].isoformat()
+    return job
+
+
+def wake_jobs(kind, key, value, payload_updates=None):
+    """
+    Makes queued jobs of `kind` whose payload[key] == value due now, merging
+    `payload_updates` into their payload. Used when a webhook reports the
+    event a polling job is waiting for. Returns the woken job ids.
+    """
+    with db_connection() as conn:
+        if not conn:
+            raise RuntimeError("Could not connect to database to wake jobs.")
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """UPDATE background_jobs
+                   SET run_after = NOW(), payload = payload || %s, updated_at = NOW()
+                   WHERE kind = %s AND status = 'queued' AND payload ->> %s = %s
+                   RETURNING job_id""",
+                (Json(payload_updates or {}), kind, key, str(value))
+            )
+            job_ids = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    return job_ids
+
+
+def _claim(cursor, worker_id):
+    cursor.execute(
+        """UPDATE background_jobs
+           SET status = 'running', locked_by = %s, locked_at = NOW(), updated_at = NOW()
+           WHERE job_id = (
+               SELECT job_id FROM background_jobs
+               WHERE status = 'queued' AND run_after <= NOW()
+               ORDER BY run_after
+               LIMIT 1
+               FOR UPDATE SKIP LOCKED
+           )
+           RETURNING job_id, kind, payload, attempts""",
+        (worker_id,)
+    )
+    return cursor.fetchone()
+
+
+def _requeue_stale(cursor):
+    # A step that kills its worker counts as a failed attempt, so it is not retried forever
+    cursor.execute(
+        """UPDATE background_jobs
+           SET status = CASE WHEN attempts + 1 >= %(max_attempts)s THEN 'failed' ELSE 'queued' END,
+               attempts = attempts + 1, error = 'Worker stopped while running the job',
+               finished_at = CASE WHEN attempts + 1 >= %(max_attempts)s THEN NOW() END,
+               locked_by = NULL, locked_at = NULL, updated_at = NOW()
+           WHERE status = 'running' AND locked_at < NOW() - make_interval(secs => %(timeout)s)
+           RETURNING job_id, status""",
+        {'max_attempts': JOB_MAX_ATTEMPTS, 'timeout': JOB_LOCK_TIMEOUT}
+    )
+    stale = cursor.fetchall()
+    if not stale:
+        return
+    from status_stream import notify_status_change
+    failed = [job_id for job_id, status in stale if status == 'failed']
+    for job_id in failed:
+        notify_status_change('job', job_id, cursor=cursor)
+    print(f"⚠️ Re-queued {len(stale) - len(failed)} and failed {len(failed)} jobs left running by a stopped worker.")
+
+
+def _keep_locked(job_id, worker_id, done):
+    """Refreshes the job's locked_at until `done` is set, so a long step is not taken for a dead worker's."""
+    while not done.wait(JOB_HEARTBEAT_INTERVAL):
+        try:
+            with db_connection() as conn:
+                if not conn:
+                    continue
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        """UPDATE background_jobs SET locked_at = NOW()
+                           WHERE job_id = %s AND locked_by = %s AND status = 'running'""",
+                        (job_id, worker_id)
+                    )
+                conn.commit()
+        except Exception as e:
+            print(f"⚠️ Could not refresh the lock on job {job_id}: {e}")
+
+
+def _finish(cursor, job_id, status, result=None, error=None):
+    # Imported here: status_stream reads jobs through this module
+    from status_stream import notify_status_change
+    notify_status_change('job', job_id, cursor=cursor)
+    cursor.execute(
+        """UPDATE background_jobs
+           SET status = %s, result = %s, error = %s, locked_by = NULL, locked_at = NULL,
+               updated_at = NOW(), finished_at = NOW()
+           WHERE job_id = %s""",
+        (status, Json(result) if result is not None else None, error, job_id)
+    )
+
+
+def _reschedule(cursor, job_id, delay, payload=None, attempts=None, polls=0, error=None):
+    cursor.execute(
+        """UPDATE background_jobs
+           SET status = 'queued', run_after = NOW() + make_interval(secs => %s),
+               payload = COALESCE(%s, payload), attempts = COALESCE(%s, attempts),
+               polls = polls + %s, error = %s, locked_by = NULL, locked_at = NULL, updated_at = NOW()
+           WHERE job_id = %s""",
+        (delay, Json(payload) if payload is not None else None, attempts, polls, error, job_id)
+    )
+
+
+def run_next_job(worker_id):
+    """Claims and runs one step of the next due job. Returns False when nothing was due."""
+    with db_connection() as conn:
+        if not conn:
+            raise RuntimeError("Could not connect to database to claim job.")
+        with conn.cursor() as cursor:
+            _requeue_stale(cursor)
+            claimed = _claim(cursor, worker_id)
+        conn.commit()
+    if not claimed:
+        return False
+
+    job_id, kind, payload, attempts = claimed
+    handler = _handlers.get(kind)
+    done = threading.Event()
+    threading.Thread(target=_keep_locked, args=(job_id, worker_id, done), daemon=True,
+                     name=f'job-heartbeat-{job_id[:8]}').start()
+    try:
+        if handler is None:
+            raise JobFailed(f"No handler registered for job kind '{kind}'")
+        outcome = ('succeeded', handler(payload))
+    except RetryLater as e:
+        outcome = ('wait', e)
+    except JobFailed as e:
+        outcome = ('failed', str(e))
+    except Exception as e:
+        outcome = ('error', e)
+    finally:
+        done.set()
+
+    with db_connection() as conn:
+        if not conn:
+            # The job stays 'running' and is picked up again after JOB_LOCK_TIMEOUT
+            raise RuntimeError(f"Could not connect to database to record outcome of job {job_id}.")
+        with conn.cursor() as cursor:
+            state, value = outcome
+            if state == 'succeeded':
+                _finish(cursor, job_id, 'succeeded', result=value)
+            elif state == 'wait':
+                _reschedule(cursor, job_id, value.delay, payload=value.payload, polls=1)
+            elif state == 'failed':
+                print(f"❌ Job {job_id} ({kind}) failed: {value}")
+                _finish(cursor, job_id, 'failed', error=value)
+            elif attempts + 1 >= JOB_MAX_ATTEMPTS:
+                print(f"❌ Job {job_id} ({kind}) failed after {attempts + 1} attempts: {value}")
+                _finish(cursor, job_id, 'failed', error=str(value))
+            else:
+                delay = min(2 ** attempts * 5, 300)
+                print(f"⚠️ Job {job_id} ({kind}) attempt {attempts + 1} failed, retrying in {delay}s: {value}")
+                _reschedule(cursor, job_id, delay, attempts=attempts + 1, error=str(value))
+        conn.commit()
+    return True
+
+
+def run_worker(threads=JOB_WORKER_THREADS):
+    """Runs jobs on `threads` threads until SIGTERM / SIGINT."""
+    # Handlers register themselves on import
+    import scan_jobs  # noqa: F401
+
+    stopping = threading.Event()
+    worker_prefix = f"{socket.gethostname()}:{os.getpid()}"
+
+    def loop(n):
+        worker_id = f"{worker_prefix}:{n}"
+        while not stopping.is_set():
+            try:
+                if not run_next_job(worker_id):
+                    stopping.wait(JOB_IDLE_SLEEP)
+            except Exception as e:
+                print(f"❌ Job worker {worker_id} error: {e}")
+                stopping.wait(JOB_IDLE_SLEEP)
+
+    def stop(signum, frame):
+        print("Stopping job worker after the current steps...")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    pool = [threading.Thread(target=loop, args=(n,), name=f'job-worker-{n}') for n in range(threads)]
+    for thread in pool:
+        thread.start()
+    print(f"✅ Job worker {worker_prefix} running with {threads} threads.")
+    while any(thread.is_alive() for thread in pool):
+        time.sleep(0.5)
+
+
+def purge_jobs(days=JOB_RETENTION_DAYS):
+    """Deletes finished jobs older than `days` days."""
+    with db_connection() as conn:
+        if not conn:
+            raise RuntimeError("Could not connect to database to purge jobs.")
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """DELETE FROM background_jobs
+                   WHERE status IN ('succeeded', 'failed') AND finished_at < NOW() - make_interval(days => %s)""",
+                (days,)
+            )
+            deleted = cursor.rowcount
+        conn.commit()
+    print(f"✅ Purged {deleted} finished jobs older than {days} days.")
+    return deleted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run and inspect background jobs.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    worker = sub.add_parser('worker', help="Run queued jobs until stopped")
+    worker.add_argument('--threads', type=int, default=JOB_WORKER_THREADS)
+    status = sub.add_parser('status', help="Show one job")
+    status.add_argument('job_id')
+    purge = sub.add_parser('purge', help="Delete finished jobs older than N days")
+    purge.add_argument('--days', type=int, default=JOB_RETENTION_DAYS)
+    args = parser.parse_args(argv)
+
+    if args.command == 'worker':
+        run_worker(args.threads)
+    elif args.command == 'status':
+        job = get_job(args.job_id)
+        if job is None:
+            print(f"❌ No job {args.job_id}")
+            return 1
+        for key, value in job.items():
+            print(f"{key:<12} {value}")
+    elif args.command == 'purge':
+        purge_jobs(args.days)
+    return 0
+
+
+if __name__ == '__main__':
+    # Run through the importable module so handlers registered by scan_jobs
+    # (which imports `jobs`) land in the same registry
+    import jobs
+    sys.exit(jobs.main())
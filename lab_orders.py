@@ -0,0 +1,309 @@
+"""
+Storage for lab test orders submitted through the Laboratory Test Request
+System.
+
+Orders used to live in downloads/order_history.json, which was re-read on
+every lookup and rewritten in full on every submission. They are now rows
+in an indexed table: `lab_orders` in PostgreSQL (migration 0010), or a local
+SQLite file when LAB_ORDER_STORE=sqlite for running the lab screens without
+the EMR database. Each order is a single INSERT, so concurrent gunicorn
+workers cannot overwrite each other's orders.
+
+Orders are returned as the same dicts the JSON file held (orderId,
+externalOrderId, uhid, department, priority, tests, specimen, createdAt),
+plus `status`: the last status reported by the LIS webhook or seen while
+polling ('completed' / 'in_progress'), or None when not known yet
+(migration 0012).
+
+    python lab_orders.py import [downloads/order_history.json]
+"""
+import json
+import os
+import sqlite3
+import sys
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+from database import db_connection
+from ttl_cache import TTLCache
+
+LAB_ORDER_STORE = os.environ.get('LAB_ORDER_STORE', 'postgres')  # 'postgres' or 'sqlite'
+LAB_ORDER_SQLITE_PATH = os.environ.get('LAB_ORDER_SQLITE_PATH', os.path.join('downloads', 'lab_orders.sqlite3'))
+LEGACY_HISTORY_PATH = os.path.join('downloads', 'order_history.json')
+# Per-worker index of orderId -> (department, uhid, createdAt) used for the
+# ownership checks on every result/report click. Orders never change once
+# recorded, so entries only need a TTL to bound memory, not for freshness.
+LAB_ORDER_INDEX_SIZE = int(os.environ.get('LAB_ORDER_INDEX_SIZE', 10000))
+LAB_ORDER_INDEX_TTL = int(os.environ.get('LAB_ORDER_INDEX_TTL', 3600))
+
+_COLUMNS = "order_id, external_order_id, uhid, department, priority, tests, specimen, created_at"
+_SELECT_COLUMNS = _COLUMNS + ", status"
+
+
+def _to_row(entry):
+    created_at = entry.get('createdAt')
+    if isinstance(created_at, str):
+        try:
+            created_at = datetime.fromisoformat(created_at)
+        except ValueError:
+            created_at = None
+    return (
+        entry['orderId'],
+        entry.get('externalOrderId'),
+        entry.get('uhid'),
+        entry.get('department'),
+        entry.get('priority'),
+        json.dumps(entry.get('tests') or []),
+        entry.get('specimen'),
+        created_at or datetime.now(),
+    )
+
+
+def _to_entry(row):
+    order_id, external_order_id, uhid, department, priority, tests, specimen, created_at, status = row
+    if isinstance(tests, str):
+        tests = json.loads(tests)
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    return {
+        'orderId': order_id,
+        'externalOrderId': external_order_id,
+        'uhid': uhid,
+        'department': department,
+        'priority': priority,
+        'tests': tests,
+        'specimen': specimen,
+        'createdAt': created_at,
+        'status': status,
+    }
+
+
+class PostgresOrderStore:
+    def record(self, entries):
+        """Inserts orders; an orderId that is already stored is left unchanged. Returns rows inserted."""
+        with db_connection() as conn:
+            if not conn:
+                raise RuntimeError("Could not connect to database to record lab order.")
+            with conn.cursor() as cursor:
+                inserted = execute_values(
+                    cursor,
+                    f"""INSERT INTO lab_orders ({_COLUMNS}) VALUES %s
+                        ON CONFLICT (order_id) DO NOTHING RETURNING 1""",
+                    [_to_row(entry) for entry in entries],
+                    template="(%s, %s, %s, %s, %s, %s::jsonb, %s, %s)",
+                    page_size=500,
+                    fetch=True
+                )
+            conn.commit()
+            return len(inserted)
+
+    def get(self, order_id):
+        with db_connection() as conn:
+            if not conn:
+                return None
+            with conn.cursor() as cursor:
+                cursor.execute(f"SELECT {_SELECT_COLUMNS} FROM lab_orders WHERE order_id = %s", (order_id,))
+                row = cursor.fetchone()
+            return _to_entry(row) if row else None
+
+    def set_status(self, order_id, status):
+        """Stores `status` for the order. Returns (previous_status, uhid), or None for an unknown order."""
+        with db_connection() as conn:
+            if not conn:
+                raise RuntimeError("Could not connect to database to update lab order.")
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT status, uhid FROM lab_orders WHERE order_id = %s FOR UPDATE", (order_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                cursor.execute(
+                    "UPDATE lab_orders SET status = %s, status_updated_at = NOW() WHERE order_id = %s",
+                    (status, order_id)
+                )
+            conn.commit()
+            return row
+
+    def list(self, department=None, limit=None):
+        query = f"SELECT {_SELECT_COLUMNS} FROM lab_orders"
+        params = []
+        if department:
+            query += " WHERE department = %s"
+            params.append(department)
+        query += " ORDER BY created_at DESC, id DESC"
+        if limit:
+            query += " LIMIT %s"
+            params.append(limit)
+        with db_connection() as conn:
+            if not conn:
+                return []
+            with conn.cursor() as cursor:
+                cursor.execute(query, params)
+                return [_to_entry(row) for row in cursor.fetchall()]
+
+
+class SQLiteOrderStore:
+    def __init__(self, path=LAB_ORDER_SQLITE_PATH):
+        self.path = path
+        conn = self._connect()
+        try:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS lab_orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_id TEXT NOT NULL UNIQUE,
+                    external_order_id TEXT,
+                    uhid TEXT,
+                    department TEXT,
+                    priority TEXT,
+                    tests TEXT NOT NULL DEFAULT '[]',
+                    specimen TEXT,
+                    created_at TEXT NOT NULL,
+                    status TEXT,
+                    status_updated_at TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_lab_orders_department_created_at
+                    ON lab_orders (department, created_at DESC);
+                CREATE INDEX IF NOT EXISTS idx_lab_orders_created_at
+                    ON lab_orders (created_at DESC);
+            """)
+            # Files created before the status columns existed
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(lab_orders)")}
+            for column in ('status', 'status_updated_at'):
+                if column not in existing:
+                    conn.execute(f"ALTER TABLE lab_orders ADD COLUMN {column} TEXT")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # WAL lets readers run alongside the single writer; busy timeout makes
+        # concurrent writers from other workers wait instead of failing.
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def record(self, entries):
+        conn = self._connect()
+        try:
+            with conn:
+                inserted = 0
+                for entry in entries:
+                    row = list(_to_row(entry))
+                    row[7] = row[7].isoformat()
+                    cursor = conn.execute(
+                        f"INSERT OR IGNORE INTO lab_orders ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row
+                    )
+                    inserted += cursor.rowcount
+                return inserted
+        finally:
+            conn.close()
+
+    def get(self, order_id):
+        conn = self._connect()
+        try:
+            row = conn.execute(f"SELECT {_SELECT_COLUMNS} FROM lab_orders WHERE order_id = ?", (order_id,)).fetchone()
+            return _to_entry(row) if row else None
+        finally:
+            conn.close()
+
+    def set_status(self, order_id, status):
+        conn = self._connect()
+        try:
+            with conn:
+                # Take the write lock before reading, like SELECT ... FOR UPDATE
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT status, uhid FROM lab_orders WHERE order_id = ?", (order_id,)).fetchone()
+                if row is None:
+                    return None
+                conn.execute(
+                    "UPDATE lab_orders SET status = ?, status_updated_at = ? WHERE order_id = ?",
+                    (status, datetime.now().isoformat(), order_id)
+                )
+            return row
+        finally:
+            conn.close()
+
+    def list(self, department=None, limit=None):
+        query = f"SELECT {_SELECT_COLUMNS} FROM lab_orders"
+        params = []
+        if department:
+            query += " WHERE department = ?"
+            params.append(department)
+        query += " ORDER BY created_at DESC, id DESC"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        conn = self._connect()
+        try:
+            return [_to_entry(row) for row in conn.execute(query, params).fetchall()]
+        finally:
+            conn.close()
+
+
+_store = None
+_order_index = TTLCache(maxsize=LAB_ORDER_INDEX_SIZE, ttl=LAB_ORDER_INDEX_TTL)
+
+
+def get_order_store():
+    global _store
+    if _store is None:
+        _store = SQLiteOrderStore() if LAB_ORDER_STORE == 'sqlite' else PostgresOrderStore()
+    return _store
+
+
+def record_order(entry):
+    get_order_store().record([entry])
+    _order_index.pop(entry['orderId'])
+
+
+def find_order(order_id):
+    """Returns the stored order dict for `order_id`, or None."""
+    return get_order_store().get(order_id)
+
+
+def lookup_order(order_id):
+    """
+    Returns {'department', 'uhid', 'createdAt'} for `order_id`, or None.
+    Served from the in-memory index after the first lookup. Unknown ids are
+    not cached, so an order recorded by another worker is found at once.
+    """
+    summary = _order_index.get(order_id)
+    if summary is None:
+        order = get_order_store().get(order_id)
+        if order is None:
+            return None
+        summary = {'department': order['department'], 'uhid': order['uhid'], 'createdAt': order['createdAt']}
+        _order_index.set(order_id, summary)
+    return summary
+
+
+def order_index_stats():
+    return _order_index.snapshot()
+
+
+def set_order_status(order_id, status):
+    """Records the order's latest status. Returns (previous_status, uhid), or None for an unknown order."""
+    return get_order_store().set_status(order_id, status)
+
+
+def list_orders(department=None, limit=None):
+    """Orders newest first, optionally for one department."""
+    return get_order_store().list(department, limit)
+
+
+def import_json_history(path=LEGACY_HISTORY_PATH):
+    """One-shot import of an order_history.json file; safe to run again."""
+    with open(path, 'r', encoding='utf-8') as f:
+        history = json.load(f) or []
+    entries = [entry for entry in history if entry.get('orderId')]
+    inserted = get_order_store().record(entries)
+    print(f"✅ Imported {inserted} of {len(entries)} orders from {path} "
+          f"({len(entries) - inserted} already present).")
+    return inserted
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'import':
+        print("Usage: python lab_orders.py import [path/to/order_history.json]")
+        sys.exit(2)
+    import_json_history(sys.argv[2] if len(sys.argv) > 2 else LEGACY_HISTORY_PATH)
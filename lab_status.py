@@ -0,0 +1,361 @@
+"""
+Lab order status lookups against the LIS.
+
+Every screen that needs an order document (status polling, results,
+/history) goes through get_order(), which keeps a per-worker cache keyed by
+(host, orderId):
+
+  * Completed orders do not change again and are kept for
+    LAB_STATUS_FINAL_TTL (a day); orders still in progress for
+    LAB_STATUS_ACTIVE_TTL seconds.
+  * For LAB_STATUS_STALE_TTL seconds after an in-progress entry expires it
+    is still served while one background refresh fetches the new version
+    (stale-while-revalidate).
+  * Concurrent lookups of the same order share one upstream request, so
+    many tabs polling one order cost one call per TTL per worker.
+
+Only successful (200) responses are cached; errors go back to the caller
+and the next lookup tries again. Documents pushed by the LIS webhook are
+put straight into the cache (prime_order).
+
+/history shows a status badge per order. The lookups run concurrently on a
+bounded, per-worker thread pool under one overall deadline, so the page
+waits about as long as the slowest single call (at most
+LAB_STATUS_DEADLINE seconds). Orders still pending at the deadline show as
+'unknown'.
+
+The /api/order proxy does not parse the document: open_order_stream()
+passes the LIS bytes through as they arrive (still compressed, if the
+client accepts the LIS encoding) together with the LIS ETag. The ETags are
+remembered per order, for as long as the document would be cached above, so
+a client revalidating with If-None-Match gets its 304 without an upstream
+call; after that the If-None-Match is forwarded and the LIS answers 304.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import requests
+from werkzeug.http import unquote_etag
+
+import http_client
+
+SHARED_API_KEY = os.environ.get('LIS_API_KEY', 'hospital_shared_key')
+LAB_STATUS_WORKERS = int(os.environ.get('LAB_STATUS_WORKERS', 16))
+LAB_STATUS_DEADLINE = float(os.environ.get('LAB_STATUS_DEADLINE', 3.0))
+# Per-call timeout; never longer than the page deadline
+LAB_STATUS_TIMEOUT = float(os.environ.get('LAB_STATUS_TIMEOUT', 5.0))
+LAB_STATUS_CACHE_SIZE = int(os.environ.get('LAB_STATUS_CACHE_SIZE', 5000))
+LAB_STATUS_FINAL_TTL = int(os.environ.get('LAB_STATUS_FINAL_TTL', 86400))
+LAB_STATUS_ACTIVE_TTL = float(os.environ.get('LAB_STATUS_ACTIVE_TTL', 10))
+LAB_STATUS_STALE_TTL = float(os.environ.get('LAB_STATUS_STALE_TTL', 60))
+ORDER_PROXY_CHUNK_SIZE = 64 * 1024
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    # Threads do not survive fork, so each gunicorn worker builds its own pool
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _executor_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(max_workers=LAB_STATUS_WORKERS, thread_name_prefix='lab-status')
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def order_state(order):
+    """'completed' once any department has completed, else 'in_progress' (as shown to users)."""
+    per = order.get('perDepartment', [])
+    return 'completed' if any(d.get('status') == 'completed' for d in per) else 'in_progress'
+
+
+def order_status_summary(order_id, order):
+    """The /api/status body for an order document."""
+    per_dept = order.get('perDepartment', [])
+    # Check if any department has completed results
+    completed_depts = []
+    for dept in per_dept:
+        if dept.get('status') == 'completed':
+            completed_depts.append({
+                'department': dept.get('department'),
+                'status': dept.get('status'),
+                'results': dept.get('results', [])
+            })
+    return {
+        'orderId': order_id,
+        'status': 'completed' if completed_depts else 'in_progress',
+        'completedDepartments': completed_depts,
+        'allDepartments': per_dept
+    }
+
+
+def is_final(order):
+    """True when every department has completed, i.e. the document will not change again."""
+    per = order.get('perDepartment', [])
+    return bool(per) and all(d.get('status') == 'completed' for d in per)
+
+
+def _request_order(host, api_key, order_id, timeout):
+    r = http_client.get(f"{host.rstrip('/')}/api/orders/{order_id}", headers={'X-API-Key': api_key},
+                        timeout=timeout, endpoint='lis.orders')
+    return r.status_code, (r.json() if r.status_code == 200 else None)
+
+
+class OrderStatusCache:
+    def __init__(self, maxsize=LAB_STATUS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (fresh_until, stale_until, order), oldest first
+        self._inflight = {}  # key -> Future shared by every caller waiting on that fetch
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'coalesced': 0,
+                      'upstream_calls': 0, 'upstream_errors': 0, 'evictions': 0}
+
+    def get(self, host, api_key, order_id, timeout=LAB_STATUS_TIMEOUT):
+        """
+        Returns (status_code, order) for `order_id`; order is None unless the
+        status is 200. Raises requests.RequestException when the LIS cannot
+        be reached and nothing usable is cached.
+        """
+        key = (host.rstrip('/'), order_id)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                fresh_until, stale_until, order = entry
+                if now < fresh_until:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return 200, order
+                if now < stale_until:
+                    self._entries.move_to_end(key)
+                    self.stats['stale_hits'] += 1
+                    if key not in self._inflight:
+                        self._inflight[key] = Future()
+                        _get_executor().submit(self._fetch, key, api_key, timeout)
+                    return 200, order
+                del self._entries[key]
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._inflight[key] = Future()
+                leader = True
+                self.stats['misses'] += 1
+            else:
+                leader = False
+                self.stats['coalesced'] += 1
+        if leader:
+            self._fetch(key, api_key, timeout)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise requests.Timeout(f"Timed out waiting for order {order_id}")
+
+    def _fetch(self, key, api_key, timeout):
+        # Runs the upstream call for the Future registered under `key` and
+        # hands its outcome to every waiter
+        host, order_id = key
+        with self._lock:
+            future = self._inflight[key]
+            self.stats['upstream_calls'] += 1
+        try:
+            result = _request_order(host, api_key, order_id, timeout)
+        except Exception as e:
+            with self._lock:
+                self.stats['upstream_errors'] += 1
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            return
+        status_code, order = result
+        with self._lock:
+            if status_code == 200:
+                self._store(key, order)
+            self._inflight.pop(key, None)
+        future.set_result(result)
+
+    def _store(self, key, order):
+        now = time.monotonic()
+        if is_final(order):
+            fresh_until = stale_until = now + LAB_STATUS_FINAL_TTL
+        else:
+            fresh_until = now + LAB_STATUS_ACTIVE_TTL
+            stale_until = fresh_until + LAB_STATUS_STALE_TTL
+        self._entries[key] = (fresh_until, stale_until, order)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def put(self, host, order_id, order):
+        with self._lock:
+            self._store((host.rstrip('/'), order_id), order)
+
+    def discard(self, host, order_id):
+        with self._lock:
+            self._entries.pop((host.rstrip('/'), order_id), None)
+
+    def peek(self, host, order_id):
+        """The cached document, if any, without counting a lookup or refreshing it."""
+        with self._lock:
+            entry = self._entries.get((host.rstrip('/'), order_id))
+            return entry[2] if entry is not None else None
+
+    def snapshot(self):
+        with self._lock:
+            served = self.stats['hits'] + self.stats['stale_hits'] + self.stats['coalesced']
+            lookups = served + self.stats['misses']
+            return dict(self.stats, size=len(self._entries), maxsize=self.maxsize, inflight=len(self._inflight),
+                        hit_ratio=round(served / lookups, 3) if lookups else None)
+
+
+class OrderValidatorCache:
+    """The ETag the LIS last sent for each order, valid as long as the document would be cached."""
+
+    def __init__(self, maxsize=LAB_STATUS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (etag, valid_until), oldest first
+        self._lock = threading.Lock()
+        self.stats = {'local_not_modified': 0, 'upstream_not_modified': 0, 'streamed': 0}
+
+    def get(self, host, order_id):
+        key = (host.rstrip('/'), order_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry[1]:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, host, order_id, etag, final):
+        ttl = LAB_STATUS_FINAL_TTL if final else LAB_STATUS_ACTIVE_TTL
+        key = (host.rstrip('/'), order_id)
+        with self._lock:
+            self._entries[key] = (etag, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, host, order_id):
+        with self._lock:
+            self._entries.pop((host.rstrip('/'), order_id), None)
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, size=len(self._entries))
+
+
+_cache = OrderStatusCache()
+_validators = OrderValidatorCache()
+
+
+def get_order(host, api_key, order_id, timeout=LAB_STATUS_TIMEOUT):
+    """Returns (status_code, order_dict_or_None) for `order_id`, from the shared cache when possible."""
+    return _cache.get(host, api_key, order_id, timeout)
+
+
+def prime_order(host, order_id, order):
+    """Caches an order document pushed to us (LIS webhook) as if it had just been fetched."""
+    _cache.put(host, order_id, order)
+    # Its ETag is not known; the next proxied request fetches it
+    _validators.discard(host, order_id)
+
+
+def forget_order(host, order_id):
+    """Drops the cached document so the next lookup fetches it again."""
+    _cache.discard(host, order_id)
+    _validators.discard(host, order_id)
+
+
+def order_status_cache_stats():
+    return dict(_cache.snapshot(), validators=_validators.snapshot())
+
+
+def order_not_modified(host, order_id, client_etags):
+    """
+    Returns the order's known ETag when it is one of `client_etags` (the
+    request's werkzeug If-None-Match set), i.e. a 304 can be sent without
+    asking the LIS; otherwise None.
+    """
+    etag = _validators.get(host, order_id)
+    if etag and client_etags and client_etags.contains_weak(unquote_etag(etag)[0]):
+        _validators.count('local_not_modified')
+        return etag
+    return None
+
+
+def open_order_stream(host, api_key, order_id, if_none_match=None, accept_encoding=None, timeout=LAB_STATUS_TIMEOUT):
+    """
+    Requests the order document for passing through to a client. Returns the
+    open, streaming requests.Response (the caller closes it); a 304 when
+    `if_none_match` still matches. The body is left as the LIS encoded it
+    (`accept_encoding` is what the client accepts, 'identity' if not given).
+    """
+    headers = {'X-API-Key': api_key, 'Accept-Encoding': accept_encoding or 'identity'}
+    if if_none_match:
+        headers['If-None-Match'] = if_none_match
+    r = http_client.get(f"{host.rstrip('/')}/api/orders/{order_id}", headers=headers, stream=True,
+                        timeout=timeout, endpoint='lis.orders')
+    etag = r.headers.get('ETag')
+    if r.status_code in (200, 304) and etag:
+        cached = _cache.peek(host, order_id)
+        _validators.put(host, order_id, etag, final=cached is not None and is_final(cached))
+    if r.status_code == 304:
+        _validators.count('upstream_not_modified')
+    elif r.status_code == 200:
+        _validators.count('streamed')
+    return r
+
+
+def iter_order_stream(r, chunk_size=ORDER_PROXY_CHUNK_SIZE):
+    """Yields the body of an open_order_stream() response as received, and closes it."""
+    try:
+        for chunk in r.raw.stream(chunk_size, decode_content=False):
+            yield chunk
+    finally:
+        r.close()
+
+
+def fetch_orders(host, api_key, order_ids, deadline=LAB_STATUS_DEADLINE):
+    """
+    Looks up many orders concurrently. Returns {order_id: (status_code, order)}
+    for the lookups that finished within `deadline` seconds without error.
+    """
+    results = {}
+    if not order_ids:
+        return results
+    executor = _get_executor()
+    timeout = min(LAB_STATUS_TIMEOUT, deadline)
+    futures = {executor.submit(get_order, host, api_key, order_id, timeout): order_id
+               for order_id in set(order_ids)}
+    done, not_done = wait(futures, timeout=deadline)
+    for future in done:
+        try:
+            results[futures[future]] = future.result()
+        except Exception:
+            pass
+    for future in not_done:
+        # Not started yet: drop it. Already running: it finishes in the
+        # background within its own timeout and the result is discarded.
+        future.cancel()
+    return results
+
+
+def fetch_order_statuses(host, api_key, order_ids, deadline=LAB_STATUS_DEADLINE):
+    """Returns {order_id: status} for all ids, 'unknown' for any not answered within `deadline` seconds."""
+    statuses = {order_id: 'unknown' for order_id in order_ids}
+    for order_id, (status_code, order) in fetch_orders(host, api_key, order_ids, deadline).items():
+        if status_code == 200:
+            statuses[order_id] = order_state(order)
+    return statuses
@@ -0,0 +1,279 @@
+"""
+Load harness: drives a running app with concurrent simulated users and
+reports throughput and latency per scenario.
+
+Start the mock lab systems and the app against them first (see
+mock_lab_server.py), then:
+
+    python load_harness.py --app http://127.0.0.1:5000 --mock http://127.0.0.1:8900 \\
+        --users 20 --duration 30 --mix status=6,order=2,results=1,history=1,submit=1
+
+Scenarios (weights in --mix pick how often each user runs them):
+
+    submit   POST /test_index: places a lab order (perform_test_request)
+    status   GET /api/status/<order_id>
+    order    GET /api/order/<order_id>
+    results  GET /results/<order_id>
+    history  GET /history (the per-order status fan-out)
+    scan     POST /scan/<uhid>, then follows /api/jobs/<id> until the job
+             finishes; its latency is end to end. Needs `python jobs.py worker`.
+
+Every user logs in to --department and first places --seed-orders orders
+between them, so status / order / results have ids to look up. With --mock
+the report also shows the calls that reached the lab systems per app
+request, which is where the status cache and request coalescing show up.
+"""
+import argparse
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+import requests
+
+SCENARIOS = ('submit', 'status', 'order', 'results', 'history', 'scan')
+ORDER_ID_PATTERN = re.compile(r'id="orderIdDisplay">([^<]+)<')
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}  # scenario -> [seconds] of successful calls
+        self.errors = {}  # scenario -> Counter of error descriptions
+
+    def record(self, scenario, seconds, error=None):
+        with self._lock:
+            if error is None:
+                self.latencies.setdefault(scenario, []).append(seconds)
+            else:
+                self.errors.setdefault(scenario, Counter())[error] += 1
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(pct / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class User:
+    """One simulated department user with its own session (cookies, keep-alive)."""
+
+    def __init__(self, args, order_ids, order_lock):
+        self.args = args
+        self.base = args.app.rstrip('/')
+        self.order_ids = order_ids
+        self.order_lock = order_lock
+        self.session = requests.Session()
+
+    def login(self):
+        r = self.session.post(f"{self.base}/test_login", data={'department': self.args.department},
+                              allow_redirects=False, timeout=self.args.timeout)
+        if r.status_code not in (200, 302):
+            raise RuntimeError(f"Login failed: {r.status_code}")
+
+    def _pick_order(self):
+        with self.order_lock:
+            if not self.order_ids:
+                raise RuntimeError("no orders to look up")
+            return random.choice(self.order_ids)
+
+    def _get(self, path):
+        r = self.session.get(f"{self.base}{path}", timeout=self.args.timeout)
+        if r.status_code >= 400:
+            raise RuntimeError(f"HTTP {r.status_code}")
+        return r
+
+    def run(self, scenario):
+        getattr(self, f"run_{scenario}")()
+
+    def run_submit(self):
+        r = self.session.post(f"{self.base}/test_index", timeout=self.args.timeout, data={
+            'uhid': f"LOAD{random.randint(1, self.args.patients)}",
+            'priority': 'routine',
+            'specimen': 'Blood',
+            'clinical_notes': 'load test',
+            'tests': self.args.tests,
+        })
+        match = ORDER_ID_PATTERN.search(r.text)
+        if r.status_code >= 400 or not match:
+            raise RuntimeError(f"HTTP {r.status_code}, no order id")
+        with self.order_lock:
+            self.order_ids.append(match.group(1))
+
+    def run_status(self):
+        self._get(f"/api/status/{self._pick_order()}")
+
+    def run_order(self):
+        self._get(f"/api/order/{self._pick_order()}")
+
+    def run_results(self):
+        self._get(f"/results/{self._pick_order()}")
+
+    def run_history(self):
+        self._get("/history")
+
+    def run_scan(self):
+        uhid = f"LOAD{random.randint(1, self.args.patients)}"
+        r = self.session.post(f"{self.base}/scan/{uhid}", allow_redirects=False, timeout=self.args.timeout, data={
+            'department': 'Ophthamology', 'uhid': uhid, 'scan_type': 'OCT', 'body_part': 'Eye',
+        })
+        job_id = re.search(r'job=([0-9a-f]+)', r.headers.get('Location', ''))
+        if r.status_code != 302 or not job_id:
+            raise RuntimeError(f"HTTP {r.status_code}, no job")
+        deadline = time.monotonic() + self.args.scan_timeout
+        while time.monotonic() < deadline:
+            job = self._get(f"/api/jobs/{job_id.group(1)}").json()
+            if job.get('status') == 'succeeded':
+                return
+            if job.get('status') == 'failed':
+                raise RuntimeError("job failed")
+            time.sleep(0.5)
+        raise RuntimeError("job not finished in time")
+
+
+def _parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario '{name}' (choose from {', '.join(SCENARIOS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def _mock_stats(mock_url):
+    try:
+        return requests.get(f"{mock_url.rstrip('/')}/__mock/stats", timeout=5).json()
+    except (requests.RequestException, ValueError) as e:
+        print(f"⚠️ Could not read mock stats: {e}")
+        return None
+
+
+def _ms(seconds):
+    return f"{seconds * 1000:.0f}" if seconds is not None else '-'
+
+
+def report(recorder, elapsed, mock_before=None, mock_after=None, health=None):
+    print(f"\n{'scenario':<10} {'ok':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    total_ok = total_errors = 0
+    for scenario in SCENARIOS:
+        latencies = sorted(recorder.latencies.get(scenario, []))
+        errors = sum(recorder.errors.get(scenario, Counter()).values())
+        if not latencies and not errors:
+            continue
+        total_ok += len(latencies)
+        total_errors += errors
+        print(f"{scenario:<10} {len(latencies):>7} {errors:>7} {len(latencies) / elapsed:>8.1f} "
+              f"{_ms(percentile(latencies, 50)):>8} {_ms(percentile(latencies, 90)):>8} "
+              f"{_ms(percentile(latencies, 99)):>8} {_ms(latencies[-1] if latencies else None):>8}")
+    print(f"{'total':<10} {total_ok:>7} {total_errors:>7} {total_ok / elapsed:>8.1f}")
+
+    for scenario, errors in recorder.errors.items():
+        for error, count in errors.most_common(3):
+            print(f"  ❌ {scenario}: {error} (x{count})")
+
+    if mock_before and mock_after:
+        calls = mock_after['total_requests'] - mock_before['total_requests']
+        print(f"\nLab system calls: {calls} ({calls / max(1, total_ok + total_errors):.2f} per app request)")
+        for endpoint, by_status in sorted(mock_after['requests'].items()):
+            before = mock_before['requests'].get(endpoint, {})
+            delta = {code: n - before.get(code, 0) for code, n in by_status.items() if n - before.get(code, 0)}
+            if delta:
+                print(f"  {endpoint:<22} " + ', '.join(f"{code}: {n}" for code, n in sorted(delta.items())))
+
+    if health:
+        cache = health.get('lab_status_cache') or {}
+        client = health.get('http_client') or {}
+        if cache:
+            print(f"\nStatus cache (one worker): hit ratio {cache.get('hit_ratio')}, "
+                  f"coalesced {cache.get('coalesced')}, upstream calls {cache.get('upstream_calls')}")
+        if client:
+            print(f"HTTP client (one worker): connection reuse {client.get('reuse_ratio')}, "
+                  f"short-circuited {client.get('short_circuited')}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive the app with concurrent users and report latencies.")
+    parser.add_argument('--app', default='http://127.0.0.1:5000', help="App base URL")
+    parser.add_argument('--mock', help="mock_lab_server.py base URL, to count lab system calls")
+    parser.add_argument('--users', type=int, default=10, help="Concurrent simulated users")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to run")
+    parser.add_argument('--mix', type=_parse_mix, default=_parse_mix('status=6,order=2,results=1,history=1,submit=1'),
+                        help="Scenario weights, e.g. status=6,history=1")
+    parser.add_argument('--department', default='biochemistry')
+    parser.add_argument('--tests', nargs='+', default=['GLUCOSE_FASTING', 'LIPID_PROFILE'])
+    parser.add_argument('--patients', type=int, default=100, help="Distinct UHIDs to order for")
+    parser.add_argument('--seed-orders', type=int, default=20, help="Orders placed before the timed run")
+    parser.add_argument('--orders', help="Comma-separated existing order ids to look up as well")
+    parser.add_argument('--timeout', type=float, default=30, help="Per request timeout (s)")
+    parser.add_argument('--scan-timeout', type=float, default=120, help="How long a scan job may take (s)")
+    args = parser.parse_args(argv)
+
+    order_ids = [o.strip() for o in (args.orders or '').split(',') if o.strip()]
+    order_lock = threading.Lock()
+    users = [User(args, order_ids, order_lock) for _ in range(args.users)]
+    try:
+        for user in users:
+            user.login()
+    except (requests.RequestException, RuntimeError) as e:
+        print(f"❌ Could not log in to {args.app}: {e}")
+        return 1
+
+    if args.seed_orders:
+        print(f"Placing {args.seed_orders} orders...")
+        seeded = Recorder()
+        for n in range(args.seed_orders):
+            try:
+                users[n % len(users)].run_submit()
+                seeded.record('submit', 0)
+            except (requests.RequestException, RuntimeError) as e:
+                seeded.record('submit', 0, str(e))
+        if seeded.errors:
+            print(f"⚠️ {sum(seeded.errors['submit'].values())} seed orders failed: "
+                  f"{seeded.errors['submit'].most_common(1)[0][0]}")
+    if not order_ids and set(args.mix) & {'status', 'order', 'results'}:
+        print("❌ No orders to look up; pass --orders or fix order submission.")
+        return 1
+
+    mock_before = _mock_stats(args.mock) if args.mock else None
+    recorder = Recorder()
+    scenarios, weights = zip(*args.mix.items())
+    stop_at = time.monotonic() + args.duration
+
+    def loop(user):
+        while time.monotonic() < stop_at:
+            scenario = random.choices(scenarios, weights)[0]
+            started = time.monotonic()
+            try:
+                user.run(scenario)
+                recorder.record(scenario, time.monotonic() - started)
+            except requests.RequestException as e:
+                recorder.record(scenario, None, type(e).__name__)
+            except RuntimeError as e:
+                recorder.record(scenario, None, str(e))
+
+    print(f"Running {args.users} users for {args.duration:.0f}s against {args.app}...")
+    started = time.monotonic()
+    threads = [threading.Thread(target=loop, args=(user,), daemon=True) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    mock_after = _mock_stats(args.mock) if args.mock else None
+    try:
+        health = requests.get(f"{args.app.rstrip('/')}/api/health", timeout=5).json()
+    except (requests.RequestException, ValueError):
+        health = None
+    report(recorder, elapsed, mock_before, mock_after, health)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
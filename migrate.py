@@ -0,0 +1,295 @@
+"""
+Versioned schema migrations.
+
+Migration files live in ./migrations and are named NNNN_description.sql or
+NNNN_description.py. They are applied in version order and recorded in the
+schema_migrations table together with a SHA-256 fingerprint of the file, so
+an already-applied migration that is edited later is reported as drift.
+
+  * .sql files run inside a single transaction. Put `-- migrate:no-transaction`
+    on the first line for statements such as CREATE INDEX CONCURRENTLY; those
+    files are split on `;` and run in autocommit mode, so every statement in
+    them must be idempotent (IF NOT EXISTS).
+  * .py files define `upgrade(cursor)` and may set `TRANSACTIONAL = False`.
+
+Only one process migrates at a time (pg_advisory_lock). Run this before
+starting the web workers, e.g. as the Render pre-deploy command:
+
+    python migrate.py apply
+    python migrate.py status
+    python migrate.py verify
+
+Migrations stay schema-only. Data fixes over whole tables are chunked
+backfills (backfill.py) run after the deploy, e.g.
+`python backfill.py run uhid_placeholders`.
+"""
+import argparse
+import hashlib
+import importlib.util
+import os
+import re
+import sys
+import time
+
+import psycopg2
+
+from database import db_connection, open_connection
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+# Arbitrary application-wide key for pg_advisory_lock
+MIGRATION_LOCK_KEY = 74_201_001
+NO_TRANSACTION_MARKER = '-- migrate:no-transaction'
+
+_FILENAME_RE = re.compile(r'^(\d+)_([A-Za-z0-9_]+)\.(sql|py)$')
+
+
+class Migration:
+    """A single migration file on disk."""
+
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+        with open(path, 'rb') as f:
+            self.source = f.read()
+        self.checksum = hashlib.sha256(self.source).hexdigest()
+        self.kind = os.path.splitext(path)[1].lstrip('.')
+        if self.kind == 'sql':
+            text = self.source.decode('utf-8')
+            self.transactional = not text.lstrip().startswith(NO_TRANSACTION_MARKER)
+            self._module = None
+        else:
+            self._module = self._load_module()
+            self.transactional = getattr(self._module, 'TRANSACTIONAL', True)
+
+    def _load_module(self):
+        spec = importlib.util.spec_from_file_location(f"migration_{self.version:04d}", self.path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def statements(self):
+        """Splits a non-transactional SQL file into individual statements."""
+        text = self.source.decode('utf-8')
+        lines = [ln for ln in text.splitlines() if not ln.strip().startswith('--')]
+        return [stmt.strip() for stmt in '\n'.join(lines).split(';') if stmt.strip()]
+
+    def run(self, cursor):
+        if self.kind == 'py':
+            self._module.upgrade(cursor)
+        elif self.transactional:
+            cursor.execute(self.source.decode('utf-8'))
+        else:
+            for stmt in self.statements():
+                cursor.execute(stmt)
+
+    def __repr__(self):
+        return f"<Migration {self.version:04d}_{self.name}>"
+
+
+def discover_migrations(directory=MIGRATIONS_DIR):
+    """Returns all migration files in version order."""
+    migrations = []
+    seen = {}
+    for fname in sorted(os.listdir(directory)):
+        m = _FILENAME_RE.match(fname)
+        if not m:
+            continue
+        version = int(m.group(1))
+        if version in seen:
+            raise ValueError(f"Duplicate migration version {version}: {seen[version]} and {fname}")
+        seen[version] = fname
+        migrations.append(Migration(version, m.group(2), os.path.join(directory, fname)))
+    return sorted(migrations, key=lambda mig: mig.version)
+
+
+def latest_version(migrations=None):
+    migrations = discover_migrations() if migrations is None else migrations
+    return migrations[-1].version if migrations else 0
+
+
+def _ensure_migrations_table(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(200) NOT NULL,
+                checksum CHAR(64) NOT NULL,
+                applied_at TIMESTAMP DEFAULT NOW(),
+                execution_ms INTEGER
+            );
+        """)
+    conn.commit()
+
+
+def applied_migrations(conn):
+    """Returns {version: (name, checksum, applied_at)} for applied migrations."""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT version, name, checksum, applied_at FROM schema_migrations ORDER BY version")
+        return {row[0]: (row[1], row[2], row[3]) for row in cursor.fetchall()}
+
+
+def find_drift(migrations, applied):
+    """Returns migrations whose file changed after they were applied."""
+    return [mig for mig in migrations
+            if mig.version in applied and applied[mig.version][1] != mig.checksum]
+
+
+def _apply_one(conn, migration):
+    started = time.monotonic()
+    # Non-transactional files run statement by statement in autocommit mode;
+    # the bookkeeping row is then written in its own transaction.
+    conn.autocommit = not migration.transactional
+    try:
+        with conn.cursor() as cursor:
+            migration.run(cursor)
+        if conn.autocommit:
+            conn.autocommit = False
+        elapsed_ms = int((time.monotonic() - started) * 1000)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO schema_migrations (version, name, checksum, execution_ms)
+                   VALUES (%s, %s, %s, %s)""",
+                (migration.version, migration.name, migration.checksum, elapsed_ms)
+            )
+        conn.commit()
+        return elapsed_ms
+    except Exception:
+        if conn.autocommit:
+            conn.autocommit = False
+        else:
+            conn.rollback()
+        raise
+
+
+def apply_migrations(target=None):
+    """Applies pending migrations up to `target` (default: all). Returns the applied list."""
+    migrations = discover_migrations()
+    conn = open_connection()
+    try:
+        _ensure_migrations_table(conn)
+        with conn.cursor() as cursor:
+            print("Waiting for migration lock...")
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        conn.commit()
+        try:
+            # Re-read after acquiring the lock: another process may have migrated meanwhile
+            applied = applied_migrations(conn)
+            conn.commit()  # end the read transaction before toggling autocommit
+            drift = find_drift(migrations, applied)
+            if drift:
+                raise RuntimeError(
+                    "Applied migrations were modified on disk: "
+                    + ", ".join(f"{m.version:04d}_{m.name}" for m in drift))
+
+            done = []
+            for migration in migrations:
+                if migration.version in applied:
+                    continue
+                if target is not None and migration.version > target:
+                    break
+                print(f"Applying {migration.version:04d}_{migration.name}...")
+                elapsed_ms = _apply_one(conn, migration)
+                print(f"✅ {migration.version:04d}_{migration.name} applied in {elapsed_ms} ms.")
+                done.append(migration)
+            if not done:
+                print("✅ Schema is up to date.")
+            return done
+        finally:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+            conn.commit()
+    finally:
+        conn.close()
+
+
+def check_schema_version():
+    """
+    Cheap startup check: one query against schema_migrations, no DDL, no locks.
+    Returns (current_version, latest_version); current is None if unknown.
+    """
+    latest = latest_version()
+    current = None
+    with db_connection() as conn:
+        if not conn:
+            print("⚠️ Schema check skipped: database unavailable.")
+            return current, latest
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            current = cursor.fetchone()[0]
+        except psycopg2.Error as e:
+            conn.rollback()
+            print(f"⚠️ Could not read schema_migrations ({e.pgcode}). Run `python migrate.py apply`.")
+            return current, latest
+        finally:
+            cursor.close()
+
+    if current < latest:
+        print(f"⚠️ Database schema is at version {current}, code expects {latest}. Run `python migrate.py apply`.")
+    elif current > latest:
+        print(f"⚠️ Database schema version {current} is newer than this code ({latest}).")
+    else:
+        print(f"✅ Database schema at version {current}.")
+    return current, latest
+
+
+def print_status():
+    migrations = discover_migrations()
+    conn = open_connection()
+    try:
+        _ensure_migrations_table(conn)
+        applied = applied_migrations(conn)
+    finally:
+        conn.close()
+    drifted = {m.version for m in find_drift(migrations, applied)}
+    for mig in migrations:
+        if mig.version in drifted:
+            state = "MODIFIED"
+        elif mig.version in applied:
+            state = f"applied {applied[mig.version][2]:%Y-%m-%d %H:%M:%S}"
+        else:
+            state = "pending"
+        print(f"{mig.version:04d}  {mig.name:<40} {state}")
+    known = {m.version for m in migrations}
+    for version in sorted(set(applied) - known):
+        print(f"{version:04d}  {applied[version][0]:<40} applied (file missing)")
+    return 1 if drifted else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply and inspect database schema migrations.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    apply_cmd = sub.add_parser('apply', help="apply pending migrations")
+    apply_cmd.add_argument('--target', type=int, help="stop after this version")
+    sub.add_parser('status', help="list migrations and whether they are applied")
+    sub.add_parser('verify', help="exit non-zero if the schema is behind or an applied file changed")
+    args = parser.parse_args(argv)
+
+    if args.command == 'apply':
+        apply_migrations(args.target)
+        return 0
+    if args.command == 'status':
+        return print_status()
+    if args.command == 'verify':
+        migrations = discover_migrations()
+        conn = open_connection()
+        try:
+            _ensure_migrations_table(conn)
+            applied = applied_migrations(conn)
+        finally:
+            conn.close()
+        drift = find_drift(migrations, applied)
+        pending = [m for m in migrations if m.version not in applied]
+        for m in drift:
+            print(f"❌ {m.version:04d}_{m.name} changed after it was applied.")
+        for m in pending:
+            print(f"❌ {m.version:04d}_{m.name} is pending.")
+        if not drift and not pending:
+            print("✅ Schema matches migrations.")
+        return 1 if drift or pending else 0
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
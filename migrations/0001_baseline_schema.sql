@@ -0,0 +1,114 @@
+-- Baseline schema. Written to be safe on both fresh databases and
+-- installations created by the old create_tables()/ensure_columns() startup code.
+
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    username VARCHAR(100) UNIQUE NOT NULL,
+    password_hash TEXT NOT NULL,
+    role VARCHAR(50) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS patients (
+    id SERIAL PRIMARY KEY,
+    mrn VARCHAR(20) UNIQUE,
+    uhid VARCHAR(50) UNIQUE,
+    first_name VARCHAR(100) NOT NULL,
+    last_name VARCHAR(100) NOT NULL,
+    dob DATE,
+    gender VARCHAR(10),
+    address TEXT,
+    phone VARCHAR(20),
+    email VARCHAR(100),
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS patient_medical_records (
+    id SERIAL PRIMARY KEY,
+    patient_id INTEGER REFERENCES patients(id) ON DELETE CASCADE,
+    uhid VARCHAR(50),
+    visit_date TIMESTAMP NOT NULL DEFAULT NOW(),
+    diagnosis TEXT NOT NULL,
+    treatment TEXT,
+    test_results JSONB,
+    prescribed_drops JSONB,
+    prescribed_medication JSONB,
+    surgery_recommendation TEXT,
+    risk_assessment_score INTEGER,
+    risk_assessment_category VARCHAR(50),
+    risk_assessment_implication TEXT,
+    prescription_details JSONB,
+    created_by INTEGER,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS audit_logs (
+    id SERIAL PRIMARY KEY,
+    timestamp TIMESTAMP DEFAULT NOW(),
+    user_id INTEGER,
+    action TEXT NOT NULL,
+    details TEXT
+);
+
+CREATE TABLE IF NOT EXISTS patient_edit_history (
+    id SERIAL PRIMARY KEY,
+    patient_id INTEGER REFERENCES patients(id) ON DELETE CASCADE,
+    uhid VARCHAR(50),
+    editor_id INTEGER NOT NULL,
+    field_name VARCHAR(100) NOT NULL,
+    old_value TEXT,
+    new_value TEXT,
+    edited_at TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS patient_prescriptions (
+    id SERIAL PRIMARY KEY,
+    patient_id INTEGER NOT NULL REFERENCES patients(id) ON DELETE CASCADE,
+    medical_record_id INTEGER REFERENCES patient_medical_records(id) ON DELETE CASCADE,
+    uhid VARCHAR(50),
+    spectacle_lens JSONB,
+    lens_type VARCHAR(100),
+    drops JSONB,
+    medications JSONB,
+    systemic_medication TEXT,
+    surgery_recommendation TEXT,
+    iol_notes TEXT,
+    patient_instructions TEXT,
+    follow_up_date DATE,
+    visit_date TIMESTAMP,
+    created_by INTEGER,
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
+
+-- Columns added over time by ensure_columns() on older installations
+ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+ALTER TABLE patients ADD COLUMN IF NOT EXISTS uhid VARCHAR(50) UNIQUE;
+ALTER TABLE patients ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT NOW();
+ALTER TABLE patients ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT NOW();
+ALTER TABLE patients ALTER COLUMN mrn DROP NOT NULL;
+
+ALTER TABLE patient_medical_records ADD COLUMN IF NOT EXISTS uhid VARCHAR(50);
+ALTER TABLE patient_medical_records ADD COLUMN IF NOT EXISTS prescription_details JSONB;
+ALTER TABLE patient_medical_records ADD COLUMN IF NOT EXISTS created_by INTEGER;
+ALTER TABLE patient_medical_records ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT NOW();
+ALTER TABLE patient_medical_records ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT NOW();
+
+ALTER TABLE patient_edit_history ADD COLUMN IF NOT EXISTS uhid VARCHAR(50);
+-- System events (e.g. DR risk assessments without a patient row) log a NULL patient_id
+ALTER TABLE patient_edit_history ALTER COLUMN patient_id DROP NOT NULL;
+
+ALTER TABLE patient_prescriptions ADD COLUMN IF NOT EXISTS uhid VARCHAR(50);
+ALTER TABLE patient_prescriptions ADD COLUMN IF NOT EXISTS lens_type VARCHAR(100);
+ALTER TABLE patient_prescriptions ADD COLUMN IF NOT EXISTS systemic_medication TEXT;
+ALTER TABLE patient_prescriptions ADD COLUMN IF NOT EXISTS iol_notes TEXT;
+ALTER TABLE patient_prescriptions ADD COLUMN IF NOT EXISTS patient_instructions TEXT;
+ALTER TABLE patient_prescriptions ADD COLUMN IF NOT EXISTS follow_up_date DATE;
+ALTER TABLE patient_prescriptions ADD COLUMN IF NOT EXISTS visit_date TIMESTAMP;
+
+-- Legacy rows without a UHID get their TEMP-UHID-<mrn> placeholder from the
+-- chunked backfill, not here, so this migration never rewrites the table:
+--   python backfill.py run uhid_placeholders
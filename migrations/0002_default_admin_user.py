@@ -0,0 +1,12 @@
+"""Seeds the default admin account used for first login."""
+from werkzeug.security import generate_password_hash
+
+
+def upgrade(cursor):
+    cursor.execute("SELECT COUNT(*) FROM users WHERE username = %s", ('admin',))
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(
+            "INSERT INTO users (username, password_hash, role) VALUES (%s, %s, %s)",
+            ('admin', generate_password_hash("adminpass", method='pbkdf2:sha256'), 'admin')
+        )
+        print("Default admin user 'admin' created.")
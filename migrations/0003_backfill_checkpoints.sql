@@ -0,0 +1,16 @@
+-- Progress of long-running data backfills (see backfill.py).
+-- One row per job slice so parallel workers resume independently.
+CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+    job_name VARCHAR(100) NOT NULL,
+    slice_no INTEGER NOT NULL,
+    slice_count INTEGER NOT NULL,
+    lower_key BIGINT NOT NULL,
+    upper_key BIGINT NOT NULL,
+    last_key BIGINT NOT NULL,
+    rows_scanned BIGINT NOT NULL DEFAULT 0,
+    rows_changed BIGINT NOT NULL DEFAULT 0,
+    started_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW(),
+    completed_at TIMESTAMP,
+    PRIMARY KEY (job_name, slice_no)
+);
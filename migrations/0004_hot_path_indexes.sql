@@ -0,0 +1,32 @@
+-- migrate:no-transaction
+-- Secondary indexes for the patient chart and audit screens. Built
+-- CONCURRENTLY so live reads and writes are not blocked while they build.
+-- If a build is interrupted, PostgreSQL leaves an INVALID index behind that
+-- IF NOT EXISTS will skip; check_indexes.py reports those.
+
+-- view_patient, view_medical_history, get_patient_api: WHERE uhid = ? ORDER BY visit_date DESC.
+-- Also lets the analytics COUNT(DISTINCT uhid)/MAX(visit_date) run as index-only scans.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pmr_uhid_visit_date
+    ON patient_medical_records (uhid, visit_date DESC);
+
+-- get_patient_api: prescriptions WHERE uhid = ? ORDER BY visit_date DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_prescriptions_uhid_visit_date
+    ON patient_prescriptions (uhid, visit_date DESC);
+
+-- view_medical_history: prescriptions WHERE uhid = ? ORDER BY created_at DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_prescriptions_uhid_created_at
+    ON patient_prescriptions (uhid, created_at DESC);
+
+-- audit_logs / download_audit_logs: edited_at range filter, newest first.
+-- id breaks ties so the order is stable for paging.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_edit_history_edited_at
+    ON patient_edit_history (edited_at DESC, id DESC);
+
+-- Foreign keys with ON DELETE CASCADE: without these, deleting a patient
+-- scans every child table.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pmr_patient_id
+    ON patient_medical_records (patient_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_prescriptions_patient_id
+    ON patient_prescriptions (patient_id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_edit_history_patient_id
+    ON patient_edit_history (patient_id);
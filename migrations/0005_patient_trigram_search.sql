@@ -0,0 +1,13 @@
+-- migrate:no-transaction
+-- Trigram indexes for patient search (patient_search.py). GIN trigram
+-- indexes serve both ILIKE '%term%' and the similarity operator (%).
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_patients_uhid_trgm
+    ON patients USING gin (uhid gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_patients_first_name_trgm
+    ON patients USING gin (first_name gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_patients_last_name_trgm
+    ON patients USING gin (last_name gin_trgm_ops);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_patients_full_name_trgm
+    ON patients USING gin ((first_name || ' ' || last_name) gin_trgm_ops);
@@ -0,0 +1,4 @@
+-- migrate:no-transaction
+-- Keyset pagination for the dashboard patient directory (patient_directory.py)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_patients_name_order
+    ON patients (last_name, first_name, id);
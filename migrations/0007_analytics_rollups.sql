@@ -0,0 +1,36 @@
+-- Summary tables behind /analytics (see analytics_rollups.py). They are
+-- updated in the same transaction as each patient / medical record write
+-- and reconciled with the base tables (corrections go to shard 0, without
+-- locking writers) by `python analytics_rollups.py refresh`.
+
+-- Medical records per visit day
+CREATE TABLE IF NOT EXISTS analytics_daily_records (
+    day DATE PRIMARY KEY,
+    record_count BIGINT NOT NULL DEFAULT 0,
+    records_with_uhid BIGINT NOT NULL DEFAULT 0
+);
+
+-- Medical records per (trimmed) diagnosis
+CREATE TABLE IF NOT EXISTS analytics_diagnosis_counts (
+    diagnosis TEXT PRIMARY KEY,
+    record_count BIGINT NOT NULL DEFAULT 0
+);
+
+-- Patients per date of birth and normalised gender ('male', 'female', 'other').
+-- Unknown dates of birth are stored as '-infinity'. Age buckets are derived at
+-- read time, so the table never goes stale as patients get older.
+CREATE TABLE IF NOT EXISTS analytics_patient_demographics (
+    dob DATE NOT NULL,
+    gender VARCHAR(10) NOT NULL,
+    patient_count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (dob, gender)
+);
+
+-- Single-row bookkeeping. refreshed_at stays NULL until the first full
+-- rebuild; until then /analytics reads the base tables directly.
+CREATE TABLE IF NOT EXISTS analytics_rollup_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    patients_with_records BIGINT NOT NULL DEFAULT 0,
+    refreshed_at TIMESTAMP
+);
+INSERT INTO analytics_rollup_state (id) VALUES (1) ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1,16 @@
+-- migrate:no-transaction
+-- audit_logs viewer filters. Each index leads with the filtered column and
+-- carries the page order (edited_at DESC, id DESC), so a filtered page is a
+-- bounded index range scan whatever the size of patient_edit_history.
+
+-- Filter by editor (user)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_edit_history_editor_edited_at
+    ON patient_edit_history (editor_id, edited_at DESC, id DESC);
+
+-- Filter by patient UHID
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_edit_history_uhid_edited_at
+    ON patient_edit_history (uhid, edited_at DESC, id DESC);
+
+-- Filter by field name (e.g. dr_risk_assessment_performed)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_edit_history_field_edited_at
+    ON patient_edit_history (field_name, edited_at DESC, id DESC);
@@ -0,0 +1,85 @@
+"""
+Converts patient_edit_history into a table range-partitioned by month on
+edited_at.
+
+Rows are copied into the new table inside this migration's transaction, and
+the table is locked for writes meanwhile; run it in a maintenance window
+when the history is large. Monthly partitions are created from the oldest
+row up to three months ahead, and a DEFAULT partition catches anything
+outside them. audit_partitions.py keeps future months created and archives
+old ones.
+
+The primary key becomes (id, edited_at) because a partitioned table's keys
+must include the partition column, so edited_at is now NOT NULL. Legacy rows
+without a timestamp are stored as 1970-01-01 and land in the DEFAULT
+partition.
+"""
+from datetime import date
+
+COLUMNS = "id, patient_id, uhid, editor_id, field_name, old_value, new_value, edited_at"
+MONTHS_AHEAD = 3
+
+
+def _add_months(day, months):
+    month_index = day.year * 12 + day.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def upgrade(cursor):
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('patient_edit_history')")
+    row = cursor.fetchone()
+    if row and row[0] == 'p':
+        print("patient_edit_history is already partitioned.")
+        return
+
+    cursor.execute("LOCK TABLE patient_edit_history IN ACCESS EXCLUSIVE MODE")
+    cursor.execute("SELECT pg_get_serial_sequence('patient_edit_history', 'id')")
+    sequence = cursor.fetchone()[0]
+    cursor.execute("SELECT MIN(edited_at) FROM patient_edit_history")
+    oldest = cursor.fetchone()[0]
+
+    cursor.execute("ALTER TABLE patient_edit_history RENAME TO patient_edit_history_unpartitioned")
+    cursor.execute(f"""
+        CREATE TABLE patient_edit_history (
+            id INTEGER NOT NULL DEFAULT nextval('{sequence}'::regclass),
+            patient_id INTEGER REFERENCES patients(id) ON DELETE CASCADE,
+            uhid VARCHAR(50),
+            editor_id INTEGER NOT NULL,
+            field_name VARCHAR(100) NOT NULL,
+            old_value TEXT,
+            new_value TEXT,
+            edited_at TIMESTAMP NOT NULL DEFAULT NOW()
+        ) PARTITION BY RANGE (edited_at)
+    """)
+    cursor.execute("CREATE TABLE patient_edit_history_default PARTITION OF patient_edit_history DEFAULT")
+
+    first_month = date(oldest.year, oldest.month, 1) if oldest else _add_months(date.today(), 0)
+    last_month = _add_months(date.today(), MONTHS_AHEAD)
+    month = first_month
+    while month <= last_month:
+        cursor.execute(
+            f"""CREATE TABLE patient_edit_history_y{month.year}m{month.month:02d}
+                PARTITION OF patient_edit_history FOR VALUES FROM (%s) TO (%s)""",
+            (month, _add_months(month, 1))
+        )
+        month = _add_months(month, 1)
+
+    cursor.execute(f"""
+        INSERT INTO patient_edit_history ({COLUMNS})
+        SELECT id, patient_id, uhid, editor_id, field_name, old_value, new_value,
+               COALESCE(edited_at, '1970-01-01')
+        FROM patient_edit_history_unpartitioned
+    """)
+    print(f"Copied {cursor.rowcount} rows into the partitioned patient_edit_history.")
+
+    # Keep the id sequence when the old table is dropped
+    cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY patient_edit_history.id")
+    cursor.execute("DROP TABLE patient_edit_history_unpartitioned")
+
+    # Same index names as migrations 0004 and 0008, now partitioned indexes
+    cursor.execute("ALTER TABLE patient_edit_history ADD PRIMARY KEY (id, edited_at)")
+    cursor.execute("CREATE INDEX idx_edit_history_edited_at ON patient_edit_history (edited_at DESC, id DESC)")
+    cursor.execute("CREATE INDEX idx_edit_history_patient_id ON patient_edit_history (patient_id)")
+    cursor.execute("CREATE INDEX idx_edit_history_editor_edited_at ON patient_edit_history (editor_id, edited_at DESC, id DESC)")
+    cursor.execute("CREATE INDEX idx_edit_history_uhid_edited_at ON patient_edit_history (uhid, edited_at DESC, id DESC)")
+    cursor.execute("CREATE INDEX idx_edit_history_field_edited_at ON patient_edit_history (field_name, edited_at DESC, id DESC)")
@@ -0,0 +1,22 @@
+-- Lab test orders submitted to the LIS, previously kept in
+-- downloads/order_history.json. Import an existing file once with
+-- `python lab_orders.py import`.
+CREATE TABLE IF NOT EXISTS lab_orders (
+    id BIGSERIAL PRIMARY KEY,
+    order_id TEXT NOT NULL UNIQUE,
+    external_order_id TEXT,
+    uhid VARCHAR(50),
+    department TEXT,
+    priority TEXT,
+    tests JSONB NOT NULL DEFAULT '[]',
+    specimen TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- /history: one department's orders, newest first
+CREATE INDEX IF NOT EXISTS idx_lab_orders_department_created_at
+    ON lab_orders (department, created_at DESC);
+
+-- Unfiltered history, newest first
+CREATE INDEX IF NOT EXISTS idx_lab_orders_created_at
+    ON lab_orders (created_at DESC);
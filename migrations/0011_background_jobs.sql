@@ -0,0 +1,28 @@
+-- Work handed off from web requests to `python jobs.py worker` (scan
+-- requests, lab report downloads). Workers claim rows with
+-- SELECT ... FOR UPDATE SKIP LOCKED, so several can run side by side.
+CREATE TABLE IF NOT EXISTS background_jobs (
+    job_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'queued'
+        CHECK (status IN ('queued', 'running', 'succeeded', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    polls INTEGER NOT NULL DEFAULT 0,
+    run_after TIMESTAMP NOT NULL DEFAULT NOW(),
+    locked_by TEXT,
+    locked_at TIMESTAMP,
+    result JSONB,
+    error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    finished_at TIMESTAMP
+);
+
+-- Claim query: the next queued job that is due
+CREATE INDEX IF NOT EXISTS idx_background_jobs_due
+    ON background_jobs (run_after) WHERE status = 'queued';
+
+-- Recovery of jobs left running by a worker that died
+CREATE INDEX IF NOT EXISTS idx_background_jobs_running
+    ON background_jobs (locked_at) WHERE status = 'running';
@@ -0,0 +1,4 @@
+-- Order status pushed by the LIS webhook (/api/webhooks/lis) or found by
+-- polling. 'completed' orders are no longer polled.
+ALTER TABLE lab_orders ADD COLUMN IF NOT EXISTS status TEXT;
+ALTER TABLE lab_orders ADD COLUMN IF NOT EXISTS status_updated_at TIMESTAMP;
@@ -0,0 +1,27 @@
+-- Content-addressed storage for downloaded DICOMs and lab reports
+-- (blob_store.py). Each distinct file is stored once, under
+-- downloads/blobs/<aa>/<bb>/<sha256>, and found through any number of
+-- logical names (the file names the pages link to).
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 CHAR(64) PRIMARY KEY,
+    size BIGINT NOT NULL,
+    mime TEXT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_stored_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS blob_refs (
+    name TEXT PRIMARY KEY,
+    sha256 CHAR(64) NOT NULL REFERENCES blobs (sha256),
+    kind TEXT NOT NULL,
+    uhid TEXT,
+    source_id TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Garbage collection: blobs no name points to any more
+CREATE INDEX IF NOT EXISTS idx_blob_refs_sha256 ON blob_refs (sha256);
+
+-- A patient's scans and reports
+CREATE INDEX IF NOT EXISTS idx_blob_refs_uhid ON blob_refs (uhid, created_at DESC);
@@ -0,0 +1,4 @@
+-- One lab_report job per order (scan_jobs.enqueue_lab_report): the
+-- webhook and /history both look up the order's existing job first.
+CREATE INDEX IF NOT EXISTS idx_background_jobs_lab_report_order
+    ON background_jobs ((payload ->> 'order_id')) WHERE kind = 'lab_report';
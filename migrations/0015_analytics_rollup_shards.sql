@@ -0,0 +1,23 @@
+-- Spreads the per-record rollup counters (analytics_rollups.py) over
+-- several rows per key. Every medical record write used to update the same
+-- row (today's day, the single state row), so concurrent writes queued
+-- behind each other's row lock. Writers now pick one of
+-- ANALYTICS_ROLLUP_SHARDS shards; readers sum over the shards.
+ALTER TABLE analytics_daily_records ADD COLUMN IF NOT EXISTS shard SMALLINT NOT NULL DEFAULT 0;
+ALTER TABLE analytics_daily_records DROP CONSTRAINT IF EXISTS analytics_daily_records_pkey;
+ALTER TABLE analytics_daily_records ADD PRIMARY KEY (day, shard);
+
+ALTER TABLE analytics_diagnosis_counts ADD COLUMN IF NOT EXISTS shard SMALLINT NOT NULL DEFAULT 0;
+ALTER TABLE analytics_diagnosis_counts DROP CONSTRAINT IF EXISTS analytics_diagnosis_counts_pkey;
+ALTER TABLE analytics_diagnosis_counts ADD PRIMARY KEY (diagnosis, shard);
+
+-- Patients with at least one medical record, moved out of the single
+-- analytics_rollup_state row
+CREATE TABLE IF NOT EXISTS analytics_patients_with_records (
+    shard SMALLINT PRIMARY KEY,
+    patient_count BIGINT NOT NULL DEFAULT 0
+);
+INSERT INTO analytics_patients_with_records (shard, patient_count)
+SELECT 0, patients_with_records FROM analytics_rollup_state WHERE id = 1
+ON CONFLICT (shard) DO NOTHING;
+ALTER TABLE analytics_rollup_state DROP COLUMN IF EXISTS patients_with_records;
@@ -0,0 +1,389 @@
+"""
+Stand-in LIS / PACS for local development and load tests.
+
+Implements the calls this app makes to DEFAULT_HOST, so ordering tests,
+results, /history and scan requests can be exercised without the real
+lab systems:
+
+    POST /api/orders                       201 {"orderId": ...}
+    GET  /api/orders/<order_id>            the order document; departments go from
+                                           in_progress to completed (with results)
+                                           --complete-after seconds after the order.
+                                           Sent with an ETag (304 for a matching
+                                           If-None-Match) and gzipped when accepted
+    POST /api/v1/get_or_request_scan       202 {"request_id": ...}, or 200 with the
+                                           DICOM at once (--immediate-scan-rate)
+    GET  /api/request_status/<request_id>  {"status": "pending" | "attended", "scan_id": ...}
+    GET  /api/scans/download/<scan_id>     a synthetic DICOM file
+
+    GET  /__mock/stats                     calls per endpoint and status code
+    POST /__mock/reset                     clears the counters
+
+Run it and point the app (and the job worker) at it:
+
+    python mock_lab_server.py --port 8900 --latency 0.05 --jitter 0.05 --failure-rate 0.01
+    LAB_HOST=http://127.0.0.1:8900 python app.py
+    LAB_HOST=http://127.0.0.1:8900 python jobs.py worker
+
+Every lab call waits --latency plus up to --jitter seconds; --failure-rate
+of them answer 503 and --hang-rate of them do not answer for --hang-time
+seconds (longer than the app's timeouts), to exercise retries and circuit
+breakers. Orders the mock has never seen (e.g. ids already in lab_orders)
+are made up on first lookup unless --strict is given.
+
+With --webhook-url (the app's base URL) and WEBHOOK_SECRET set, completed
+orders and attended scans are also pushed to /api/webhooks/lis and
+/api/webhooks/pacs, signed the way webhooks.py expects.
+"""
+import argparse
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import requests
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import WSGIRequestHandler
+
+MOCK_API_KEY = os.environ.get('LIS_API_KEY', 'hospital_shared_key')
+
+app = Flask(__name__)
+config = {
+    'latency': 0.05,
+    'jitter': 0.05,
+    'failure_rate': 0.0,
+    'hang_rate': 0.0,
+    'hang_time': 60.0,
+    'complete_after': 10.0,
+    'scan_after': 5.0,
+    'immediate_scan_rate': 0.0,
+    'image_size': 256,
+    'strict': False,
+    'webhook_url': None,
+    'webhook_secret': os.environ.get('WEBHOOK_SECRET'),
+}
+
+_lock = threading.Lock()
+_orders = {}  # order_id -> order as submitted, plus 'created'
+_scan_requests = {}  # request_id -> {'created', 'uhid', 'scan_id'}
+_counts = {}  # endpoint -> {status_code: n}
+_started = time.time()
+
+
+# --- synthetic payloads ---
+
+def _stable_random(*parts):
+    """A Random seeded by `parts`, so an order looks the same on every lookup."""
+    return random.Random(hashlib.sha256('|'.join(map(str, parts)).encode()).hexdigest())
+
+
+def _results(order_id, department, tests):
+    rnd = _stable_random(order_id, department)
+    results = []
+    for test in tests:
+        code = test.get('testCode') if isinstance(test, dict) else test
+        if department == 'biochemistry':
+            low, high = 70, 110
+            value = round(rnd.uniform(50, 140), 1)
+            results.append({
+                'testCode': code, 'value': value, 'unit': 'mg/dL',
+                'flag': 'H' if value > high else 'L' if value < low else 'N',
+                'referenceRange': {'low': low, 'high': high},
+            })
+        elif department == 'microbiology':
+            growth = rnd.random() < 0.3
+            results.append({
+                'testCode': code,
+                'findings': 'Growth of E. coli' if growth else 'No growth after 48 hours',
+                'abnormalFindings': 'Significant growth' if growth else 'None',
+                'impression': 'Positive' if growth else 'Negative',
+            })
+        else:
+            results.append({
+                'testCode': code,
+                'specimenNature': 'Tissue biopsy',
+                'surgeryName': 'Excision biopsy',
+                'grossFindings': 'Grey-white tissue bit measuring 1 x 1 cm',
+                'microscopicExamination': 'Sections show benign features',
+                'intraoperativeFindings': 'None',
+                'impression': 'Benign' if rnd.random() < 0.8 else 'Suspicious for malignancy',
+                'reportingDoctor': 'Dr. Mock Pathologist',
+            })
+    return results
+
+
+def _made_up_order(order_id):
+    rnd = _stable_random(order_id)
+    department = rnd.choice(['biochemistry', 'microbiology', 'pathology'])
+    return {
+        'externalOrderId': None,
+        'priority': 'routine',
+        'patient': {'uhid': f"UH{rnd.randint(1000, 9999)}", 'name': 'Mock Patient'},
+        'clinician': {'name': f"Dr. {department.title()}", 'department': department},
+        'tests': [{'testCode': 'CBC'}],
+        'specimen': 'Blood',
+        'clinicalNotes': '',
+    }
+
+
+def _order_document(order_id, order):
+    department = (order.get('clinician') or {}).get('department', 'biochemistry').lower()
+    completed = time.time() - order['created'] >= config['complete_after']
+    return {
+        'orderId': order_id,
+        'externalOrderId': order.get('externalOrderId'),
+        'priority': order.get('priority'),
+        'receivedAt': datetime.fromtimestamp(order['created']).isoformat(),
+        'patient': order.get('patient'),
+        'clinician': order.get('clinician'),
+        'tests': order.get('tests'),
+        'specimen': order.get('specimen'),
+        'perDepartment': [{
+            'department': department,
+            'status': 'completed' if completed else 'in_progress',
+            'results': _results(order_id, department, order.get('tests') or []) if completed else [],
+        }],
+    }
+
+
+def _element(group, elem, vr, value):
+    """One explicit VR little endian data element."""
+    if isinstance(value, str):
+        value = value.encode()
+        if len(value) % 2:
+            value += b'\0' if vr == 'UI' else b' '
+    elif len(value) % 2:
+        value += b'\0'
+    header = struct.pack('<HH', group, elem) + vr.encode()
+    if vr in ('OB', 'OW', 'SQ', 'UN', 'UT'):
+        return header + b'\0\0' + struct.pack('<I', len(value)) + value
+    return header + struct.pack('<H', len(value)) + value
+
+
+def synthetic_dicom(scan_id, uhid='MOCK', size=None):
+    """A small, valid Secondary Capture DICOM file with a size x size 8-bit gradient image."""
+    size = size or config['image_size']
+    sop_class = '1.2.840.10008.5.1.4.1.1.7'
+    sop_instance = f"2.25.{uuid.uuid5(uuid.NAMESPACE_URL, str(scan_id)).int}"
+    explicit_le = '1.2.840.10008.1.2.1'
+    meta = (_element(0x0002, 0x0001, 'OB', b'\0\1')
+            + _element(0x0002, 0x0002, 'UI', sop_class)
+            + _element(0x0002, 0x0003, 'UI', sop_instance)
+            + _element(0x0002, 0x0010, 'UI', explicit_le))
+    us = lambda v: struct.pack('<H', v)  # noqa: E731
+    pixels = bytes((x + y) % 256 for y in range(size) for x in range(size))
+    dataset = (_element(0x0008, 0x0016, 'UI', sop_class)
+               + _element(0x0008, 0x0018, 'UI', sop_instance)
+               + _element(0x0008, 0x0060, 'CS', 'OT')
+               + _element(0x0010, 0x0010, 'PN', 'Mock^Patient')
+               + _element(0x0010, 0x0020, 'LO', str(uhid))
+               + _element(0x0028, 0x0002, 'US', us(1))
+               + _element(0x0028, 0x0004, 'CS', 'MONOCHROME2')
+               + _element(0x0028, 0x0010, 'US', us(size))
+               + _element(0x0028, 0x0011, 'US', us(size))
+               + _element(0x0028, 0x0100, 'US', us(8))
+               + _element(0x0028, 0x0101, 'US', us(8))
+               + _element(0x0028, 0x0102, 'US', us(7))
+               + _element(0x0028, 0x0103, 'US', us(0))
+               + _element(0x7FE0, 0x0010, 'OB', pixels))
+    return (b'\0' * 128 + b'DICM'
+            + _element(0x0002, 0x0000, 'UL', struct.pack('<I', len(meta))) + meta
+            + dataset)
+
+
+# --- webhooks ---
+
+def _push(path, event):
+    # Same signature as webhooks.sign(): HMAC-SHA256 over "<timestamp>." + body
+    body = json.dumps(event).encode()
+    timestamp = str(int(time.time()))
+    digest = hmac.new(config['webhook_secret'].encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    try:
+        resp = requests.post(f"{config['webhook_url'].rstrip('/')}{path}", data=body, timeout=10, headers={
+            'Content-Type': 'application/json',
+            'X-Webhook-Timestamp': timestamp,
+            'X-Webhook-Signature': f"sha256={digest}",
+        })
+        print(f"Webhook {path} {event.get('orderId') or event.get('request_id')}: {resp.status_code}")
+    except requests.RequestException as e:
+        print(f"⚠️ Webhook {path} failed: {e}")
+
+
+def _push_later(delay, path, event_factory):
+    if config['webhook_url'] and config['webhook_secret']:
+        timer = threading.Timer(delay, lambda: _push(path, event_factory()))
+        timer.daemon = True
+        timer.start()
+
+
+# --- fault injection and counters ---
+
+@app.before_request
+def inject_faults():
+    if request.path.startswith('/__mock/'):
+        return None
+    time.sleep(config['latency'] + random.uniform(0, config['jitter']))
+    roll = random.random()
+    if roll < config['hang_rate']:
+        time.sleep(config['hang_time'])
+    elif roll < config['hang_rate'] + config['failure_rate']:
+        return jsonify({'error': 'Service temporarily unavailable (mock)'}), 503
+    return None
+
+
+@app.after_request
+def count_response(resp):
+    if not request.path.startswith('/__mock/'):
+        with _lock:
+            by_status = _counts.setdefault(request.endpoint or 'unknown', {})
+            by_status[resp.status_code] = by_status.get(resp.status_code, 0) + 1
+    return resp
+
+
+def _check_api_key():
+    if request.headers.get('X-API-Key') != MOCK_API_KEY:
+        return jsonify({'error': 'Unauthorized. Invalid or missing API key.'}), 401
+    return None
+
+
+# --- LIS ---
+
+@app.route('/api/orders', methods=['POST'])
+def create_order():
+    denied = _check_api_key()
+    if denied:
+        return denied
+    order = request.get_json(silent=True) or {}
+    if not order.get('tests'):
+        return jsonify({'error': 'At least one test is required'}), 400
+    order_id = f"ORD{uuid.uuid4().hex[:10].upper()}"
+    with _lock:
+        _orders[order_id] = dict(order, created=time.time())
+    _push_later(config['complete_after'], '/api/webhooks/lis',
+                lambda: {'orderId': order_id, 'order': _order_document(order_id, _orders[order_id])})
+    return jsonify({'orderId': order_id, 'status': 'received'}), 201
+
+
+@app.route('/api/orders/<order_id>')
+def get_order(order_id):
+    denied = _check_api_key()
+    if denied:
+        return denied
+    with _lock:
+        order = _orders.get(order_id)
+        if order is None:
+            if config['strict']:
+                return jsonify({'error': 'Order not found'}), 404
+            order = _orders[order_id] = dict(_made_up_order(order_id), created=time.time())
+    body = json.dumps(_order_document(order_id, order)).encode()
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers={'ETag': etag})
+    resp = Response(body, mimetype='application/json', headers={'ETag': etag})
+    if 'gzip' in request.headers.get('Accept-Encoding', '') and len(body) > 1024:
+        resp.set_data(gzip.compress(body))
+        resp.headers['Content-Encoding'] = 'gzip'
+    return resp
+
+
+# --- PACS ---
+
+@app.route('/api/v1/get_or_request_scan', methods=['POST'])
+def get_or_request_scan():
+    body = request.get_json(silent=True) or {}
+    if not all(body.get(k) for k in ('uhid', 'type_of_scan', 'body_part')):
+        return jsonify({'error': 'uhid, type_of_scan and body_part are required'}), 400
+    if random.random() < config['immediate_scan_rate']:
+        return Response(synthetic_dicom(uuid.uuid4().hex, body['uhid']), mimetype='application/dicom')
+    request_id = uuid.uuid4().hex
+    with _lock:
+        _scan_requests[request_id] = {'created': time.time(), 'uhid': body['uhid'], 'scan_id': f"SCAN{request_id[:12]}"}
+    scan_id = _scan_requests[request_id]['scan_id']
+    _push_later(config['scan_after'], '/api/webhooks/pacs',
+                lambda: {'request_id': request_id, 'status': 'attended', 'scan_id': scan_id})
+    return jsonify({'request_id': request_id, 'status': 'pending'}), 202
+
+
+@app.route('/api/request_status/<request_id>')
+def request_status(request_id):
+    with _lock:
+        scan_request = _scan_requests.get(request_id)
+    if scan_request is None:
+        return jsonify({'error': 'Request not found'}), 404
+    if time.time() - scan_request['created'] < config['scan_after']:
+        return jsonify({'request_id': request_id, 'status': 'pending'})
+    return jsonify({'request_id': request_id, 'status': 'attended', 'scan_id': scan_request['scan_id']})
+
+
+@app.route('/api/scans/download/<scan_id>')
+def download_scan(scan_id):
+    uhid = next((r['uhid'] for r in list(_scan_requests.values()) if r['scan_id'] == scan_id), 'MOCK')
+    return Response(synthetic_dicom(scan_id, uhid), mimetype='application/dicom',
+                    headers={'Content-Disposition': f'attachment; filename="{uhid}_{scan_id}.dcm"'})
+
+
+# --- mock control ---
+
+@app.route('/__mock/stats')
+def mock_stats():
+    with _lock:
+        counts = {endpoint: dict(by_status) for endpoint, by_status in _counts.items()}
+        orders, scan_requests = len(_orders), len(_scan_requests)
+    return jsonify({
+        'uptime': round(time.time() - _started, 1),
+        'config': {k: v for k, v in config.items() if k != 'webhook_secret'},
+        'requests': counts,
+        'total_requests': sum(sum(by_status.values()) for by_status in counts.values()),
+        'orders': orders,
+        'scan_requests': scan_requests,
+    })
+
+
+@app.route('/__mock/reset', methods=['POST'])
+def mock_reset():
+    with _lock:
+        _counts.clear()
+    return jsonify({'reset': True})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a stand-in LIS / PACS server.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=config['latency'], help="Base delay per call (s)")
+    parser.add_argument('--jitter', type=float, default=config['jitter'], help="Extra random delay per call, up to (s)")
+    parser.add_argument('--failure-rate', type=float, default=config['failure_rate'], help="Share of calls answered 503")
+    parser.add_argument('--hang-rate', type=float, default=config['hang_rate'], help="Share of calls that stall")
+    parser.add_argument('--hang-time', type=float, default=config['hang_time'], help="How long a stalled call waits (s)")
+    parser.add_argument('--complete-after', type=float, default=config['complete_after'],
+                        help="Seconds until an order's results are in")
+    parser.add_argument('--scan-after', type=float, default=config['scan_after'],
+                        help="Seconds until a scan request is attended")
+    parser.add_argument('--immediate-scan-rate', type=float, default=config['immediate_scan_rate'],
+                        help="Share of scan requests answered with the DICOM at once")
+    parser.add_argument('--image-size', type=int, default=config['image_size'], help="DICOM image width and height")
+    parser.add_argument('--strict', action='store_true', help="404 for orders not created on this server")
+    parser.add_argument('--webhook-url', help="App base URL to push completion webhooks to")
+    args = parser.parse_args(argv)
+
+    config.update({k: v for k, v in vars(args).items() if k in config})
+    if config['webhook_url'] and not config['webhook_secret']:
+        print("⚠️ --webhook-url given but WEBHOOK_SECRET is not set; webhooks will not be sent.")
+    # Keep-alive, like the real servers behind DEFAULT_HOST
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    print(f"✅ Mock LIS/PACS on http://{args.host}:{args.port} "
+          f"(latency {args.latency}s +{args.jitter}s, failures {args.failure_rate:.0%}, hangs {args.hang_rate:.0%})")
+    app.run(host=args.host, port=args.port, threaded=True, use_reloader=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
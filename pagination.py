@@ -0,0 +1,38 @@
+"""
+Helpers for keyset (seek) pagination.
+
+A cursor is the sort key of the last row on a page, serialised as URL-safe
+base64 JSON so it can be passed back in a query string.
+"""
+import base64
+import json
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), default=str, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, length=None):
+    """Returns the list of key values in a cursor, or None if it is missing or malformed."""
+    if not token:
+        return None
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded).decode())
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if not isinstance(values, list) or (length is not None and len(values) != length):
+        return None
+    return values
+
+
+def clamp_page_size(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, maximum))
@@ -0,0 +1,73 @@
+"""
+Paged patient directory for the dashboard.
+
+Pages are read with keyset (seek) pagination on (last_name, first_name, id),
+served by idx_patients_name_order (migration 0006), so every page costs the
+same regardless of how deep into the registry it is.
+"""
+from pagination import encode_cursor, decode_cursor
+
+_COLUMNS = "uhid, first_name, last_name, dob, gender, id"
+
+
+def decode_directory_cursor(token):
+    """Returns (last_name, first_name, id) from a directory cursor, or None."""
+    values = decode_cursor(token, length=3)
+    if values is None:
+        return None
+    last_name, first_name, patient_id = values
+    if not isinstance(last_name, str) or not isinstance(first_name, str) or not isinstance(patient_id, int):
+        return None
+    # A tampered cursor must not reach the query as a type or a string Postgres rejects
+    if isinstance(patient_id, bool) or '\x00' in last_name or '\x00' in first_name:
+        return None
+    return last_name, first_name, patient_id
+
+
+def _sort_key(row):
+    # row is (uhid, first_name, last_name, dob, gender, id)
+    return [row[2], row[1], row[5]]
+
+
+def list_patients_page(cursor, limit, after=None, before=None):
+    """
+    Returns (rows, next_cursor, prev_cursor) for one page of the directory.
+    rows are (uhid, first_name, last_name, dob, gender). Pass at most one of
+    `after` / `before` (decoded cursors) to move forwards or backwards.
+    """
+    if before is not None:
+        cursor.execute(
+            f"""SELECT {_COLUMNS} FROM patients
+                WHERE (last_name, first_name, id) < (%s, %s, %s)
+                ORDER BY last_name DESC, first_name DESC, id DESC
+                LIMIT %s""",
+            (*before, limit + 1)
+        )
+        rows = cursor.fetchall()
+        has_more_before = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+        next_cursor = encode_cursor(_sort_key(rows[-1])) if rows else None
+        prev_cursor = encode_cursor(_sort_key(rows[0])) if rows and has_more_before else None
+    else:
+        if after is not None:
+            cursor.execute(
+                f"""SELECT {_COLUMNS} FROM patients
+                    WHERE (last_name, first_name, id) > (%s, %s, %s)
+                    ORDER BY last_name, first_name, id
+                    LIMIT %s""",
+                (*after, limit + 1)
+            )
+        else:
+            cursor.execute(
+                f"""SELECT {_COLUMNS} FROM patients
+                    ORDER BY last_name, first_name, id
+                    LIMIT %s""",
+                (limit + 1,)
+            )
+        rows = cursor.fetchall()
+        has_more_after = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = encode_cursor(_sort_key(rows[-1])) if rows and has_more_after else None
+        prev_cursor = encode_cursor(_sort_key(rows[0])) if rows and after is not None else None
+
+    return [tuple(r[:5]) for r in rows], next_cursor, prev_cursor
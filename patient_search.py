@@ -0,0 +1,95 @@
+"""
+Patient search backed by pg_trgm.
+
+Exact UHID lookups take the unique index; everything else is a trigram
+match on UHID and names (GIN indexes from migration 0005), ranked by
+similarity with prefix matches first, and returned one bounded page at a
+time using a keyset cursor on (rank, id).
+"""
+from decimal import Decimal, InvalidOperation
+
+from pagination import encode_cursor, decode_cursor
+
+SEARCH_PAGE_SIZE = 25
+
+_SEARCH_SQL = """
+    SELECT uhid, first_name, last_name, dob, gender, rank, id
+    FROM (
+        SELECT id, uhid, first_name, last_name, dob, gender,
+               ROUND((
+                   CASE WHEN uhid ILIKE %(prefix)s OR first_name ILIKE %(prefix)s
+                             OR last_name ILIKE %(prefix)s THEN 1 ELSE 0 END
+                   + GREATEST(
+                       similarity(uhid, %(q)s),
+                       similarity(first_name, %(q)s),
+                       similarity(last_name, %(q)s),
+                       similarity(first_name || ' ' || last_name, %(q)s)
+                   )
+               )::numeric, 4) AS rank
+        FROM patients
+        WHERE uhid ILIKE %(contains)s
+           OR first_name ILIKE %(contains)s
+           OR last_name ILIKE %(contains)s
+           OR (first_name || ' ' || last_name) %% %(q)s
+    ) matches
+    {keyset}
+    ORDER BY rank DESC, id
+    LIMIT %(limit)s
+"""
+_KEYSET_SQL = "WHERE rank < %(after_rank)s OR (rank = %(after_rank)s AND id > %(after_id)s)"
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def decode_search_cursor(token):
+    """Returns (rank, id) from a search cursor, or None if it is malformed."""
+    values = decode_cursor(token, length=2)
+    if values is None:
+        return None
+    try:
+        return Decimal(values[0]), int(values[1])
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+
+
+def search_patients(cursor, query, limit=SEARCH_PAGE_SIZE, after=None):
+    """
+    Searches patients by UHID or name.
+    Returns (rows, next_cursor); rows are (uhid, first_name, last_name, dob, gender, rank).
+    """
+    query = (query or '').strip()
+    if not query:
+        return [], None
+
+    # Exact UHID fast path (unique index), only for the first page
+    if after is None:
+        cursor.execute(
+            "SELECT uhid, first_name, last_name, dob, gender FROM patients WHERE uhid = %s",
+            (query,)
+        )
+        row = cursor.fetchone()
+        if row:
+            return [tuple(row) + (None,)], None
+
+    params = {
+        'q': query,
+        'prefix': _escape_like(query) + '%',
+        'contains': '%' + _escape_like(query) + '%',
+        # One extra row tells us whether there is a next page
+        'limit': limit + 1,
+    }
+    keyset = ''
+    if after is not None:
+        keyset = _KEYSET_SQL
+        params['after_rank'], params['after_id'] = after
+    cursor.execute(_SEARCH_SQL.format(keyset=keyset), params)
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([str(last[5]), last[6]])
+    return [tuple(r[:6]) for r in rows], next_cursor
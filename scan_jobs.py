@@ -0,0 +1,213 @@
+"""
+Background job handlers for scan requests (PACS) and lab reports (LIS).
+
+A scan request is submitted once; if the PACS answers 202 the job keeps
+polling /api/request_status/<id> until the scan is attended, then downloads
+the DICOM into the blob store (blob_store.py). A lab report job polls the
+order until a department has completed results and stores the order JSON.
+The job result names the stored file ('dicom_file' / 'report_file').
+
+When the PACS / LIS calls our webhooks (webhooks.py) the waiting job is
+run at once with the pushed details, so polling is only the fallback for
+missed callbacks.
+
+Polls start every `poll_interval_s` seconds and back off by
+JOB_POLL_BACKOFF per attempt up to JOB_POLL_MAX_INTERVAL, until the job's
+`timeout_s` deadline. Between polls the job waits in the queue (see
+jobs.RetryLater), not on a worker thread. The worker and the web app must
+share BLOB_STORE_DIR.
+"""
+import json
+import os
+import time
+
+import requests
+
+import http_client
+from blob_store import BLOB_CHUNK_SIZE, store_blob
+from jobs import JobFailed, RetryLater, enqueue_job, job_handler, wake_jobs
+from lab_status import SHARED_API_KEY, get_order
+
+JOB_POLL_BACKOFF = float(os.environ.get('JOB_POLL_BACKOFF', 1.5))
+JOB_POLL_MAX_INTERVAL = float(os.environ.get('JOB_POLL_MAX_INTERVAL', 30))
+
+SCAN_REQUEST = 'scan_request'
+LAB_REPORT = 'lab_report'
+
+
+def download_scan(host, scan_id, uhid=None):
+    """Downloads a scan by its ID into the blob store and returns its file name."""
+    url = f"{host.rstrip('/')}/api/scans/download/{scan_id}"
+    try:
+        with http_client.get(url, stream=True, timeout=30, endpoint='pacs.scan_download') as r:
+            if r.ok:
+                disp = r.headers.get('Content-Disposition', '')
+                if 'filename=' in disp:
+                    fname = os.path.basename(disp.split('filename=')[-1].strip(' "'))
+                else:
+                    # Named by the scan, so downloading it again replaces rather than adds a file
+                    fname = f"{uhid or 'scan'}_{scan_id}.dcm"
+                store_blob(r.iter_content(BLOB_CHUNK_SIZE), fname, 'dicom', 'application/dicom',
+                           uhid=uhid, source_id=scan_id)
+                return fname
+            else:
+                return None
+    except Exception:
+        return None
+
+
+def _poll_again(payload, min_delay=0):
+    """Reschedules a polling job with a longer interval, or fails it once its deadline has passed."""
+    remaining = payload['deadline'] - time.time()
+    if remaining <= 0:
+        raise JobFailed("Polling timed out or the final download failed.")
+    interval = payload['poll_interval_s']
+    payload = dict(payload, poll_interval_s=min(interval * JOB_POLL_BACKOFF, JOB_POLL_MAX_INTERVAL))
+    raise RetryLater(min(max(interval, min_delay), remaining), payload)
+
+
+def enqueue_scan_request(host, department, uhid, scan_type, body_part, poll_interval_s=3.0, timeout_s=300.0):
+    """Queues a scan request and returns the job id."""
+    return enqueue_job(SCAN_REQUEST, {
+        'host': host,
+        'department': department,
+        'uhid': uhid,
+        'scan_type': scan_type,
+        'body_part': body_part,
+        'poll_interval_s': poll_interval_s,
+        'timeout_s': timeout_s,
+    })
+
+
+@job_handler(SCAN_REQUEST)
+def run_scan_request(payload):
+    host = payload['host']
+    if payload.get('request_id'):
+        return _poll_scan(payload)
+
+    url = f"{host.rstrip('/')}/api/v1/get_or_request_scan"
+    body = {
+        "department_name": payload['department'],
+        "uhid": payload['uhid'],
+        "type_of_scan": payload['scan_type'],
+        "body_part": payload['body_part']
+    }
+    headers = {'Accept': 'application/json, application/dicom, */*'}
+    # The submission is not idempotent: it is only sent again when it never
+    # reached the PACS. Once it has, any failure ends the job rather than
+    # filing a second scan request.
+    try:
+        resp = http_client.post(url, json=body, headers=headers, timeout=30, stream=True,
+                                endpoint='pacs.scan_request')
+    except http_client.CircuitOpenError as e:
+        raise RetryLater(e.retry_after, payload)
+    except requests.RequestException as e:
+        if http_client.could_not_connect(e):
+            raise
+        raise JobFailed(f"Scan request failed after it was sent; not resubmitting: {e}")
+    with resp:
+        try:
+            return _submitted_scan(payload, resp)
+        except (JobFailed, RetryLater):
+            raise
+        except Exception as e:
+            raise JobFailed(f"Could not handle the PACS answer; not resubmitting: {e}")
+
+
+def _submitted_scan(payload, resp):
+    """Handles the PACS answer to a scan request: a DICOM at once (200) or a request to poll (202)."""
+    if resp.status_code == 200:
+        if 'application/json' in resp.headers.get('Content-Type', '').lower():
+            raise JobFailed(f"Received unexpected JSON: {resp.json()}")
+        # No scan id to name it by; named by its content instead
+        def dicom_name(sha256):
+            return f"{payload['uhid'] or 'scan'}_{sha256[:16]}.dcm"
+        sha256 = store_blob(resp.iter_content(BLOB_CHUNK_SIZE), dicom_name, 'dicom', 'application/dicom',
+                            uhid=payload['uhid'])
+        return {'dicom_file': dicom_name(sha256)}
+
+    if resp.status_code == 202:
+        j = resp.json()
+        request_id = j.get('request_id') or j.get('id')
+        if not request_id:
+            raise JobFailed(f"Server returned 202 but no request_id was found: {j}")
+        payload = dict(payload, request_id=request_id, deadline=time.time() + payload['timeout_s'])
+        raise RetryLater(payload['poll_interval_s'], payload)
+
+    raise JobFailed(f"Server returned error {resp.status_code}: {resp.text[:400]}")
+
+
+def _poll_scan(payload):
+    host = payload['host']
+    if payload.get('scan_id'):
+        # Reported by the PACS webhook; no need to ask for the status
+        fname = download_scan(host, payload['scan_id'], payload['uhid'])
+        if not fname:
+            raise RuntimeError(f"Download of scan {payload['scan_id']} failed")
+        return {'dicom_file': fname}
+    status_url = f"{host.rstrip('/')}/api/request_status/{payload['request_id']}"
+    try:
+        r = http_client.get(status_url, timeout=15, endpoint='pacs.request_status')
+        if r.ok:
+            j = r.json()
+            status = j.get('status')
+            scan_id = j.get('scan_id')
+            if status and status.lower() in ('attended', 'completed') and scan_id:
+                fname = download_scan(host, scan_id, payload['uhid'])
+                if not fname:
+                    raise RuntimeError(f"Download of scan {scan_id} failed")
+                return {'dicom_file': fname}
+    except http_client.CircuitOpenError as e:
+        # The PACS is down; don't ask again before the breaker lets a probe through
+        _poll_again(payload, e.retry_after)
+    except requests.RequestException:
+        # Ignore connection errors and continue polling
+        pass
+    _poll_again(payload)
+
+
+def wake_scan_request(request_id, scan_id=None):
+    """Runs the job waiting on PACS request `request_id` now; with `scan_id` it downloads without polling."""
+    return wake_jobs(SCAN_REQUEST, 'request_id', request_id, {'scan_id': scan_id} if scan_id else None)
+
+
+def enqueue_lab_report(host, order_id, uhid, poll_interval_s=10.0, timeout_s=6 * 3600, order=None):
+    """
+    Queues a job that saves the order's report once results are in, and
+    returns the job id. `order` is a document already received (webhook).
+    An order gets one report job: if one is already queued, running or
+    done, its id is returned instead.
+    """
+    return enqueue_job(LAB_REPORT, {
+        'host': host,
+        'order_id': order_id,
+        'uhid': uhid,
+        'poll_interval_s': poll_interval_s,
+        'deadline': time.time() + timeout_s,
+        'order': order,
+    }, unique_key='order_id')
+
+
+def _has_results(order):
+    return any(d.get('status') == 'completed' and d.get('results') for d in order.get('perDepartment', []))
+
+
+@job_handler(LAB_REPORT)
+def run_lab_report(payload):
+    order_id = payload['order_id']
+    try:
+        order = payload.get('order')
+        if not order or not _has_results(order):
+            status_code, order = get_order(payload['host'], SHARED_API_KEY, order_id, timeout=15)
+            if status_code != 200:
+                order = None
+        if order and _has_results(order):
+            fname = f"{payload['uhid'] or 'patient'}_{order_id}.json"
+            store_blob([json.dumps(order).encode('utf-8')], fname, 'lab_report', 'application/json',
+                       uhid=payload['uhid'], source_id=order_id)
+            return {'report_file': fname}
+    except http_client.CircuitOpenError as e:
+        _poll_again(payload, e.retry_after)
+    except requests.RequestException:
+        pass
+    _poll_again(payload)
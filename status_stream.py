@@ -0,0 +1,294 @@
+"""
+Server-Sent Events for lab order and scan job status.
+
+Pages open one EventSource on /api/status/stream?orders=ORD1,ORD2&jobs=<id>
+instead of polling /api/status/<order_id> themselves. Each worker runs a
+single StatusHub:
+
+  * One refresher thread looks up every order / job that at least one open
+    stream is watching, every SSE_REFRESH_INTERVAL seconds. Orders go
+    through lab_status.get_order, so a hundred tabs watching one order cost
+    one upstream call per cache TTL, not one per tab.
+  * One listener thread LISTENs on the `status_events` channel. The LIS
+    webhook and finishing jobs NOTIFY it (notify_status_change), so pushed
+    changes reach every worker's streams at once instead of at the next
+    refresh. Other workers drop their cached copy of a notified order; the
+    worker that sent the notification keeps the document the webhook just
+    cached.
+
+Every change gets the next sequence number of this hub; that is the SSE
+event id. A reconnecting EventSource sends it back as Last-Event-ID and
+only gets what changed since. An id from another worker (or an earlier
+process) cannot be compared, so that client gets the current state of all
+its topics again.
+
+Each stream holds a server thread, so the web workers must be threaded
+(gunicorn.conf.py runs gthread workers with GUNICORN_THREADS threads). A
+worker serves at most SSE_MAX_STREAMS streams, by default half its threads
+(503 beyond that; the pages fall back to polling), and closes each after
+SSE_MAX_DURATION seconds. The browser reconnects on
+its own. A comment line is sent every SSE_HEARTBEAT seconds so proxies keep
+idle streams open.
+"""
+import json
+import os
+import select
+import socket
+import threading
+import time
+import uuid
+
+from database import db_connection, open_connection
+from jobs import get_job
+from lab_status import SHARED_API_KEY, fetch_orders, forget_order, is_final, order_status_summary
+
+# Leaves the other half of the worker's threads for page requests
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', int(os.environ.get('GUNICORN_THREADS', 32)) // 2))
+SSE_MAX_TOPICS = int(os.environ.get('SSE_MAX_TOPICS', 200))
+SSE_HEARTBEAT = float(os.environ.get('SSE_HEARTBEAT', 15))
+SSE_MAX_DURATION = float(os.environ.get('SSE_MAX_DURATION', 300))
+SSE_REFRESH_INTERVAL = float(os.environ.get('SSE_REFRESH_INTERVAL', 5))
+# Browsers wait this long (ms) before reconnecting a closed stream
+SSE_RETRY_MS = 3000
+
+STATUS_CHANNEL = 'status_events'
+FINAL_JOB_STATES = ('succeeded', 'failed')
+
+
+class StreamLimitReached(Exception):
+    pass
+
+
+def _origin():
+    # Identifies this process in notifications; checked per call because of fork
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def notify_status_change(kind, topic_id, cursor=None):
+    """
+    Tells every worker's hub that `kind` ('order' / 'job') `topic_id`
+    changed. With `cursor` the notification is sent when the caller's
+    transaction commits.
+    """
+    payload = f"{kind}:{topic_id} {_origin()}"
+    if cursor is not None:
+        cursor.execute("SELECT pg_notify(%s, %s)", (STATUS_CHANNEL, payload))
+        return
+    with db_connection() as conn:
+        if not conn:
+            raise RuntimeError("Could not connect to database to send status notification.")
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", (STATUS_CHANNEL, payload))
+        conn.commit()
+
+
+def _sse(data, event=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, default=str)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+class StatusHub:
+    def __init__(self, host):
+        self.host = host
+        self.epoch = uuid.uuid4().hex[:8]
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._states = {}  # topic -> (seq, data, final)
+        self._watchers = {}  # topic -> number of open streams
+        self._dirty = set()  # topics to refresh before the next interval
+        self._wake = threading.Event()
+        self._streams = 0
+        self._pid = os.getpid()
+        self.stats = {'streams_opened': 0, 'streams_rejected': 0, 'events': 0, 'refreshes': 0, 'notifications': 0}
+        for target, name in ((self._refresh_loop, 'sse-refresh'), (self._listen_loop, 'sse-listen')):
+            threading.Thread(target=target, name=name, daemon=True).start()
+
+    # --- state ---
+
+    def publish(self, topic, data, final=False):
+        with self._cond:
+            current = self._states.get(topic)
+            if current is not None and current[1] == data:
+                return
+            self._seq += 1
+            self._states[topic] = (self._seq, data, final)
+            self.stats['events'] += 1
+            self._cond.notify_all()
+
+    def mark_dirty(self, topic):
+        with self._cond:
+            self._dirty.add(topic)
+        self._wake.set()
+
+    def _refresh(self, topics):
+        self.stats['refreshes'] += 1
+        orders = [t.split(':', 1)[1] for t in topics if t.startswith('order:')]
+        jobs = [t.split(':', 1)[1] for t in topics if t.startswith('job:')]
+        for job_id in jobs:
+            try:
+                job = get_job(job_id)
+            except Exception as e:
+                print(f"⚠️ Status stream could not read job {job_id}: {e}")
+                continue
+            if job is None:
+                self.publish(f"job:{job_id}", {'type': 'job', 'id': job_id, 'status': 'unknown'}, final=True)
+            else:
+                self.publish(f"job:{job_id}", {'type': 'job', 'id': job_id, 'status': job['status'],
+                                               'result': job['result'], 'error': job['error']},
+                             final=job['status'] in FINAL_JOB_STATES)
+        # Orders that fail or are slow keep their last known state until the next round
+        for order_id, (status_code, order) in fetch_orders(self.host, SHARED_API_KEY, orders).items():
+            if status_code == 200:
+                self.publish(f"order:{order_id}", dict(order_status_summary(order_id, order), type='order', id=order_id),
+                             final=is_final(order))
+            elif status_code == 404:
+                self.publish(f"order:{order_id}", {'type': 'order', 'id': order_id, 'status': 'unknown'}, final=True)
+
+    def _refresh_loop(self):
+        while True:
+            self._wake.wait(SSE_REFRESH_INTERVAL)
+            self._wake.clear()
+            with self._cond:
+                dirty, self._dirty = self._dirty, set()
+                watched = [t for t, n in self._watchers.items()
+                           if n > 0 and (t in dirty or t not in self._states or not self._states[t][2])]
+            if watched:
+                try:
+                    self._refresh(watched)
+                except Exception as e:
+                    print(f"❌ Status stream refresh failed: {e}")
+
+    def _listen_loop(self):
+        while True:
+            conn = None
+            try:
+                conn = open_connection()
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {STATUS_CHANNEL}")
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        topic, _, origin = conn.notifies.pop(0).payload.partition(' ')
+                        self.stats['notifications'] += 1
+                        # The sender already has the new document in its cache
+                        if topic.startswith('order:') and origin != _origin():
+                            forget_order(self.host, topic.split(':', 1)[1])
+                        with self._cond:
+                            watched = self._watchers.get(topic)
+                        if watched:
+                            self.mark_dirty(topic)
+            except Exception as e:
+                print(f"⚠️ Status stream listener disconnected ({e}); falling back to polling for 30s.")
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(30)
+
+    # --- streams ---
+
+    def _open(self, topics):
+        with self._cond:
+            if self._streams >= SSE_MAX_STREAMS:
+                self.stats['streams_rejected'] += 1
+                raise StreamLimitReached()
+            self._streams += 1
+            self.stats['streams_opened'] += 1
+            for topic in topics:
+                self._watchers[topic] = self._watchers.get(topic, 0) + 1
+                if topic not in self._states:
+                    self._dirty.add(topic)
+        self._wake.set()
+
+    def _close(self, topics):
+        with self._cond:
+            self._streams -= 1
+            for topic in topics:
+                self._watchers[topic] -= 1
+                if self._watchers[topic] <= 0:
+                    del self._watchers[topic]
+                    # Nobody is watching: forget it unless it can never change again
+                    if topic in self._states and not self._states[topic][2]:
+                        del self._states[topic]
+
+    def _parse_last_id(self, last_event_id):
+        epoch, _, seq = (last_event_id or '').partition('-')
+        if epoch == self.epoch and seq.isdigit():
+            return int(seq)
+        return 0
+
+    def stream(self, topics, last_event_id=None):
+        """
+        Opens a stream over `topics` ('order:<id>' / 'job:<id>') and returns
+        (SSE text generator, release). Raises StreamLimitReached when the
+        worker is already serving SSE_MAX_STREAMS streams.
+
+        The slot is freed when the generator finishes; the caller must also
+        call `release` when the response closes (Response.call_on_close),
+        because a generator that never started - a HEAD request, a client
+        gone before the first chunk - does not run its cleanup.
+        """
+        self._open(topics)
+        released = threading.Event()
+
+        def release():
+            with self._cond:
+                if released.is_set():
+                    return
+                released.set()
+            self._close(topics)
+
+        def generate():
+            try:
+                last_seen = self._parse_last_id(last_event_id)
+                yield f"retry: {SSE_RETRY_MS}\n\n"
+                started = time.monotonic()
+                while time.monotonic() - started < SSE_MAX_DURATION:
+                    with self._cond:
+                        self._cond.wait_for(lambda: self._seq > last_seen, timeout=SSE_HEARTBEAT)
+                        changed = sorted((self._states[t][0], t) for t in topics
+                                         if t in self._states and self._states[t][0] > last_seen)
+                        events = [(seq, self._states[t][1]) for seq, t in changed]
+                        all_final = all(t in self._states and self._states[t][2] for t in topics)
+                        last_seen = max(last_seen, self._seq)
+                    if not events:
+                        yield ": keepalive\n\n"
+                    for seq, data in events:
+                        yield _sse(data, event='status', event_id=f"{self.epoch}-{seq}")
+                    if all_final:
+                        # Nothing left to watch; the page closes its EventSource on this
+                        yield _sse({'topics': topics}, event='done')
+                        return
+            finally:
+                release()
+
+        return generate(), release
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, open_streams=self._streams, max_streams=SSE_MAX_STREAMS,
+                        watched_topics=len(self._watchers), known_topics=len(self._states))
+
+
+_hub = None
+_hub_lock = threading.Lock()
+
+
+def get_status_hub(host):
+    """The StatusHub of this worker process (started on first use)."""
+    global _hub
+    with _hub_lock:
+        if _hub is None or _hub._pid != os.getpid():
+            _hub = StatusHub(host)
+        return _hub
+
+
+def status_stream_stats():
+    return _hub.snapshot() if _hub is not None and _hub._pid == os.getpid() else None
@@ -0,0 +1,124 @@
+import pytest
+import requests
+
+import http_client
+from http_client import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeSession:
+    """Stands in for the shared requests.Session; raises `error` on every call."""
+
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        raise self.error
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(http_client.time, 'monotonic', clock)
+    monkeypatch.setattr(http_client.time, 'sleep', lambda seconds: None)
+    return clock
+
+
+def _session(monkeypatch, error):
+    session = FakeSession(error)
+    monkeypatch.setattr(http_client, 'get_session', lambda: session)
+    monkeypatch.setattr(http_client, '_breakers', {})
+    return session
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=10)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_success_resets_the_failure_count(clock):
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    # Past the reset timeout plus its jitter
+    clock.now += 13
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    breaker.before_call()
+
+
+def test_failed_probe_reopens(clock):
+    breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    clock.now += 13
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert breaker.stats['opened'] == 2
+
+
+def test_retry_budget_is_spent_and_earned(clock, monkeypatch):
+    monkeypatch.setattr(http_client, 'HTTP_RETRY_BUDGET_MAX', 2)
+    monkeypatch.setattr(http_client, 'HTTP_RETRY_BUDGET_RATIO', 0.5)
+    breaker = CircuitBreaker('test')
+    assert breaker.take_retry_token()
+    assert breaker.take_retry_token()
+    assert not breaker.take_retry_token()
+    # Retries earn nothing; two first attempts earn one token
+    breaker.before_call(retry=True)
+    assert not breaker.take_retry_token()
+    breaker.before_call()
+    breaker.before_call()
+    assert breaker.take_retry_token()
+    assert breaker.stats['retries_denied'] == 2
+
+
+def test_post_that_timed_out_reading_is_not_resent(clock, monkeypatch):
+    session = _session(monkeypatch, requests.ReadTimeout("read timed out"))
+    with pytest.raises(requests.ReadTimeout):
+        http_client.request('POST', 'http://lab.test/api', retries=2, endpoint='test.post')
+    assert session.calls == 1
+
+
+def test_post_that_could_not_connect_is_resent(clock, monkeypatch):
+    session = _session(monkeypatch, requests.ConnectTimeout("connect timed out"))
+    with pytest.raises(requests.ConnectTimeout):
+        http_client.request('POST', 'http://lab.test/api', retries=2, endpoint='test.post')
+    assert session.calls == 3
+
+
+def test_get_that_timed_out_reading_is_retried(clock, monkeypatch):
+    session = _session(monkeypatch, requests.ReadTimeout("read timed out"))
+    with pytest.raises(requests.ReadTimeout):
+        http_client.request('GET', 'http://lab.test/api', retries=2, endpoint='test.get')
+    assert session.calls == 3
@@ -0,0 +1,84 @@
+import sqlite3
+
+import pytest
+
+from pagination import decode_cursor, encode_cursor
+from patient_directory import decode_directory_cursor, list_patients_page
+
+# Duplicate names, so only the id breaks ties between them
+PATIENTS = [
+    ('Smith', 'Anna'), ('Smith', 'Anna'), ('Smith', 'Anna'), ('Brown', 'Zoe'),
+    ('Smith', 'Ben'), ('Adams', 'Anna'), ('Brown', 'Zoe'), ('Smith', 'Anna'), ('Zhang', 'Li'),
+]
+
+
+class SqliteCursor:
+    """Runs the directory queries (psycopg2 %s placeholders) against an in-memory SQLite table."""
+
+    def __init__(self, conn):
+        self._cursor = conn.cursor()
+
+    def execute(self, sql, params):
+        self._cursor.execute(sql.replace('%s', '?'), params)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+
+@pytest.fixture
+def cursor():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("""CREATE TABLE patients (id INTEGER PRIMARY KEY, uhid TEXT, first_name TEXT NOT NULL,
+                                           last_name TEXT NOT NULL, dob TEXT, gender TEXT)""")
+    conn.executemany(
+        "INSERT INTO patients (id, uhid, first_name, last_name) VALUES (?, ?, ?, ?)",
+        [(n, f"UH{n}", first, last) for n, (last, first) in enumerate(PATIENTS, start=1)]
+    )
+    yield SqliteCursor(conn)
+    conn.close()
+
+
+def _expected():
+    ordered = sorted((last, first, n) for n, (last, first) in enumerate(PATIENTS, start=1))
+    return [f"UH{n}" for _, _, n in ordered]
+
+
+def test_pages_neither_skip_nor_repeat_rows(cursor):
+    pages = []
+    rows, next_cursor, prev_cursor = list_patients_page(cursor, 2)
+    assert prev_cursor is None
+    pages.append([r[0] for r in rows])
+    while next_cursor:
+        rows, next_cursor, prev_cursor = list_patients_page(cursor, 2, after=decode_directory_cursor(next_cursor))
+        assert prev_cursor is not None
+        pages.append([r[0] for r in rows])
+    assert [uhid for page in pages for uhid in page] == _expected()
+
+    # Walking back from the last page returns the same pages
+    back = [pages[-1]]
+    while prev_cursor:
+        rows, _, prev_cursor = list_patients_page(cursor, 2, before=decode_directory_cursor(prev_cursor))
+        back.append([r[0] for r in rows])
+    assert list(reversed(back)) == pages
+
+
+def test_cursor_round_trip():
+    token = encode_cursor(['Smith', 'Anna', 42])
+    assert '=' not in token
+    assert decode_cursor(token, length=3) == ['Smith', 'Anna', 42]
+    assert decode_directory_cursor(token) == ('Smith', 'Anna', 42)
+
+
+@pytest.mark.parametrize('token', [
+    None,
+    '',
+    'not base64 at all!',
+    encode_cursor(['Smith', 'Anna']),
+    encode_cursor(['Smith', 'Anna', '42']),
+    encode_cursor(['Smith', None, 42]),
+    encode_cursor(['Smith', 'Anna', True]),
+    encode_cursor(['Smith\x00', 'Anna', 42]),
+    encode_cursor(['Smith', 'Anna', 42])[:-3],
+])
+def test_invalid_cursor_starts_from_the_first_page(token):
+    assert decode_directory_cursor(token) is None
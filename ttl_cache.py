@@ -0,0 +1,66 @@
+"""
+Small thread-safe in-process cache with a per-entry TTL and a size bound.
+
+Each gunicorn worker holds its own copy, so clear() only reaches the worker
+that handled the write; other workers catch up when their entries expire.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, maxsize=128, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value), oldest first
+        self._lock = threading.Lock()
+        # Bumped by clear(); a value computed before a clear() is not stored
+        self._generation = 0
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0}
+
+    @property
+    def generation(self):
+        """Pass this to set() to drop values computed across an invalidation."""
+        return self._generation
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return value
+                del self._entries[key]
+                self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            return default
+
+    def set(self, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+            return True
+
+    def pop(self, key):
+        with self._lock:
+            return self._entries.pop(key, (None, None))[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            self.stats['invalidations'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(self.stats, size=len(self._entries), maxsize=self.maxsize, ttl=self.ttl,
+                        hit_ratio=round(self.stats['hits'] / lookups, 3) if lookups else None)
@@ -0,0 +1,107 @@
+"""
+Completion callbacks from the LIS and PACS.
+
+Instead of being polled, the lab systems POST to us when something changes:
+
+    POST /api/webhooks/lis   {"orderId": "...", "order": {...order document, optional}}
+    POST /api/webhooks/pacs  {"request_id": "...", "status": "attended", "scan_id": "..."}
+
+Every call is signed with the shared WEBHOOK_SECRET:
+
+    X-Webhook-Timestamp: <unix seconds>
+    X-Webhook-Signature: sha256=<hex HMAC-SHA256 of "<timestamp>." + raw body>
+
+Calls older than WEBHOOK_TOLERANCE seconds are rejected so a captured
+request cannot be replayed later. Without WEBHOOK_SECRET the endpoints are
+disabled and completion is found by polling only.
+
+An LIS event stores the order's status (lab_orders.status), puts the
+document in the status cache and, once an order has completed, makes sure
+its report download is queued (whether or not /history saw the completion
+first); open status streams on every worker are told
+through NOTIFY. A PACS event runs the waiting scan_request job
+at once. Polling (the job backoff, /history, the status page) remains as
+the fallback for callbacks that never arrive.
+"""
+import hashlib
+import hmac
+import os
+import time
+
+from lab_orders import set_order_status
+from lab_status import SHARED_API_KEY, forget_order, get_order, order_state, prime_order
+from scan_jobs import enqueue_lab_report, wake_scan_request
+from status_stream import notify_status_change
+
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_TOLERANCE = int(os.environ.get('WEBHOOK_TOLERANCE', 300))
+TIMESTAMP_HEADER = 'X-Webhook-Timestamp'
+SIGNATURE_HEADER = 'X-Webhook-Signature'
+
+
+def sign(body, timestamp, secret=None):
+    """The X-Webhook-Signature value for `body` (bytes) sent at `timestamp`."""
+    secret = secret or WEBHOOK_SECRET
+    digest = hmac.new(secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def authenticate(body, headers):
+    """Returns None for a correctly signed, recent request, otherwise (error message, HTTP status)."""
+    if not WEBHOOK_SECRET:
+        return "Webhooks are not configured.", 503
+    timestamp = headers.get(TIMESTAMP_HEADER, '')
+    signature = headers.get(SIGNATURE_HEADER, '')
+    try:
+        age = abs(time.time() - int(timestamp))
+    except ValueError:
+        return "Missing or invalid timestamp.", 401
+    if age > WEBHOOK_TOLERANCE:
+        return "Timestamp outside the allowed window.", 401
+    if not hmac.compare_digest(signature, sign(body, timestamp)):
+        return "Invalid signature.", 401
+    return None
+
+
+def handle_lis_event(host, event):
+    """
+    Applies an order update from the LIS. Returns a summary dict, or None
+    when the order is not one of ours.
+    """
+    order_id = event.get('orderId')
+    if not order_id:
+        raise ValueError("orderId is required")
+    order = event.get('order')
+    if order:
+        prime_order(host, order_id, order)
+    else:
+        # Only told that something changed: fetch the new version once
+        forget_order(host, order_id)
+        status_code, order = get_order(host, SHARED_API_KEY, order_id, timeout=15)
+        if status_code != 200:
+            raise RuntimeError(f"Failed to fetch order {order_id}: {status_code}")
+
+    status = order_state(order)
+    previous = set_order_status(order_id, status)
+    if previous is None:
+        return None
+    _, uhid = previous
+    try:
+        notify_status_change('order', order_id)
+    except Exception as e:
+        print(f"⚠️ Could not notify status streams about order {order_id}: {e}")
+    report_job = None
+    if status == 'completed':
+        # Returns the existing job when one is already queued for the order
+        report_job = enqueue_lab_report(host, order_id, uhid, order=order)
+    return {'orderId': order_id, 'status': status, 'reportJob': report_job}
+
+
+def handle_pacs_event(event):
+    """Wakes the scan_request job waiting on the reported request. Returns a summary dict."""
+    request_id = event.get('request_id') or event.get('id')
+    if not request_id:
+        raise ValueError("request_id is required")
+    status = (event.get('status') or '').lower()
+    scan_id = event.get('scan_id') if status in ('attended', 'completed') else None
+    return {'request_id': request_id, 'jobs': wake_scan_request(request_id, scan_id)}